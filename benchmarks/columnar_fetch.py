@@ -0,0 +1,64 @@
+"""Compare fetching rows with DictCursor against fetching columns.
+
+The same query is read three ways: into DictRows the way every ciptools
+connection does by default, into columns of array.array and, if numpy is
+installed, into columns of numpy arrays. The time taken and the peak amount of
+memory allocated by Python are printed for each.
+
+    python benchmarks/columnar_fetch.py --rows 5000000 --dsn "host=localhost dbname=postgres"
+
+"""
+import argparse
+import importlib.util
+import time
+import tracemalloc
+
+from ciptools.database.pool import DatabaseClient
+
+QUERY = """
+    SELECT i AS id, i %% 1000 AS retweets, i / 7.0::float8 AS score, 'tweet ' || i AS text
+    FROM generate_series(1, %s) AS i
+"""
+
+
+def rows(db, count):
+    with db.transaction() as conn:
+        with conn.cursor() as cur:
+            cur.execute(QUERY, (count,))
+            results = cur.fetchall()
+    return len(results)
+
+
+def columns(db, count, numpy=False):
+    results = db.fetch_columns(QUERY, (count,), numpy=numpy)
+    return len(results["id"])
+
+
+def measure(name, function, *args, **kwargs):
+    tracemalloc.start()
+    started = time.perf_counter()
+    count = function(*args, **kwargs)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{:>8}: {} rows in {:.2f}s, peak {:.1f} MiB".format(name, count, elapsed, peak / 1048576))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", default="", help="libpq connection string")
+    parser.add_argument("--rows", type=int, default=5000000)
+    args = parser.parse_args()
+
+    db = DatabaseClient(minconn=1, maxconn=1, retry=False, dsn=args.dsn)
+    measure("dict", rows, db, args.rows)
+    measure("array", columns, db, args.rows)
+    if importlib.util.find_spec("numpy") is None:
+        print("numpy is not installed, skipping")
+    else:
+        measure("numpy", columns, db, args.rows, numpy=True)
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Compare loading rows with text COPY and binary COPY.
+
+Rows that look like tweets are generated and loaded into a temporary table,
+once through StringIteratorIO in text format and once in binary format. With
+"--encode-only" nothing is sent to the database and only the time spent
+formatting rows in Python is measured.
+
+    python benchmarks/copy_formats.py --rows 3000000 --dsn "host=localhost dbname=postgres"
+
+"""
+import argparse
+import datetime
+import time
+
+from ciptools.database.pool import DatabaseClient
+from ciptools.pgcopy import BinaryCopyIO
+from ciptools.strings import StringIteratorIO, copy_line
+
+COLUMNS = ["id", "created_at", "author_id", "text", "retweets", "score", "data"]
+TYPES = ["int8", "timestamptz", "int8", "text", "int4", "float8", "jsonb"]
+
+
+def generate(count):
+    started = datetime.datetime(2020, 11, 3, tzinfo=datetime.timezone.utc)
+    for i in range(count):
+        yield (
+            1323000000000000000 + i,
+            started + datetime.timedelta(seconds=i),
+            i % 100000,
+            "this is tweet number {}\twith a tab and a \\ backslash".format(i),
+            i % 1000,
+            i / 7.0,
+            '{"lang": "en", "source": "web"}',
+        )
+
+
+def encode_only(count):
+    started = time.perf_counter()
+    data = StringIteratorIO(copy_line(row) for row in generate(count))
+    while data.read(65536):
+        pass
+    print("text encode:   {:.2f}s".format(time.perf_counter() - started))
+
+    started = time.perf_counter()
+    data = BinaryCopyIO(TYPES, generate(count))
+    while data.read(65536):
+        pass
+    print("binary encode: {:.2f}s".format(time.perf_counter() - started))
+
+
+def load(dsn, count):
+    db = DatabaseClient(minconn=1, maxconn=1, retry=False, dsn=dsn)
+    definition = ", ".join("{} {}".format(c, t) for c, t in zip(COLUMNS, TYPES))
+
+    for name, types in (("text", None), ("binary", TYPES)):
+        with db.transaction() as conn:
+            with conn.cursor() as cur:
+                cur.execute("CREATE TEMPORARY TABLE copy_benchmark ({}) ON COMMIT DROP".format(definition))
+            result = db.copy_rows("copy_benchmark", COLUMNS, generate(count), types=types)
+        print("{:>6}: {} rows in {:.2f}s ({:.0f} rows/s)".format(name, result.rows, result.seconds, result.rows_per_second))
+
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", default="", help="libpq connection string")
+    parser.add_argument("--rows", type=int, default=3000000)
+    parser.add_argument("--encode-only", action="store_true")
+    args = parser.parse_args()
+
+    if args.encode_only:
+        encode_only(args.rows)
+    else:
+        load(args.dsn, args.rows)
+
+
+if __name__ == "__main__":
+    main()
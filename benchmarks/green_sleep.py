@@ -0,0 +1,60 @@
+"""Run hundreds of concurrent pg_sleep queries from green threads.
+
+With eventlet or gevent patched and the psycopg2 wait callback installed, each
+green thread yields to the hub while its query runs. All of the queries run
+at the same time and the whole run takes about as long as a single query.
+Without the callback every query blocks the hub and the run takes the sum of
+all of them.
+
+    python benchmarks/green_sleep.py --library eventlet --dsn "host=localhost dbname=postgres"
+
+Remember that the server needs "max_connections" to be at least as large as
+the number of green threads.
+"""
+import argparse
+import time
+
+import ciptools.monkey
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", default="", help="libpq connection string")
+    parser.add_argument("--library", choices=["eventlet", "gevent"], default="eventlet")
+    parser.add_argument("--greenlets", type=int, default=200)
+    parser.add_argument("--sleep", type=float, default=1.0)
+    args = parser.parse_args()
+
+    if args.library == "eventlet":
+        ciptools.monkey.eventlet_patch()
+    else:
+        ciptools.monkey.gevent_patch()
+    print("wait callback installed: {}".format(ciptools.monkey.patch_psycopg()))
+
+    # import this after patching so that the pool gets green locks
+    from ciptools.database.pool import DatabaseClient
+    db = DatabaseClient(minconn=args.greenlets, maxconn=args.greenlets, retry=False, ping="never", dsn=args.dsn)
+
+    def query():
+        with db.conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_sleep(%s)", (args.sleep,))
+
+    started = time.monotonic()
+    if args.library == "eventlet":
+        import eventlet
+        pool = eventlet.GreenPool(args.greenlets)
+        for _ in range(args.greenlets):
+            pool.spawn_n(query)
+        pool.waitall()
+    else:
+        import gevent
+        gevent.joinall([gevent.spawn(query) for _ in range(args.greenlets)])
+    elapsed = time.monotonic() - started
+
+    print("{} queries of {}s each finished in {:.2f}s".format(args.greenlets, args.sleep, elapsed))
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
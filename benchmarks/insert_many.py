@@ -0,0 +1,64 @@
+"""Compare ways of upserting rows.
+
+Rows are upserted into a temporary table with execute_values using its
+default page size, with insert_many and its adaptive page size and, for
+comparison, loaded with COPY, which can't upsert but is as fast as it gets.
+
+    python benchmarks/insert_many.py --rows 1000000 --dsn "host=localhost dbname=postgres"
+
+"""
+import argparse
+import time
+
+from psycopg2.extras import execute_values
+
+from ciptools.database import bulk
+from ciptools.database.pool import DatabaseClient
+
+UPSERT = "ON CONFLICT (id) DO UPDATE SET text = excluded.text, score = excluded.score"
+
+
+def generate(count):
+    for i in range(count):
+        yield i, "this is tweet number {}".format(i), i / 7.0
+
+
+def run(db, name, load):
+    with db.transaction() as conn:
+        with conn.cursor() as cur:
+            cur.execute("CREATE TEMPORARY TABLE upsert_benchmark (id int8 PRIMARY KEY, text text, score float8) ON COMMIT DROP")
+        started = time.perf_counter()
+        count = load(conn)
+        elapsed = time.perf_counter() - started
+    print("{:>15}: {} rows in {:.2f}s ({:.0f} rows/s)".format(name, count, elapsed, count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", default="", help="libpq connection string")
+    parser.add_argument("--rows", type=int, default=1000000)
+    args = parser.parse_args()
+    count = args.rows
+
+    db = DatabaseClient(minconn=1, maxconn=1, retry=False, dsn=args.dsn)
+
+    def values(conn):
+        with conn.cursor() as cur:
+            execute_values(cur, "INSERT INTO upsert_benchmark VALUES %s " + UPSERT, list(generate(count)))
+        return count
+
+    def paged(conn):
+        return db.insert_many("upsert_benchmark", ["id", "text", "score"], generate(count), on_conflict=UPSERT).rows
+
+    def copy(conn):
+        # the temporary table only exists on this connection
+        return bulk.copy_rows(conn, "upsert_benchmark", ["id", "text", "score"], generate(count)).rows
+
+    run(db, "execute_values", values)
+    run(db, "insert_many", paged)
+    run(db, "copy", copy)
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Measure what instrumenting cursors costs.
+
+The same short query is run over and over on one connection with and without
+instrumentation and the time per query is printed for each. The difference
+is the overhead of timing and fingerprinting every query.
+
+    python benchmarks/instrument_overhead.py --queries 20000 --dsn "host=localhost dbname=postgres"
+
+"""
+import argparse
+import time
+
+from ciptools.database.pool import DatabaseClient
+
+QUERY = "SELECT %s::int8 AS id, %s::text AS text"
+
+
+def run(instrument, count, dsn):
+    db = DatabaseClient(minconn=1, maxconn=1, retry=False, instrument=instrument, slow_query=None, dsn=dsn)
+    with db.conn() as conn:
+        with conn.cursor() as cur:
+            started = time.perf_counter()
+            for i in range(count):
+                cur.execute(QUERY, (i, "tweet"))
+                cur.fetchall()
+            elapsed = time.perf_counter() - started
+    db.close()
+
+    print("{:>13}: {} queries in {:.2f}s ({:.1f} us/query)".format(
+        "instrumented" if instrument else "plain", count, elapsed, elapsed / count * 1e6,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", default="", help="libpq connection string")
+    parser.add_argument("--queries", type=int, default=20000)
+    args = parser.parse_args()
+
+    for instrument in (False, True, False, True):
+        run(instrument, args.queries, args.dsn)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""See how loading with parallel_copy scales with the number of workers.
+
+Rows that look like tweets are loaded into an unlogged table once for each
+number of workers. The table is created before and dropped after.
+
+    python benchmarks/parallel_copy.py --rows 4000000 --workers 1 2 4 8 --dsn "host=localhost dbname=postgres"
+
+"""
+import argparse
+import datetime
+
+from ciptools.database.parallel import parallel_copy
+from ciptools.database.pool import DatabaseClient
+
+COLUMNS = ["id", "created_at", "text", "score"]
+
+
+def generate(count):
+    started = datetime.datetime(2020, 11, 3, tzinfo=datetime.timezone.utc)
+    for i in range(count):
+        yield (
+            1323000000000000000 + i,
+            started + datetime.timedelta(seconds=i),
+            "this is tweet number {}\twith a tab and a \\ backslash".format(i),
+            i / 7.0,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", default="", help="libpq connection string")
+    parser.add_argument("--rows", type=int, default=4000000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    db = DatabaseClient(minconn=1, maxconn=1, retry=False, dsn=args.dsn)
+    with db.conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("CREATE UNLOGGED TABLE parallel_benchmark (id int8, created_at timestamptz, text text, score float8)")
+
+    try:
+        for workers in args.workers:
+            result = parallel_copy({"dsn": args.dsn}, "parallel_benchmark", COLUMNS, rows=generate(args.rows), workers=workers)
+            print("{:>3} workers: {} rows in {:.2f}s ({:.0f} rows/s)".format(workers, result.rows, result.seconds, result.rows_per_second))
+            with db.conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("TRUNCATE parallel_benchmark")
+    finally:
+        with db.conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DROP TABLE parallel_benchmark")
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
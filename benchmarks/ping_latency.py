@@ -0,0 +1,56 @@
+"""Compare checkout latency for each of the connection liveness policies.
+
+Each policy gets its own pool. A single thread checks out a connection, runs a
+trivial query and puts the connection back, over and over. The "always"
+policy pays for an extra round trip on every checkout. The others only look
+at the local state of the connection most or all of the time.
+
+    python benchmarks/ping_latency.py --dsn "host=localhost dbname=postgres"
+
+"""
+import argparse
+import statistics
+import time
+
+from ciptools.database import liveness
+from ciptools.database.pool import DatabaseClient
+
+
+def run(dsn, ping, iterations):
+    db = DatabaseClient(minconn=1, maxconn=1, retry=False, ping=ping, ping_idle=1.0, dsn=dsn)
+
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        with db.conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+        timings.append(time.perf_counter() - started)
+
+    timings.sort()
+    return {
+        "mean": statistics.mean(timings),
+        "p50": timings[len(timings) // 2],
+        "p99": timings[int(len(timings) * 0.99)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", default="", help="libpq connection string")
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args()
+
+    for ping in liveness.PING_POLICIES:
+        result = run(args.dsn, ping, args.iterations)
+        print("{:>8}: mean={:.1f}us p50={:.1f}us p99={:.1f}us".format(
+            ping,
+            result["mean"] * 1e6,
+            result["p50"] * 1e6,
+            result["p99"] * 1e6,
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Measure ConnectionPool throughput while new connections are slow.
+
+Every worker thread checks out a connection, runs a trivial query and puts the
+connection back. A fraction of the connections are closed when they are put
+back so the pool is constantly making new ones, and every new connection is
+made artificially slow to simulate a flaky or distant database host. When the
+pool connects while holding its lock then every other thread stalls behind
+the slow connect and throughput collapses.
+
+    python benchmarks/pool_throughput.py --dsn "host=localhost dbname=postgres"
+
+"""
+import argparse
+import threading
+import time
+import uuid
+
+import psycopg2.extensions
+
+from ciptools.database.pool import ConnectionPool, PoolError
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", default="", help="libpq connection string")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--maxconn", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--connect-delay", type=float, default=0.5, help="seconds added to every connect")
+    parser.add_argument("--close-ratio", type=float, default=0.05, help="fraction of connections closed on return")
+    args = parser.parse_args()
+
+    class SlowConnection(psycopg2.extensions.connection):
+        def __init__(self, *a, **kw):
+            time.sleep(args.connect_delay)
+            super().__init__(*a, **kw)
+
+    pool = ConnectionPool(args.maxconn, args.maxconn, False, args.dsn, connection_factory=SlowConnection)
+    stop = threading.Event()
+    counts = []
+    exhausted = []
+
+    def worker():
+        count = 0
+        misses = 0
+        n = 0
+        while not stop.is_set():
+            key = str(uuid.uuid4())
+            try:
+                conn = pool.getconn(key)
+            except PoolError:
+                misses = misses + 1
+                time.sleep(0.001)
+                continue
+
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+
+            n = n + 1
+            pool.putconn(key, close=(n * args.close_ratio) % 1.0 < args.close_ratio)
+            count = count + 1
+        counts.append(count)
+        exhausted.append(misses)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    print("threads={} maxconn={} connect_delay={}s".format(args.threads, args.maxconn, args.connect_delay))
+    print("checkouts: {} ({:.1f}/s)".format(sum(counts), sum(counts) / elapsed))
+    print("exhausted: {}".format(sum(exhausted)))
+
+
+if __name__ == "__main__":
+    main()
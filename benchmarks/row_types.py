@@ -0,0 +1,55 @@
+"""Compare the cost of each row type.
+
+The same query is fetched once for each row type. The time taken, the rows
+per second and the peak amount of memory allocated by Python while the rows
+were held are printed for each.
+
+    python benchmarks/row_types.py --rows 2000000 --dsn "host=localhost dbname=postgres"
+
+"""
+import argparse
+import time
+import tracemalloc
+
+from ciptools.database.pool import DatabaseClient
+from ciptools.database.rows import CURSOR_FACTORIES
+
+QUERY = """
+    SELECT i AS id, i %% 1000 AS retweets, i / 7.0::float8 AS score, 'tweet ' || i AS text
+    FROM generate_series(1, %s) AS i
+"""
+
+
+def fetch(db, row_type, count):
+    with db.conn(row_type=row_type) as conn:
+        with conn.cursor() as cur:
+            cur.execute(QUERY, (count,))
+
+            # only measure making the row objects. the results are already on
+            # the client once execute returns.
+            tracemalloc.start()
+            started = time.perf_counter()
+            rows = cur.fetchall()
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    print("{:>10}: {} rows in {:.2f}s ({:.0f} rows/s), peak {:.1f} MiB".format(
+        row_type, len(rows), elapsed, len(rows) / elapsed, peak / 1048576,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", default="", help="libpq connection string")
+    parser.add_argument("--rows", type=int, default=2000000)
+    args = parser.parse_args()
+
+    db = DatabaseClient(minconn=1, maxconn=1, retry=False, dsn=args.dsn)
+    for row_type in CURSOR_FACTORIES:
+        fetch(db, row_type, args.rows)
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -32,21 +32,52 @@ Example:
         client_id="my-different-client-id"
     )
 
+    # send "SELECT 1" to check that the connection still works every time
+    # instead of only when it hasn't been used for "ping_idle" seconds. see
+    # ciptools.database.liveness for the policies.
+    conn = ciptools.database.conn(
+        host="mars.lab.cip.uw.edu",
+        ping="always",
+    )
+
+    # get rows back as plain tuples instead of DictRows. the connection is
+    # shared so this lasts until the next call asks for something else, unless
+    # the connection is in a transaction. see ciptools.database.rows for the
+    # other row types.
+    conn = ciptools.database.conn(host="mars.lab.cip.uw.edu", row_type="tuple")
+
+Pass instrument=True to time every query on the connection and log the slow
+ones. See ciptools.database.instrument.
+
+When connecting to a database fails over and over then attempts to connect to
+it fail right away for a while without trying. See ciptools.database.breaker
+for how that works and pass circuit_breaker=False to turn it off.
+
+Connections belong to the thread that asked for them. When the thread exits,
+or the process forks, its connections are released the next time the
+registry is swept. That happens every SWEEP_INTERVAL seconds when "conn" is
+called, right away after a fork, or whenever "sweep" is called. "count" says
+how many connections are in the registry.
+
 """
 
 import logging
 import os
 import threading
+import time
 import traceback
+import weakref
 from collections import defaultdict
 
 import psycopg2
-import psycopg2.extras
 
+import ciptools.monkey
+from ciptools.database import breaker, liveness, rows
 # export the class that connects to the database. this may cause a circular
 # import problem since that class relies on this module but only if we call
 # this code when doing the import so we're ok.
 from ciptools.database.client import DatabaseClient
+from ciptools.database.pool import detach
 
 # export the database client class
 __all__ = ["DatabaseClient"]
@@ -56,6 +87,36 @@ __all__ = ["DatabaseClient"]
 # second dict is the combo of the dsn and the client id.
 connections = defaultdict(dict)
 
+# when each of the connections above was last handed out, keyed the same way.
+# this is used to decide whether to check the connection before reusing it.
+last_used = defaultdict(dict)
+
+# the process and thread that each connection id above belongs to. the thread
+# is a weak reference so that we don't keep it around after it exits.
+owners = {}
+
+# how often, in seconds, "conn" looks for connections of threads that are gone
+SWEEP_INTERVAL = 60.0
+
+# when and in which process the registry was last swept. only one thread
+# sweeps at a time.
+_last_sweep = time.monotonic()
+_sweep_pid = os.getpid()
+_sweep_lock = threading.Lock()
+
+# held while changing who owns an entry in the registry or taking an entry
+# out of it. never held while talking to the database.
+_registry_lock = threading.Lock()
+
+
+def _reset_sweep_lock():
+    global _sweep_lock, _registry_lock
+    _sweep_lock = threading.Lock()
+    _registry_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_sweep_lock)
+
 # want logging on database connections
 logger = logging.getLogger(__name__)
 
@@ -67,51 +128,81 @@ def conn(
         password: str = None,
         sslmode: str = "require",
         client_id: str = "default",
+        ping: str = liveness.PING_IDLE,
+        ping_idle: float = 30.0,
+        row_type: str = rows.ROW_DICT,
+        circuit_breaker: bool = True,
+        instrument: bool = False,
 ):
-    # add standard options to the list of options
-    options = {
-        "host": host,
-        "database": database,
-        "user": user,
-        "password": password,
-        "sslmode": sslmode,
-        "cursor_factory": psycopg2.extras.DictCursor,
-    }
+    # make sure the row type makes sense before connecting
+    factory = rows.cursor_factory(row_type)
+    if instrument:
+        factory = ciptools.database.instrument.cursor_class(factory)
+
+    # every so often, and right after a fork, let go of connections that
+    # belong to threads that are gone or to the process we were forked from
+    global _last_sweep
+    now = time.monotonic()
+    if now - _last_sweep >= SWEEP_INTERVAL or _sweep_pid != os.getpid():
+        _last_sweep = now
+        sweep()
 
     # get identifier for the connection and the key for the connection
     connection_id = get_connection_id()
     dsn = (host, database, user, password, sslmode, client_id)
 
-    # if this dsn doesn't exist then mark it as "down"
-    if dsn not in connections[connection_id]:
-        connections[connection_id][dsn] = None
+    # remember who this belongs to. thread ids can be reused so check that it
+    # is still the same thread. a sweep that started before we took over from
+    # a thread that is gone won't release what we take over.
+    thread = threading.current_thread()
+    with _registry_lock:
+        owner = owners.get(connection_id)
+        if owner is None or owner[1]() is not thread:
+            owners[connection_id] = (os.getpid(), weakref.ref(thread))
+
+        # if this dsn doesn't exist then mark it as "down"
+        if dsn not in connections[connection_id]:
+            connections[connection_id][dsn] = None
 
-    # try to get the connection out of our connection dict
-    connection = connections[connection_id][dsn]
+        # try to get the connection out of our connection dict
+        connection = connections[connection_id][dsn]
 
     try:
         if connection is not None:
             # if we have a connection handle already then try to verify that it
             # still works. if it doesn't then go try to connect again below.
-            try:
-                with connection.cursor() as cur:
-                    cur.execute("SELECT 1")
+            now = time.monotonic()
+            idle = now - last_used[connection_id].get(dsn, now)
+            if liveness.check(connection, ping, idle, ping_idle):
                 logger.debug("reusing connection for {}".format(dsn))
+                last_used[connection_id][dsn] = now
+
+                # a connection in a transaction keeps the row type that the
+                # transaction started with
+                if connection.autocommit:
+                    connection.cursor_factory = factory
+                if instrument:
+                    ciptools.database.instrument.attach(connection)
                 return connection
+
+            # it is ok if this fails as we will just create a new connection
+            try:
+                connection.close()
             except psycopg2.Error:
-                # it is ok if this fails as we will just create a new connection
                 pass
 
         # actually connect to the database. if we can't connect to the database
         # then this line will blow up.
         logger.debug("creating new connection for {}".format(dsn))
-        connection = psycopg2.connect(**options)
+        connection = connect(host, database, user, password, sslmode, row_type=factory, circuit_breaker=circuit_breaker)
 
-        # make this behave like everything else for now
-        connection.autocommit = True
+        if instrument:
+            ciptools.database.instrument.attach(connection)
 
         # add this new connection to our list of connections
-        connections[connection_id][dsn] = connection
+        with _registry_lock:
+            connections[connection_id][dsn] = connection
+            last_used[connection_id][dsn] = time.monotonic()
 
         return connection
     except Exception:
@@ -130,12 +221,116 @@ def conn(
             pass
 
         # remove references to it which destroys the object
-        del connections[connection_id][dsn]
+        with _registry_lock:
+            connections[connection_id].pop(dsn, None)
+            last_used[connection_id].pop(dsn, None)
 
         # re-raise the exception that got us here
         raise
 
 
+def connect(
+        host: str = None,
+        database: str = None,
+        user: str = None,
+        password: str = None,
+        sslmode: str = "require",
+        row_type: str = rows.ROW_DICT,
+        circuit_breaker: bool = False,
+):
+    # make a brand new connection that isn't tracked anywhere. the caller is
+    # responsible for closing it. if eventlet or gevent is in charge then make
+    # sure that waiting on the database yields to the hub.
+    ciptools.monkey.patch_psycopg()
+
+    # with the circuit breaker, fail right away while the database is down
+    circuit = breaker.get((host, database, user, sslmode)) if circuit_breaker else None
+    if circuit is not None:
+        circuit.before()
+    try:
+        connection = psycopg2.connect(
+            host=host,
+            database=database,
+            user=user,
+            password=password,
+            sslmode=sslmode,
+            cursor_factory=rows.cursor_factory(row_type),
+        )
+    except Exception:
+        if circuit is not None:
+            circuit.failure()
+        raise
+    if circuit is not None:
+        circuit.success()
+
+    # make this behave like everything else for now
+    connection.autocommit = True
+
+    return connection
+
+
+def sweep() -> int:
+    """Release connections that belong to threads that have exited.
+
+    Connections that were inherited from a parent process are detached without
+    disturbing the parent. Returns how many connections were released.
+    """
+    global _sweep_pid
+    if not _sweep_lock.acquire(blocking=False):
+        # someone else is already doing it
+        return 0
+
+    try:
+        pid = os.getpid()
+        _sweep_pid = pid
+
+        released = 0
+        for connection_id, owner in list(owners.items()):
+            owner_pid, ref = owner
+            thread = ref()
+            if owner_pid == pid and thread is not None and thread.is_alive():
+                continue
+
+            # a new thread with the same id may have taken these over since
+            # we looked. then they are its connections now.
+            with _registry_lock:
+                if owners.get(connection_id) is not owner:
+                    continue
+                owners.pop(connection_id)
+                last_used.pop(connection_id, None)
+                dsns = connections.pop(connection_id, {})
+
+            for connection in dsns.values():
+                if connection is None:
+                    continue
+
+                released += 1
+                if owner_pid != pid:
+                    detach(connection)
+                    continue
+
+                try:
+                    connection.close()
+                except psycopg2.Error as e:
+                    logger.warning("could not close connection of exited thread: {}".format(e))
+
+        if released:
+            logger.debug("released {} connections of exited threads or processes".format(released))
+        return released
+    finally:
+        _sweep_lock.release()
+
+
+def count() -> int:
+    """Return how many open connections the registry is holding."""
+    return sum(
+        1
+        for dsns in list(connections.values())
+        for connection in list(dsns.values())
+        if connection is not None
+    )
+
+
 def get_connection_id():
     # yes, thread ids "may be recycled when a thread exits and another thread
     # is created" but since this value is never getting communicated to other
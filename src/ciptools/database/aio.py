@@ -0,0 +1,437 @@
+"""Asynchronous Database Client Library
+
+This works like ciptools.database.pool.DatabaseClient except that it is meant
+to be used with asyncio. It uses the asynchronous mode that is built into
+psycopg2 and waits for the database using the event loop so thousands of tasks
+can share a small pool of connections from a single thread.
+
+Example:
+
+    from ciptools.database.aio import AsyncDatabaseClient
+
+    db = AsyncDatabaseClient(host="mars.lab.cip.uw.edu", database="election2020")
+
+    async with db.conn() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT txid_current()")
+            print(cur.fetchone())
+
+    async with db.transaction() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT txid_current()")
+            print(cur.fetchone())
+
+            await cur.execute("SELECT txid_current()")
+            print(cur.fetchone())
+
+    await db.close()
+
+
+Asynchronous connections in psycopg2 are always in autocommit mode so
+transactions are started with "BEGIN" and finished with "COMMIT" or "ROLLBACK"
+by the client. Named (server-side) cursors and "executemany" are not available
+on asynchronous connections.
+
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import psycopg2
+import psycopg2.extensions
+import tenacity
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from ciptools.database import liveness
+from ciptools.database.pool import PoolError
+from ciptools.database.rows import ROW_DICT, cursor_factory
+
+logger = logging.getLogger(__name__)
+
+
+async def wait(conn):
+    """Wait for the connection to finish whatever it is doing.
+
+    This returns when psycopg2 says that the connection is ready and waits for
+    the connection's socket on the event loop when it is not.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            state = conn.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                return
+            elif state == psycopg2.extensions.POLL_READ:
+                await _wait_fd(conn.fileno(), loop.add_reader, loop.remove_reader)
+            elif state == psycopg2.extensions.POLL_WRITE:
+                await _wait_fd(conn.fileno(), loop.add_writer, loop.remove_writer)
+            else:
+                raise psycopg2.OperationalError("bad state from poll: {}".format(state))
+    except asyncio.CancelledError:
+        # we gave up on whatever the connection was doing so ask the server
+        # to stop doing it too. the pool will not reuse this connection.
+        try:
+            conn.cancel()
+        except psycopg2.Error as e:
+            logger.warning("could not cancel query: {}".format(e))
+        raise
+
+
+async def _wait_fd(fd, add, remove):
+    future = asyncio.get_running_loop().create_future()
+    add(fd, lambda: future.done() or future.set_result(None))
+    try:
+        await future
+    finally:
+        remove(fd)
+
+
+class AsyncCursor:
+    """Wraps a psycopg2 cursor so that queries can be awaited.
+
+    Everything except "execute" and "callproc" is passed through to the
+    underlying cursor. Fetching rows does not need to be awaited because the
+    rows are already on the client once "execute" returns.
+    """
+
+    def __init__(self, conn, cursor):
+        self.connection = conn
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.cursor.close()
+
+    async def execute(self, query, params=None):
+        self.cursor.execute(query, params)
+        await wait(self.connection.raw)
+
+    async def callproc(self, procname, params=None):
+        self.cursor.callproc(procname, params)
+        await wait(self.connection.raw)
+
+
+class AsyncConnection:
+    """Wraps a psycopg2 asynchronous connection."""
+
+    def __init__(self, conn):
+        self.raw = conn
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def cursor(self, *args, **kwargs):
+        return AsyncCursor(self, self.raw.cursor(*args, **kwargs))
+
+    async def execute(self, query, params=None):
+        async with self.cursor() as cur:
+            await cur.execute(query, params)
+
+
+class AsyncConnectionPool:
+    def __init__(
+            self,
+            minconn,
+            maxconn,
+            retry,
+            *args,
+            timeout=30.0,
+            ping=liveness.PING_ALWAYS,
+            ping_idle=30.0,
+            **kwargs,
+    ):
+        self.minconn = int(minconn)
+        self.maxconn = int(maxconn)
+
+        # how long to wait for a connection when the pool is exhausted. zero
+        # means fail immediately and None means wait forever.
+        self.timeout = timeout
+
+        # how to check connections before handing them out. see the liveness
+        # module for what the policies mean.
+        self.ping = liveness.validate_policy(ping)
+        self.ping_idle = ping_idle
+
+        self._args = args
+        self._kwargs = kwargs
+
+        self._pool = []   # connections that are available, with idle time
+        self._used = set()  # connections currently in use
+        self._pending = 0  # connections being checked out
+        self._returning = 0  # connections being put back
+        self._reserved = 0  # handed to waiting tasks that haven't run yet
+        self._closed = False
+
+        # tasks waiting for a connection, oldest first. when a connection is
+        # returned it is handed directly to the task at the front of the line.
+        self._waiters = deque()
+
+        # control retries
+        self._retry = retry
+
+    async def getconn(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        if self._closed:
+            raise PoolError("connection pool is closed")
+
+        # take what is available unless somebody is already waiting for it.
+        # otherwise get in line.
+        item = False
+        if not self._waiters:
+            if len(self._pool):
+                item = self._pool.pop()
+            elif self._available():
+                item = None
+
+        if item is False:
+            item = await self._wait(timeout)
+
+        # we now hold either an idle connection or a reserved slot for a new
+        # connection. either way it counts against maxconn.
+        self._pending += 1
+        try:
+            if item is None:
+                conn = await self._connect()
+            else:
+                conn = await self._check(*item)
+        except BaseException:
+            self._pending -= 1
+            self._notify()
+            raise
+
+        self._pending -= 1
+        self._used.add(conn)
+        return conn
+
+    async def putconn(self, conn, close=False):
+        if conn not in self._used:
+            raise PoolError("connection is not from this pool")
+
+        self._used.discard(conn)
+        keep = (
+            not close
+            and not self._closed
+            and len(self._pool) + self._returning < self.minconn
+        )
+
+        if keep:
+            # return the connection into a consistent state before putting it
+            # back in the pool. it still counts against maxconn until then.
+            self._returning += 1
+            try:
+                keep = await self._reset(conn)
+            finally:
+                self._returning -= 1
+
+        if keep and not self._closed:
+            self._pool.append((conn, time.monotonic()))
+        else:
+            self._discard(conn)
+        self._notify()
+
+    async def close(self):
+        # close every idle connection. the connections that are in use are
+        # closed when they are put back.
+        self._closed = True
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(PoolError("connection pool is closed"))
+
+        idle, self._pool = self._pool, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+    async def _wait(self, timeout):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # the shield keeps a connection that arrives right as we time out
+            # from getting lost. we check for it below.
+            item = await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                raise PoolError("connection pool exhausted") from None
+            item = waiter.result()
+        except BaseException:
+            # we were cancelled. if something was handed to us in the meantime
+            # then give it to the next task in line.
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                item = waiter.result()
+                self._reserved -= 1
+                if item is not None:
+                    self._pool.append(item)
+                self._notify()
+            raise
+        finally:
+            if not waiter.done():
+                waiter.cancel()
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+
+        self._reserved -= 1
+        return item
+
+    def _available(self):
+        return len(self._used) + self._pending + self._returning + self._reserved < self.maxconn
+
+    def _notify(self):
+        # hand whatever is available to the tasks at the front of the line
+        while self._waiters and (len(self._pool) or self._available()):
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+
+            # whatever we hand out stays reserved so that nobody else takes it
+            # before the waiting task gets a chance to run
+            self._reserved += 1
+            if len(self._pool):
+                waiter.set_result(self._pool.pop())
+            else:
+                waiter.set_result(None)
+
+    async def _check(self, conn, idle_since):
+        idle = time.monotonic() - idle_since
+        usable = liveness.is_usable(conn)
+        if usable and (self.ping == liveness.PING_ALWAYS or (self.ping == liveness.PING_IDLE and idle >= self.ping_idle)):
+            try:
+                await AsyncConnection(conn).execute("SELECT 1")
+            except psycopg2.Error as e:
+                logger.warning("connection failed: {}".format(e))
+                usable = False
+
+        if usable:
+            return conn
+
+        # test failed, make a new connection
+        self._discard(conn)
+        logger.warning("creating new connection to replace failed connection")
+        return await self._connect()
+
+    @staticmethod
+    async def _reset(conn):
+        # return the connection into a consistent state by rolling back or
+        # forcibly disconnecting. returns true if it can be reused.
+        try:
+            if conn.isexecuting() or not liveness.is_usable(conn):
+                return False
+            if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                # connection in error or in transaction
+                await AsyncConnection(conn).execute("ROLLBACK")
+            return True
+        except psycopg2.Error as e:
+            logger.warning("could not reset database connection when putting back into the pool: {}".format(e))
+            return False
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except psycopg2.Error as e:
+            logger.warning("could not close database connection: {}".format(e))
+
+    async def _connect(self):
+        # stop right away unless we are retrying
+        stop = tenacity.stop_never if self._retry else tenacity.stop_after_attempt(1)
+
+        counter = 0
+        async for attempt in tenacity.AsyncRetrying(
+                reraise=True,
+                stop=stop,
+                wait=tenacity.wait_fixed(0.1) + tenacity.wait_random(0, 0.9),
+        ):
+            with attempt:
+                counter = counter + 1
+                try:
+                    conn = psycopg2.connect(*self._args, async_=True, **self._kwargs)
+                    await wait(conn)
+                    return conn
+                except Exception as e:
+                    logger.error("failed to connect to database on attempt {}: {}".format(counter, e))
+                    raise
+
+
+class AsyncDatabaseClient:
+    def __init__(
+            self,
+            minconn=2,
+            maxconn=32,
+            retry=True,
+            timeout=30.0,
+            ping=liveness.PING_ALWAYS,
+            ping_idle=30.0,
+            row_type=ROW_DICT,
+            **kwargs,
+    ):
+        # what rows come back as unless a connection asks for something else.
+        # see ciptools.database.rows.
+        self._cursor_factory = cursor_factory(row_type)
+
+        # initialize the connection pool
+        self.pool = AsyncConnectionPool(
+            minconn=minconn,
+            maxconn=maxconn,
+            retry=retry,
+            timeout=timeout,
+            ping=ping,
+            ping_idle=ping_idle,
+            cursor_factory=self._cursor_factory,
+            **kwargs,
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        await self.pool.close()
+
+    @asynccontextmanager
+    async def conn(self, autocommit=True, timeout=None, row_type=None):
+        # the timeout is how long to wait for a connection if the pool is
+        # exhausted. if not given then the pool's default is used. the row
+        # type, if given, is only for this checkout.
+        factory = self._cursor_factory if row_type is None else cursor_factory(row_type)
+        conn = await self.pool.getconn(timeout=timeout)
+        conn.cursor_factory = factory
+        wrapper = AsyncConnection(conn)
+
+        try:
+            if not autocommit:
+                await wrapper.execute("BEGIN")
+            yield wrapper
+            if not autocommit:
+                await wrapper.execute("COMMIT")
+        except BaseException:
+            try:
+                if not conn.isexecuting() and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                    await wrapper.execute("ROLLBACK")
+            except psycopg2.Error as e:
+                logger.warning("could not rollback connection: {}".format(e))
+
+            raise
+        finally:
+            try:
+                await self.pool.putconn(conn)
+            except Exception as e:
+                logger.warning("could not put connection back into pool: {}".format(e))
+
+    def transaction(self, timeout=None, row_type=None):
+        return self.conn(autocommit=False, timeout=timeout, row_type=row_type)
@@ -0,0 +1,252 @@
+"""Batched Statements
+
+Every "execute" is a round trip to the server and when the server is far away
+the time spent waiting on the network is most of the time spent. A batch
+queues statements and sends them together, many statements per round trip,
+when the batch is flushed or finishes:
+
+    with db.batch() as batch:
+        batch.execute("UPDATE accounts SET seen_at = now() WHERE id = %s", (account_id,))
+        batch.execute_values("INSERT INTO tweets (id, text) VALUES %s", rows)
+        counts = batch.execute("SELECT count(*) FROM tweets WHERE account_id = %s", (account_id,), fetch=True)
+
+    print(counts.rows)
+
+Statements are formatted on the client with "mogrify" and joined into one
+query string. The server only sends back the results of the last statement in
+a query string so a statement that asks for its results with *fetch* is always
+the last one in its round trip. Results and row counts are only available for
+those statements and only once the batch has been flushed.
+
+Everything in a batch happens in a transaction. Each round trip starts with a
+savepoint so that when something fails the statements in it can be run again
+one at a time to find out which one failed. The BatchError that is raised says
+which statement it was.
+
+Statements that ask for results, or that fill up *max_bytes*, are sent before
+the batch finishes. If the block raises an exception, including a BatchError,
+the clients roll back everything that the batch sent so that a transaction
+the batch is part of can carry on as if the batch never happened. Otherwise
+the savepoints are released along with the last round trip so that batches in
+a long transaction don't pile up subtransactions.
+
+"""
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from psycopg2.sql import Composable
+
+# the savepoint that the whole batch starts with
+START = b"SAVEPOINT ciptools_batch_start"
+UNDO = b"ROLLBACK TO SAVEPOINT ciptools_batch_start"
+FINISH = b"RELEASE SAVEPOINT ciptools_batch_start"
+
+# the savepoint that each round trip starts with
+SAVEPOINT = b"SAVEPOINT ciptools_batch"
+RELEASE = b"RELEASE SAVEPOINT ciptools_batch"
+ROLLBACK = b"ROLLBACK TO SAVEPOINT ciptools_batch"
+
+
+def split_values(cur, query):
+    """Split a query on the "%s" where a VALUES list goes."""
+    if isinstance(query, Composable):
+        query = query.as_string(cur)
+    if not isinstance(query, bytes):
+        query = query.encode(psycopg2.extensions.encodings[cur.connection.encoding])
+    return psycopg2.extras._split_sql(query)
+
+
+def values_statement(cur, pre, post, template, page) -> bytes:
+    """Put a page of rows into a query split by "split_values".
+
+    This works the same way as psycopg2.extras.execute_values.
+    """
+    if template is None:
+        template = b"(" + b",".join([b"%s"] * len(page[0])) + b")"
+    parts = pre[:]
+    for args in page:
+        parts.append(cur.mogrify(template, args))
+        parts.append(b",")
+    parts[-1:] = post
+    return b"".join(parts)
+
+
+class BatchError(psycopg2.Error):
+    """A statement in a batch failed.
+
+    *index* is the position of the statement in the batch, counting from zero,
+    and *query* is the statement as it was sent. The error from the server is
+    the cause of this one.
+    """
+
+    def __init__(self, message, index, query):
+        super().__init__(message)
+        self.index = index
+        self.query = query
+
+
+class BatchResult:
+    """What came back from a statement in a batch once it was sent.
+
+    *rows* is None unless the results were asked for. *rowcount* is -1 unless
+    the results were asked for.
+    """
+
+    __slots__ = ("rows", "rowcount", "done")
+
+    def __init__(self, fetch):
+        self.rows = [] if fetch else None
+        self.rowcount = -1 if not fetch else 0
+        self.done = False
+
+
+class _Statement:
+    __slots__ = ("index", "query", "result")
+
+    def __init__(self, index, query, result):
+        self.index = index
+        self.query = query
+        self.result = result
+
+
+class Batch:
+    def __init__(self, conn, max_bytes: int = 1048576):
+        """Queue statements to send on *conn*, which must be in a transaction.
+
+        Queued statements are sent whenever they add up to more than
+        *max_bytes* and when "flush" is called.
+        """
+        self.conn = conn
+        self.max_bytes = max_bytes
+        self.count = 0
+        self.round_trips = 0
+
+        self._cursor = conn.cursor()
+        self._queue = []
+        self._size = 0
+        self._savepoint = False
+
+    def execute(self, query, params=None, fetch: bool = False) -> BatchResult:
+        """Queue one statement. Its results are kept if *fetch* is set."""
+        result = BatchResult(fetch)
+        self._add(self._cursor.mogrify(query, params), result, fetch)
+        return result
+
+    def execute_values(self, query, argslist, template=None, page_size: int = 100, fetch: bool = False) -> BatchResult:
+        """Queue a statement with a VALUES list, like psycopg2.extras.execute_values.
+
+        The rows in *argslist* are split into statements of *page_size* rows.
+        If *fetch* is set then the results of every page are kept together,
+        but then each page is its own round trip.
+        """
+        pre, post = split_values(self._cursor, query)
+
+        result = BatchResult(fetch)
+        page = []
+        for args in argslist:
+            page.append(args)
+            if len(page) >= page_size:
+                self._add_page(pre, post, template, page, result, fetch)
+                page = []
+        if page:
+            self._add_page(pre, post, template, page, result, fetch)
+
+        return result
+
+    def flush(self):
+        """Send everything that is queued."""
+        while self._queue:
+            self._send()
+
+    def finish(self):
+        """Send everything that is queued and let go of the batch's savepoints.
+
+        Releasing the savepoint the batch started with releases the ones for
+        each round trip too. After this the batch can't be rolled back.
+        """
+        if self._queue:
+            self._send(finish=True)
+        elif self._savepoint:
+            self._release()
+
+    def rollback(self):
+        """Undo everything that was sent and forget what is still queued.
+
+        This does nothing once the batch has finished.
+        """
+        self._queue, self._size = [], 0
+        if self._savepoint:
+            self._cursor.execute(UNDO)
+
+    def _add_page(self, pre, post, template, page, result, fetch):
+        self._add(values_statement(self._cursor, pre, post, template, page), result, fetch)
+
+    def _add(self, query, result, fetch):
+        self._queue.append(_Statement(self.count, query, result))
+        self._size += len(query)
+        self.count += 1
+
+        # the server only sends back the results of the last statement
+        if fetch or self._size >= self.max_bytes:
+            self._send()
+
+    def _send(self, finish=False):
+        statements, self._queue, self._size = self._queue, [], 0
+
+        # let go of the savepoint from the last round trip and start a new
+        # one. the first round trip also marks where the batch started.
+        parts = [RELEASE, SAVEPOINT] if self._savepoint else [START, SAVEPOINT]
+        parts.extend(statement.query for statement in statements)
+        self._savepoint = True
+
+        # the last round trip lets go of the savepoints too unless that would
+        # take the place of results that were asked for
+        released = finish and statements[-1].result.rows is None
+        if released:
+            parts.append(FINISH)
+
+        self.round_trips += 1
+        try:
+            self._cursor.execute(b";\n".join(parts))
+        except psycopg2.Error as e:
+            self._replay(statements, e)
+            released = False
+        else:
+            self._finish(statements[-1])
+
+        if released:
+            self._savepoint = False
+        elif finish:
+            self._release()
+
+        for statement in statements:
+            statement.result.done = True
+
+    def _release(self):
+        self.round_trips += 1
+        self._cursor.execute(FINISH)
+        self._savepoint = False
+
+    def _replay(self, statements, error):
+        # go back to before this round trip and run each statement by itself
+        # to find out which one failed
+        try:
+            self._cursor.execute(ROLLBACK)
+        except psycopg2.Error:
+            raise error
+
+        for statement in statements:
+            self.round_trips += 1
+            try:
+                self._cursor.execute(statement.query)
+            except psycopg2.Error as e:
+                raise BatchError("statement {} in batch failed: {}".format(statement.index, e), statement.index, statement.query) from e
+            self._finish(statement)
+
+    def _finish(self, statement):
+        result = statement.result
+        if result.rows is not None:
+            if self._cursor.description is not None:
+                result.rows.extend(self._cursor.fetchall())
+            result.rowcount += self._cursor.rowcount
@@ -0,0 +1,107 @@
+"""Connection Circuit Breakers
+
+When the database goes away every thread that needs a connection starts
+trying to make one, over and over, which only makes things worse for the
+server when it comes back. A circuit breaker keeps track of failed attempts to
+connect to each database. Once *failures* attempts in a row have failed it
+"opens" and attempts fail right away with CircuitOpenError without going near
+the server. After *reset_timeout* seconds a single attempt is let through to
+see if the database is back. If it works then the breaker "closes" again and
+everyone can connect. If it doesn't then the breaker stays open for another
+*reset_timeout* seconds.
+
+The legacy ciptools.database.conn function uses one breaker for each database
+it connects to, keyed by host, database, user and sslmode and shared by every
+thread in the process:
+
+    breaker = ciptools.database.breaker.get(("mars.lab.cip.uw.edu", "election2020", "user", "require"))
+    print(breaker.state)
+
+"""
+
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(psycopg2.OperationalError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failures: int = 5, reset_timeout: float = 10.0):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+
+        self.state = CLOSED
+        self.failed = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def before(self):
+        """Call before trying to connect. Raises CircuitOpenError if we shouldn't."""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+
+            # let one attempt through once we've waited long enough. everyone
+            # else keeps failing until we hear how it went, or until another
+            # timeout goes by in case we never hear.
+            now = time.monotonic()
+            if now - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self.opened_at = now
+                return
+
+        raise CircuitOpenError("database is unavailable after {} failed connection attempts".format(self.failed))
+
+    def success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info("database is available again")
+            self.state = CLOSED
+            self.failed = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failed += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failed >= self.failures):
+                if self.state == CLOSED:
+                    logger.warning("database is unavailable, failing connection attempts for {} seconds".format(self.reset_timeout))
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+
+# the breakers for each database, shared by every thread
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def _reset_breakers():
+    # the breakers' locks might have been held when we forked and the child
+    # should find out for itself whether the database is there
+    global _breakers_lock
+    _breakers_lock = threading.Lock()
+    _breakers.clear()
+
+
+os.register_at_fork(after_in_child=_reset_breakers)
+
+
+def get(key, failures: int = 5, reset_timeout: float = 10.0) -> CircuitBreaker:
+    """Return the breaker for *key*, making it if it doesn't exist yet."""
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = _breakers[key] = CircuitBreaker(failures, reset_timeout)
+        return breaker
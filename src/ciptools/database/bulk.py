@@ -0,0 +1,366 @@
+"""Bulk Loading
+
+Loading rows with COPY is much faster than inserting them. This streams any
+iterable of rows through COPY without holding the whole thing in memory:
+
+    from ciptools.database.bulk import copy_rows
+
+    with db.conn() as conn:
+        result = copy_rows(conn, "public.tweets", ["id", "text"], rows)
+        print("loaded {} rows at {:.0f} rows/s".format(result.rows, result.rows_per_second))
+
+The clients have a "copy_rows" method that does the same thing after getting a
+connection for you. Inside a transaction it uses the transaction's connection
+so the rows are loaded as part of the transaction. See ciptools.strings.copy_escape for how values are
+formatted. If the types of the columns are given then rows are sent in the
+binary format instead, which is faster still. See ciptools.pgcopy for that.
+
+When COPY won't do, like for upserts, "insert_many" and "execute_many" send
+rows as VALUES lists a page at a time. The number of rows in each page changes
+as it goes so that each statement takes about *target_seconds* and isn't much
+bigger than *max_bytes*, so nobody has to pick a page size:
+
+    result = insert_many(
+        conn, "public.tweets", ["id", "text"], rows,
+        on_conflict="ON CONFLICT (id) DO UPDATE SET text = excluded.text",
+        returning=["id"],
+    )
+    print("upserted {} rows in {} pages".format(result.rows, result.pages))
+
+For really big upserts "bulk_upsert" loads the rows into a temporary table
+with COPY and then merges them into the table with one INSERT ... SELECT ...
+ON CONFLICT DO UPDATE for every *chunk_size* rows:
+
+    result = bulk_upsert(conn, "public.tweets", ["id"], rows, columns=["id", "text"])
+    print("inserted {} and updated {} rows".format(result.inserted, result.updated))
+
+psycopg2 can't COPY while a wait callback is installed, which is what
+ciptools.monkey does so that queries yield to the eventlet or gevent hub. In a
+patched process "copy_rows" and "bulk_upsert" raise NotSupportedError instead.
+Use "insert_many" there, or "parallel_copy", whose worker processes take the
+callback off before they copy.
+
+"""
+
+import itertools
+import logging
+import time
+import uuid
+from typing import Iterable, List, NamedTuple, Sequence
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2 import sql
+from psycopg2.extensions import cursor as TupleCursor
+
+from ciptools.database.batch import split_values, values_statement
+from ciptools.pgcopy import BinaryCopyIO
+from ciptools.strings import StringIteratorIO, copy_line
+
+logger = logging.getLogger(__name__)
+
+
+class CopyResult(NamedTuple):
+    rows: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+class ExecuteResult(NamedTuple):
+    rows: int
+    seconds: float
+    pages: int
+    # what came back from RETURNING, if it was asked for
+    returned: List = None
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+class PageSize:
+    """Picks how many rows to put in the next page.
+
+    After each page the time it took and its size are used to work out how
+    many rows would take *target_seconds* without going over *max_bytes*. The
+    page size moves towards that but never more than doubles or halves at once
+    so one slow statement doesn't throw it off.
+    """
+
+    def __init__(
+            self,
+            initial: int = 100,
+            minimum: int = 10,
+            maximum: int = 50000,
+            target_seconds: float = 0.25,
+            max_bytes: int = 8388608,
+    ):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+
+    def update(self, rows: int, seconds: float, size: int) -> int:
+        if rows:
+            wanted = self.maximum
+            if seconds > 0:
+                wanted = min(wanted, self.target_seconds * rows / seconds)
+            if size > 0:
+                wanted = min(wanted, self.max_bytes * rows / size)
+            wanted = max(self.size / 2, min(self.size * 2, wanted))
+            self.size = int(max(self.minimum, min(self.maximum, wanted)))
+        return self.size
+
+
+class UpsertResult(NamedTuple):
+    rows: int
+    inserted: int
+    updated: int
+    chunks: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def table_identifier(table: str) -> sql.Identifier:
+    # accept "schema.table" as well as just "table"
+    return sql.Identifier(*table.split("."))
+
+
+def check_copy():
+    """Raise NotSupportedError if psycopg2 can't COPY in this process."""
+    if psycopg2.extensions.get_wait_callback() is not None:
+        raise psycopg2.NotSupportedError(
+            "COPY can't be used while a psycopg2 wait callback is installed, like the one for eventlet or gevent. "
+            "use insert_many or parallel_copy instead"
+        )
+
+
+def copy_rows(
+        conn,
+        table: str,
+        columns: Sequence[str],
+        rows: Iterable[Sequence],
+        flush_size: int = 65536,
+        replace_nulls: bool = True,
+        types: Sequence[str] = None,
+) -> CopyResult:
+    """Load rows into a table with COPY.
+
+    Rows are formatted and sent in chunks of about *flush_size* characters so
+    memory use does not depend on how many rows there are. If *columns* is
+    None then each row must have a value for every column in the table, in
+    order. If *types* is given, one for each column, then the rows are sent
+    in binary format and *replace_nulls* is ignored.
+    """
+    check_copy()
+    query = sql.SQL("COPY {} {} FROM STDIN {}").format(
+        table_identifier(table),
+        sql.SQL("({})").format(sql.SQL(", ").join(map(sql.Identifier, columns))) if columns else sql.SQL(""),
+        sql.SQL("WITH (FORMAT binary)") if types else sql.SQL(""),
+    )
+
+    if types:
+        started = time.monotonic()
+        data = BinaryCopyIO(types, rows, flush_size=flush_size)
+        with conn.cursor() as cur:
+            cur.copy_expert(query, data, size=flush_size)
+        return _finished(table, CopyResult(data.count, time.monotonic() - started))
+
+    counter = [0]
+
+    def chunks():
+        lines = []
+        size = 0
+        for row in rows:
+            line = copy_line(row, replace_nulls)
+            lines.append(line)
+            size += len(line)
+            counter[0] += 1
+            if size >= flush_size:
+                yield "".join(lines)
+                lines = []
+                size = 0
+        if lines:
+            yield "".join(lines)
+
+    started = time.monotonic()
+    with conn.cursor() as cur:
+        cur.copy_expert(query, StringIteratorIO(chunks()), size=flush_size)
+    return _finished(table, CopyResult(counter[0], time.monotonic() - started))
+
+
+def execute_many(conn, query, rows: Iterable[Sequence], template=None, fetch: bool = False, page_size: PageSize = None) -> ExecuteResult:
+    """Run a query with a single "%s" for a VALUES list over every row.
+
+    This is like psycopg2.extras.execute_values except that *rows* can be any
+    iterable and the page size adapts as it goes. If *fetch* is set then what
+    each page returns is collected in the result.
+    """
+    if page_size is None:
+        page_size = PageSize()
+
+    returned = [] if fetch else None
+    count = 0
+    pages = 0
+    rows = iter(rows)
+
+    started = time.monotonic()
+    with conn.cursor() as cur:
+        pre, post = split_values(cur, query)
+        while True:
+            page = list(itertools.islice(rows, page_size.size))
+            if not page:
+                break
+
+            statement = values_statement(cur, pre, post, template, page)
+            page_started = time.perf_counter()
+            cur.execute(statement)
+            if fetch:
+                returned.extend(cur.fetchall())
+            page_size.update(len(page), time.perf_counter() - page_started, len(statement))
+
+            count += len(page)
+            pages += 1
+
+    result = ExecuteResult(count, time.monotonic() - started, pages, returned)
+    logger.info("executed {} rows in {} pages in {:.2f}s ({:.0f} rows/s)".format(
+        result.rows, result.pages, result.seconds, result.rows_per_second,
+    ))
+    return result
+
+
+def insert_many(
+        conn,
+        table: str,
+        columns: Sequence[str],
+        rows: Iterable[Sequence],
+        on_conflict: str = None,
+        returning: Sequence[str] = None,
+        page_size: PageSize = None,
+) -> ExecuteResult:
+    """Insert rows into a table a page at a time.
+
+    *on_conflict* is added to the end of the INSERT as it is, for example
+    "ON CONFLICT (id) DO NOTHING". The values of the *returning* columns for
+    every row that was inserted or updated are collected in the result.
+    """
+    query = sql.SQL("INSERT INTO {} ({}) VALUES %s {} {}").format(
+        table_identifier(table),
+        sql.SQL(", ").join(map(sql.Identifier, columns)),
+        sql.SQL(on_conflict) if on_conflict else sql.SQL(""),
+        sql.SQL("RETURNING {}").format(sql.SQL(", ").join(map(sql.Identifier, returning))) if returning else sql.SQL(""),
+    )
+    return execute_many(conn, query, rows, fetch=bool(returning), page_size=page_size)
+
+
+def bulk_upsert(
+        conn,
+        table: str,
+        key_columns: Sequence[str],
+        rows: Iterable[Sequence],
+        columns: Sequence[str] = None,
+        update_columns: Sequence[str] = None,
+        chunk_size: int = 100000,
+        types: Sequence[str] = None,
+) -> UpsertResult:
+    """Insert or update lots of rows with COPY and a few set based statements.
+
+    The connection must be in a transaction. The rows are copied into a
+    temporary table and then merged into *table* *chunk_size* rows at a time.
+    *key_columns* must have a unique index on them. Rows with keys that are
+    already in the table update *update_columns*, which is every column that
+    isn't a key unless given. If there are no columns to update then those
+    rows are left alone and aren't counted as updated. If *columns* is None
+    then each row must have a value for every column in the table, in order.
+    *types* works the same way as it does for "copy_rows".
+
+    When a key shows up more than once the last row with it wins. A key that
+    shows up in more than one chunk is merged once for each chunk.
+    """
+    check_copy()
+    started = time.monotonic()
+    target = table_identifier(table)
+    staging = "ciptools_upsert_{}".format(uuid.uuid4().hex)
+
+    # the counts are read by position so don't use whatever row type the
+    # connection has
+    with conn.cursor(cursor_factory=TupleCursor) as cur:
+        if columns is None:
+            cur.execute(sql.SQL("SELECT * FROM {} LIMIT 0").format(target))
+            columns = [column.name for column in cur.description]
+
+        if update_columns is None:
+            update_columns = [column for column in columns if column not in key_columns]
+
+        # the staging table gets the same types as the target table plus a
+        # row number that says which rows came last
+        cur.execute(sql.SQL(
+            "CREATE TEMPORARY TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA"
+        ).format(sql.Identifier(staging), sql.SQL(", ").join(map(sql.Identifier, columns)), target))
+        cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN ciptools_row bigserial").format(sql.Identifier(staging)))
+
+    loaded = copy_rows(conn, staging, columns, rows, types=types)
+
+    # each chunk picks its rows out by row number. without an index every
+    # chunk would scan all of the staged rows and without statistics the
+    # planner has no idea how many rows there are.
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("ALTER TABLE {} ADD PRIMARY KEY (ciptools_row)").format(sql.Identifier(staging)))
+        cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(staging)))
+
+    names = sql.SQL(", ").join(map(sql.Identifier, columns))
+    keys = sql.SQL(", ").join(map(sql.Identifier, key_columns))
+    if update_columns:
+        action = sql.SQL("DO UPDATE SET {}").format(sql.SQL(", ").join(
+            sql.SQL("{0} = excluded.{0}").format(sql.Identifier(column)) for column in update_columns
+        ))
+    else:
+        action = sql.SQL("DO NOTHING")
+
+    # rows that were just inserted have no xmax. rows that were updated have
+    # the id of this transaction in xmax. rows left alone aren't returned.
+    merge = sql.SQL("""
+        WITH merged AS (
+            INSERT INTO {target} ({names})
+            SELECT DISTINCT ON ({keys}) {names} FROM {staging}
+            WHERE ciptools_row > %s AND ciptools_row <= %s
+            ORDER BY {keys}, ciptools_row DESC
+            ON CONFLICT ({keys}) {action}
+            RETURNING xmax = 0 AS inserted
+        )
+        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM merged
+    """).format(target=target, names=names, keys=keys, staging=sql.Identifier(staging), action=action)
+
+    inserted = 0
+    updated = 0
+    chunks = 0
+    with conn.cursor(cursor_factory=TupleCursor) as cur:
+        for start in range(0, loaded.rows, chunk_size):
+            cur.execute(merge, (start, start + chunk_size))
+            chunk_inserted, chunk_updated = cur.fetchone()
+            inserted += chunk_inserted
+            updated += chunk_updated
+            chunks += 1
+
+        # don't wait for the end of the transaction to get rid of it
+        cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(staging)))
+
+    result = UpsertResult(loaded.rows, inserted, updated, chunks, time.monotonic() - started)
+    logger.info("upserted {} rows into {} in {:.2f}s, {} inserted and {} updated ({:.0f} rows/s)".format(
+        result.rows, table, result.seconds, result.inserted, result.updated, result.rows_per_second,
+    ))
+    return result
+
+
+def _finished(table, result):
+    logger.info("copied {} rows into {} in {:.2f}s ({:.0f} rows/s)".format(
+        result.rows, table, result.seconds, result.rows_per_second,
+    ))
+    return result
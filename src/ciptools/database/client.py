@@ -32,15 +32,18 @@ Example:
 
 
 It is worth noting that psycopg2 loads the entire result set into memory. If
-that is not desirable then one can name the cursor and it will be loaded into
-memory one row at a time. See this resource for more information:
+that is not desirable then use "stream", which uses a server-side cursor to
+load rows from the server a few at a time. See this resource for more
+information:
 * http://initd.org/psycopg/docs/usage.html#server-side-cursors
 
-    cur = conn.cursor(name="something_unique")
-    cur.execute("SELECT foo FROM bar")
-    for row in cur:
-        print "found {}".format(row["foo"])
-    cur.close()
+    for row in db.stream("SELECT foo FROM bar", itersize=10000):
+        print("found {}".format(row["foo"]))
+
+For large reads where only a few columns are wanted, "fetch_columns" returns
+the results as a dict of arrays instead of rows, which uses much less memory:
+
+    columns = db.fetch_columns("SELECT id, score FROM bar")
 
 
 For more examples of how to use databases in Python, this is a great resource:
@@ -49,12 +52,16 @@ For more examples of how to use databases in Python, this is a great resource:
 """
 import contextlib
 import logging
+import time
 from threading import Event
 
 import psycopg2
 import tenacity
 
 import ciptools.database
+from ciptools.database import (batch, bulk, columnar, instrument, liveness,
+                               streaming, transactions)
+from ciptools.database.rows import ROW_DICT, cursor_factory
 
 logger = logging.getLogger(__name__)
 
@@ -69,6 +76,13 @@ class DatabaseClient:
             sslmode: str = "prefer",
             client_id: str = "default",
             retry: bool = True,
+            ping: str = liveness.PING_IDLE,
+            ping_idle: float = 30.0,
+            row_type: str = ROW_DICT,
+            retry_deadline: float = None,
+            retry_max_wait: float = 30.0,
+            circuit_breaker: bool = True,
+            instrument: bool = False,
     ):
         """Creates a database client object.
 
@@ -91,8 +105,32 @@ class DatabaseClient:
                 client_id="bar",
             )
 
-        Aside from *client_id* and *retry*, all arguments are passed directly
-        to the underlying connection library.
+        The *ping* argument controls how connections are checked before they
+        are reused. By default only what psycopg2 knows about the connection
+        is looked at unless the connection has not been used for *ping_idle*
+        seconds, in which case a "SELECT 1" is sent. Set it to "always" to
+        send it every time or to "never" to never send it. See
+        ciptools.database.liveness for details.
+
+        When *retry* is set, failed attempts to connect are tried again after
+        a random wait that grows exponentially up to *retry_max_wait* seconds,
+        for up to *retry_deadline* seconds or forever if that isn't given.
+        When a database keeps failing, attempts to connect to it fail right
+        away for a while, unless *circuit_breaker* is turned off. See
+        ciptools.database.breaker for details.
+
+        The *row_type* argument picks what rows are returned as. It may be
+        "dict", "tuple", "namedtuple", "realdict" or a cursor class and may be
+        changed for a single connection by passing it to "conn" or for a
+        single query by passing it to "stream". See ciptools.database.rows.
+
+        When *instrument* is set every query is timed and grouped by its
+        fingerprint and slow queries are logged. Connections are shared across
+        the process so the numbers are in ciptools.database.instrument.statistics
+        and "query_stats" returns them. See ciptools.database.instrument.
+
+        Aside from *client_id* and the arguments above, all arguments are
+        passed directly to the underlying connection library.
         """
 
         self.dsn = {
@@ -107,20 +145,54 @@ class DatabaseClient:
         # this will store a persistent connection so we can ensure that we are
         # giving the user the same connection every time
         self.persistent = None
+        self.persistent_used = None
+
+        # how to check connections before reusing them
+        self.ping = liveness.validate_policy(ping)
+        self.ping_idle = ping_idle
 
-        # if the user told us not to retry then prevent retrying
+        # if the user told us not to retry then prevent retrying. otherwise
+        # back off more and more, optionally giving up after a while.
         self.retry = retry
+        self.retry_deadline = retry_deadline
+        self.retry_max_wait = retry_max_wait
+        self.circuit_breaker = circuit_breaker
+
+        # time queries and log slow ones
+        self.instrument = instrument
+
+        # what rows come back as. check it now rather than on first use.
+        cursor_factory(row_type)
+        self.row_type = row_type
 
-    def conn(self, retry=None):
+    def conn(self, retry=None, row_type=None):
         """Get a database connection.
 
         If it does not matter to you whether you get the same handle with each
         invocation you can use this method. If no current database connection
         exists or the database went away then this method will try to connect
-        to the database.
+        to the database. The connection is shared so a *row_type* given here
+        lasts until the next call to "conn", except that a connection in a
+        transaction keeps the row type that the transaction started with.
         """
+        if row_type is None:
+            row_type = self.row_type
 
-        # if set then we will not retry connections
+        # make a copy so that we don't modify the original data structure
+        dsn = self.dsn.copy()
+
+        return self._retrying(retry, lambda: ciptools.database.conn(
+            **dsn,
+            ping=self.ping,
+            ping_idle=self.ping_idle,
+            row_type=row_type,
+            circuit_breaker=self.circuit_breaker,
+            instrument=self.instrument,
+        ))
+
+    def _retrying(self, retry, connect):
+        # call connect until it works, backing off between attempts, unless
+        # retrying is turned off. if set then we will not retry connections.
         retry_flag = Event()
 
         # control retries. give the user a second chance to stop retries.
@@ -129,23 +201,32 @@ class DatabaseClient:
         else:
             retry_flag.set()
 
-        # make a copy so that we don't modify the original data structure
-        dsn = self.dsn.copy()
+        stop = tenacity.stop_when_event_set(retry_flag)
+        if self.retry_deadline is not None:
+            stop = stop | tenacity.stop_after_delay(self.retry_deadline)
 
         counter = 0
         for attempt in tenacity.Retrying(
                 reraise=True,
-                stop=tenacity.stop_when_event_set(retry_flag),
-                wait=tenacity.wait_fixed(0.1) + tenacity.wait_random(0, 0.9),
+                stop=stop,
+                wait=tenacity.wait_random_exponential(multiplier=0.1, max=self.retry_max_wait),
         ):
             with attempt:
                 counter = counter + 1
                 try:
-                    return ciptools.database.conn(**dsn)
+                    return connect()
                 except Exception as e:
                     logger.error("failed to connect to database on attempt {}: {}".format(counter, e))
                     raise
 
+    def query_stats(self):
+        """Return how long queries have taken, by fingerprint.
+
+        This is only filled in when *instrument* is set. It covers every
+        instrumented connection in the process.
+        """
+        return instrument.statistics.snapshot()
+
     def persistent_conn(self):
         """Get a persistent database connection.
 
@@ -155,34 +236,40 @@ class DatabaseClient:
         methods. But if there had been a connection and it went away then this
         method will throw an exception.
         """
+        now = time.monotonic()
         if self.persistent is not None:
             # we have a handle, make sure it is live. if it is not live then
             # clean it and die.
-            try:
-                with self.persistent.cursor() as cur:
-                    cur.execute("SELECT 1")
-            except Exception:
+            if not liveness.check(self.persistent, self.ping, now - self.persistent_used, self.ping_idle):
                 self.persistent = None
-                raise
+                raise psycopg2.InterfaceError("persistent connection is no longer usable")
         else:
             # we don't have a handle already so create one. this handle will be
             # returned every time persistent_conn is called.
             self.persistent = self.conn()
 
+        self.persistent_used = now
         return self.persistent
 
     @contextlib.contextmanager
-    def transaction(self):
+    def transaction(self, row_type=None):
         """Get a connection in a transaction.
 
         This will return a connection that is in a transaction. You should use
         it as a context wrapper. When the context wrapper finishes then the
         transaction will commit. If anything in your context wrapper throws an
         exception then the transaction will be rolled back.
+
+        Inside of another transaction this uses a savepoint in the transaction
+        that is already going instead. See ciptools.database.transactions.
         """
-        conn = None
+        conn = self.conn(row_type=row_type)
+        if not conn.autocommit:
+            with transactions.savepoint(conn):
+                yield conn
+            return
+
         try:
-            conn = self.conn()
             conn.autocommit = False
             yield conn
             conn.commit()
@@ -200,3 +287,105 @@ class DatabaseClient:
                     conn.autocommit = True
             except (AttributeError, psycopg2.Error) as e:
                 logger.warning("could not reset autocommit on connection: {}".format(e))
+
+    def copy_rows(self, table, columns, rows, flush_size=65536, replace_nulls=True, types=None):
+        """Load rows into a table with COPY.
+
+        This streams any iterable of rows into the table without holding all
+        of them in memory and returns a ciptools.database.bulk.CopyResult with
+        the number of rows loaded and how fast it went. Inside a transaction
+        the rows are loaded as part of the transaction. psycopg2 can't COPY in
+        a process patched for eventlet or gevent so this raises
+        NotSupportedError there.
+        """
+        return bulk.copy_rows(self.conn(), table, columns, rows, flush_size=flush_size, replace_nulls=replace_nulls, types=types)
+
+    @contextlib.contextmanager
+    def batch(self, max_bytes=1048576):
+        """Queue statements and send them in as few round trips as possible.
+
+        This returns a ciptools.database.batch.Batch that should be used as a
+        context wrapper. Everything that was queued is sent when the context
+        wrapper finishes. Inside a transaction the statements are part of the
+        transaction and if anything fails then whatever the batch already sent
+        is rolled back. Otherwise they get a transaction of their own that is
+        committed at the end or rolled back if anything fails.
+        """
+        conn = self.conn()
+        context = self.transaction() if conn.autocommit else contextlib.nullcontext(conn)
+        with context as conn:
+            queue = batch.Batch(conn, max_bytes=max_bytes)
+            try:
+                yield queue
+                queue.finish()
+            except BaseException:
+                try:
+                    queue.rollback()
+                except psycopg2.Error as e:
+                    logger.warning("could not rollback batch: {}".format(e))
+                raise
+
+    def stream(self, query, params=None, itersize=2000, batches=False, row_type=None):
+        """Yield rows from a query without loading them all into memory.
+
+        Rows are fetched from a server-side cursor *itersize* rows at a time.
+        If *batches* is set then lists of up to *itersize* rows are yielded
+        instead of one row at a time. Inside a transaction the cursor is part
+        of the transaction. Otherwise a separate connection is made for the
+        cursor and it is closed when the iterator is exhausted or closed.
+        """
+        factory = None if row_type is None else cursor_factory(row_type)
+        if factory is not None and self.instrument:
+            factory = instrument.cursor_class(factory)
+        with self._cursor_transaction() as conn:
+            yield from streaming.stream(conn, query, params, itersize=itersize, batches=batches, cursor_factory=factory)
+
+    def fetch_columns(self, query, params=None, batch_size=10000, numpy=False):
+        """Run a query and return its results as a dict of columns.
+
+        Numeric columns are packed into arrays and everything else is a list.
+        No row objects are made so this is much cheaper than fetching rows
+        for large reads. See ciptools.database.columnar for the details.
+        """
+        with self._cursor_transaction() as conn:
+            return columnar.fetch(conn, query, params, batch_size=batch_size, numpy=numpy)
+
+    def _current_transaction(self):
+        # this thread's connection from the registry if it is in a
+        # transaction. this only looks, it doesn't connect or check anything.
+        key = tuple(self.dsn[name] for name in ("host", "database", "user", "password", "sslmode", "client_id"))
+        conn = ciptools.database.connections.get(ciptools.database.get_connection_id(), {}).get(key)
+        if conn is not None and not conn.closed and not conn.autocommit:
+            return conn
+        return None
+
+    @contextlib.contextmanager
+    def _cursor_transaction(self):
+        conn = self._current_transaction()
+        if conn is not None:
+            # we're inside of a transaction so use it
+            yield conn
+            return
+
+        # server-side cursors need a transaction. this gets its own connection
+        # so that the transaction doesn't get mixed up with anything else this
+        # thread does while the cursor is open. it is retried and goes through
+        # the circuit breaker just like "conn".
+        dsn = self.dsn.copy()
+        del dsn["client_id"]
+        factory = cursor_factory(self.row_type)
+        if self.instrument:
+            factory = instrument.cursor_class(factory)
+        conn = self._retrying(None, lambda: ciptools.database.connect(
+            **dsn, row_type=factory, circuit_breaker=self.circuit_breaker,
+        ))
+        if self.instrument:
+            instrument.attach(conn)
+        try:
+            conn.autocommit = False
+            yield conn
+        finally:
+            try:
+                conn.close()
+            except psycopg2.Error as e:
+                logger.warning("could not close cursor connection: {}".format(e))
@@ -0,0 +1,111 @@
+"""Columnar Query Results
+
+Every connection that ciptools makes hands back rows as DictRow objects, which
+is handy but expensive when there are millions of rows and all you want to do
+is aggregate them. This fetches a query's results as columns instead. Numeric
+columns are packed into an array.array, or a NumPy array if asked for, and
+everything else goes into a list:
+
+    columns = db.fetch_columns("SELECT id, retweets, text FROM tweets")
+    print(sum(columns["retweets"]) / len(columns["retweets"]))
+
+    # or with numpy, if it is installed
+    columns = db.fetch_columns("SELECT id, score FROM tweets", numpy=True)
+    print(columns["score"].mean())
+
+Rows are read from a server-side cursor *batch_size* rows at a time with a
+plain tuple cursor, so no DictRow is ever made and the tuples psycopg2 makes
+for each batch are thrown away as soon as the batch has been copied into the
+columns. A numeric column that turns out to have a NULL in it can't be packed
+so it becomes a list of numbers and Nones.
+
+"""
+
+import array
+from typing import Dict
+
+from psycopg2.extensions import cursor as TupleCursor
+
+from ciptools.database import streaming
+
+# object ids of the types that can be packed and the array.array typecode to
+# pack them with. numpy understands the same typecodes.
+TYPECODES = {
+    16: "b",  # bool
+    20: "q",  # int8
+    21: "h",  # int2
+    23: "i",  # int4
+    26: "I",  # oid
+    700: "f",  # float4
+    701: "d",  # float8
+}
+
+BOOL_OID = 16
+
+
+def fetch(conn, query, params=None, batch_size: int = 10000, numpy: bool = False) -> Dict[str, object]:
+    """Run a query and return its results as a dict of columns.
+
+    The connection must already be in a transaction. The dict is in the same
+    order as the columns in the query.
+    """
+    with streaming.named_cursor(conn, batch_size, cursor_factory=TupleCursor) as cur:
+        cur.execute(query, params)
+        return fill(cur, batch_size, numpy=numpy)
+
+
+def fill(cur, batch_size: int = 10000, numpy: bool = False) -> Dict[str, object]:
+    """Read every remaining row from a cursor that has run a query into columns."""
+    # a server-side cursor only sends a DECLARE when the query is executed so
+    # psycopg2 doesn't know what the columns are until the first FETCH.
+    rows = cur.fetchmany(batch_size)
+    description = cur.description
+    names = [column.name for column in description]
+    if len(set(names)) != len(names):
+        raise ValueError("column names must be unique to fetch columns: {}".format(", ".join(names)))
+
+    columns = [
+        array.array(TYPECODES[column.type_code]) if column.type_code in TYPECODES else []
+        for column in description
+    ]
+
+    while rows:
+        for i, values in enumerate(zip(*rows)):
+            column = columns[i]
+            if type(column) is list:
+                column.extend(values)
+                continue
+
+            size = len(column)
+            try:
+                column.extend(values)
+            except TypeError:
+                # there was a null. the values before it have already been
+                # added so take them out again and switch to a list.
+                del column[size:]
+                columns[i] = column = column.tolist()
+                column.extend(values)
+
+        rows = cur.fetchmany(batch_size)
+
+    if numpy:
+        columns = _to_numpy(description, columns)
+
+    return dict(zip(names, columns))
+
+
+def _to_numpy(description, columns):
+    try:
+        import numpy as np
+    except ImportError:
+        raise ImportError("numpy must be installed to fetch columns as numpy arrays") from None
+
+    results = []
+    for column, values in zip(description, columns):
+        if isinstance(values, array.array):
+            # this shares memory with the array rather than copying it
+            values = np.frombuffer(values, dtype=values.typecode)
+            if column.type_code == BOOL_OID:
+                values = values.view(np.bool_)
+        results.append(values)
+    return results
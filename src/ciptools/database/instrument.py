@@ -0,0 +1,231 @@
+"""Query Statistics and the Slow Query Log
+
+The pool statistics say how long threads waited for connections but not which
+queries were slow. With instrumentation turned on every "execute",
+"executemany" and "copy_expert" is timed and recorded under its fingerprint,
+which is the query with the literals and parameters taken out, so that the
+same query with different values is counted together:
+
+    db = DatabaseClient(host="mars.lab.cip.uw.edu", instrument=True, slow_query=0.5)
+    ...
+    for fingerprint, statement in db.query_stats().items():
+        print(fingerprint, statement["count"], statement["latency"]["p99"])
+
+    # "SELECT text FROM tweets WHERE id = %s" and friends become
+    # "SELECT text FROM tweets WHERE id = ?"
+
+The legacy ciptools.database.conn function and the DatabaseClient in
+ciptools.database.client take *instrument* too. Those connections are shared
+by everyone in the process so they record into one set of statistics, which
+is ciptools.database.instrument.statistics.
+
+Each fingerprint has a count, the number of rows and errors and a latency
+histogram like the ones in ciptools.database.stats. The histograms are
+rolling: they cover the last one or two *window* seconds, while the counts
+go back to the start. Queries that take longer than *slow_query* seconds are
+logged with their fingerprint and the types of their parameters, but never
+the parameters themselves.
+
+Timing a query costs a couple of clock reads and a dictionary lookup, and
+fingerprints are cached, so it's fine to leave this on.
+
+"""
+
+import functools
+import logging
+import re
+import threading
+import time
+import weakref
+from collections.abc import Mapping
+
+from psycopg2.sql import Composable
+
+from ciptools.database.stats import Histogram
+
+logger = logging.getLogger(__name__)
+
+# how a query is boiled down to its fingerprint, in order
+NORMALIZE = [
+    (re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL), " "),
+    (re.compile(r"(?:E|e)?'(?:[^']|'')*'"), "?"),
+    (re.compile(r"%(?:\(\w+\))?s|\$\d+"), "?"),
+    (re.compile(r"(?<![\w.$])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b"), "?"),
+    (re.compile(r"\b(?:NULL|TRUE|FALSE)\b", re.IGNORECASE), "?"),
+    (re.compile(r"\s+"), " "),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?)"),
+    (re.compile(r"\(\?\)(?:\s*,\s*\(\?\))+"), "(?)"),
+]
+
+# fingerprints longer than this are cut off
+MAX_FINGERPRINT = 1000
+
+# where to put statements once there are too many fingerprints to keep track
+# of, which usually means something is building queries with values in them
+OTHER = "<other>"
+
+# which statistics each connection records into. they go away with their
+# connections.
+_registries = weakref.WeakKeyDictionary()
+
+
+def fingerprint(query) -> str:
+    """Return *query* with its literals, parameters and extra space taken out."""
+    # long queries, like pages of VALUES, are rarely seen twice and would take
+    # up a lot of room in the cache
+    if len(query) > 4096:
+        return _fingerprint(query)
+    return _cached_fingerprint(query)
+
+
+def _fingerprint(query):
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    for pattern, replacement in NORMALIZE:
+        query = pattern.sub(replacement, query)
+    return query.strip()[:MAX_FINGERPRINT]
+
+
+_cached_fingerprint = functools.lru_cache(maxsize=4096)(_fingerprint)
+
+
+def shape(params) -> str:
+    """Describe parameters by their types without saying what they are."""
+    if params is None:
+        return "none"
+    if isinstance(params, Mapping):
+        items = ["{}: {}".format(name, _describe(value)) for name, value in list(params.items())[:20]]
+        return "{" + ", ".join(items) + (", ..." if len(params) > 20 else "") + "}"
+    if isinstance(params, (list, tuple)):
+        items = [_describe(value) for value in params[:20]]
+        return "(" + ", ".join(items) + (", ..." if len(params) > 20 else "") + ")"
+    return _describe(params)
+
+
+def _describe(value):
+    name = type(value).__name__
+    if isinstance(value, (str, bytes, list, tuple, dict, set)):
+        return "{}[{}]".format(name, len(value))
+    return name
+
+
+class Statement:
+    __slots__ = ("count", "rows", "errors", "current", "previous", "started")
+
+    def __init__(self, now):
+        self.count = 0
+        self.rows = 0
+        self.errors = 0
+        self.current = Histogram()
+        self.previous = None
+        self.started = now
+
+
+class QueryStatistics:
+    def __init__(self, slow_query: float = 1.0, window: float = 300.0, max_statements: int = 1000):
+        """Keep track of how long queries take.
+
+        Queries that take longer than *slow_query* seconds are logged, unless
+        it is None. Latency histograms cover the last *window* to twice
+        *window* seconds. No more than *max_statements* fingerprints are kept.
+        """
+        self.slow_query = slow_query
+        self.window = window
+        self.max_statements = max_statements
+        self.statements = {}
+        self._lock = threading.Lock()
+
+    def record(self, cur, query, params, seconds: float, rows: int, error: bool = False):
+        if isinstance(query, Composable):
+            query = query.as_string(cur)
+        name = key = fingerprint(query)
+
+        now = time.monotonic()
+        with self._lock:
+            statement = self.statements.get(key)
+            if statement is None:
+                if len(self.statements) >= self.max_statements:
+                    key = OTHER
+                    statement = self.statements.get(key)
+                if statement is None:
+                    statement = self.statements[key] = Statement(now)
+
+            # start a new histogram once a window goes by. the last one is
+            # kept so there's always a window's worth to look at.
+            if now - statement.started >= self.window:
+                statement.previous = statement.current if now - statement.started < 2 * self.window else None
+                statement.current = Histogram()
+                statement.started = now
+
+            statement.count += 1
+            statement.rows += max(0, rows)
+            if error:
+                statement.errors += 1
+            statement.current.observe(seconds)
+
+        if self.slow_query is not None and seconds >= self.slow_query:
+            logger.warning("slow query took {:.3f}s: {} with parameters {}".format(seconds, name, shape(params)))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            result = {}
+            for key, statement in self.statements.items():
+                histogram = statement.current
+                if statement.previous is not None:
+                    histogram = histogram.merge(statement.previous)
+                result[key] = {
+                    "count": statement.count,
+                    "rows": statement.rows,
+                    "errors": statement.errors,
+                    "latency": histogram.snapshot(),
+                }
+            return result
+
+    def reset(self):
+        with self._lock:
+            self.statements = {}
+
+
+# the statistics for connections that are shared by the whole process
+statistics = QueryStatistics()
+
+
+def attach(conn, registry: QueryStatistics = None):
+    """Record the queries run on a connection into *registry*."""
+    _registries[conn] = statistics if registry is None else registry
+
+
+class InstrumentedCursorMixin:
+    def execute(self, query, vars=None):
+        registry = _registries.get(self.connection)
+        if registry is None:
+            return super().execute(query, vars)
+        return self._timed(registry, query, vars, super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        registry = _registries.get(self.connection)
+        if registry is None:
+            return super().executemany(query, vars_list)
+        return self._timed(registry, query, vars_list, super().executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        registry = _registries.get(self.connection)
+        if registry is None:
+            return super().copy_expert(sql, file, size)
+        return self._timed(registry, sql, None, super().copy_expert, sql, file, size)
+
+    def _timed(self, registry, query, params, method, *args):
+        started = time.perf_counter()
+        try:
+            result = method(*args)
+        except Exception:
+            registry.record(self, query, params, time.perf_counter() - started, 0, error=True)
+            raise
+        registry.record(self, query, params, time.perf_counter() - started, self.rowcount)
+        return result
+
+
+@functools.lru_cache(maxsize=None)
+def cursor_class(base):
+    """Return a subclass of the cursor class *base* that times its queries."""
+    return type("Instrumented{}".format(base.__name__), (InstrumentedCursorMixin, base), {})
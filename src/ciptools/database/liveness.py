@@ -0,0 +1,71 @@
+"""Connection Liveness Checks
+
+Before a connection is handed out it can be checked to see whether it still
+works. Sending "SELECT 1" is the only way to know for sure but it costs a full
+round trip to the database on every checkout. These policies trade certainty
+for speed:
+
+    "always" -- send "SELECT 1" on every checkout. this is the default.
+    "idle"   -- send "SELECT 1" only if the connection has been sitting idle
+                for longer than "ping_idle" seconds.
+    "never"  -- never send anything. connections that have failed are found
+                when they are used and they are thrown away when they are
+                returned so the next checkout gets a new one.
+
+Every policy first looks at the local state of the connection, which is free.
+A connection that psycopg2 knows is closed or that is in an unknown
+transaction state is never handed out.
+
+"""
+
+import logging
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN
+
+PING_ALWAYS = "always"
+PING_IDLE = "idle"
+PING_NEVER = "never"
+PING_POLICIES = (PING_ALWAYS, PING_IDLE, PING_NEVER)
+
+logger = logging.getLogger(__name__)
+
+
+def validate_policy(ping: str) -> str:
+    if ping not in PING_POLICIES:
+        raise ValueError("ping policy must be one of: {}".format(", ".join(PING_POLICIES)))
+    return ping
+
+
+def is_usable(conn) -> bool:
+    # this only looks at what psycopg2 already knows about the connection and
+    # does not talk to the database.
+    try:
+        return not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_UNKNOWN
+    except psycopg2.Error:
+        return False
+
+
+def ping(conn) -> bool:
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        return True
+    except psycopg2.Error as e:
+        logger.warning("connection failed: {}".format(e))
+        return False
+
+
+def check(conn, policy: str = PING_ALWAYS, idle: float = 0.0, ping_idle: float = 30.0) -> bool:
+    """Returns true if the connection looks like it can be used.
+
+    The *idle* argument is how many seconds the connection has been sitting
+    unused and is only looked at by the "idle" policy.
+    """
+    if not is_usable(conn):
+        return False
+
+    if policy == PING_ALWAYS or (policy == PING_IDLE and idle >= ping_idle):
+        return ping(conn)
+
+    return True
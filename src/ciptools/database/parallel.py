@@ -0,0 +1,207 @@
+"""Parallel Bulk Loading
+
+One COPY stream is limited by how fast one Python process can format rows,
+which is usually well below what the database can take. This spreads the work
+over a pool of processes. Each process has its own connection pool with one
+connection in it and formats and copies its own share of the rows:
+
+    from ciptools.database.parallel import parallel_copy
+
+    # split rows from any iterable into shards of 100,000 rows
+    result = parallel_copy(
+        {"host": "mars.lab.cip.uw.edu", "dbname": "election2020"},
+        "public.tweets", ["id", "text"], rows=rows, workers=8,
+    )
+
+    # or give each process whole files. the reader is called in the worker
+    # with a path and returns the rows in that file. it has to be something
+    # that can be pickled, like a function defined at the top of a module.
+    result = parallel_copy(dsn, "public.tweets", ["id", "text"], files=paths, reader=read_tweets)
+    print("loaded {} rows at {:.0f} rows/s".format(result.rows, result.rows_per_second))
+
+The pool based DatabaseClient has a "parallel_copy" method that uses the same
+connection arguments as the client. The number of processes is the smallest of
+*workers* and *connections*, which is the most connections the load may have
+open at once. Shards of rows are pickled and sent to the workers, so some of
+the work still happens in the calling process. Files are read in the workers.
+
+The workers take off any psycopg2 wait callback that they inherit, like the
+one ciptools.monkey installs for eventlet and gevent, because psycopg2 can't
+COPY with one installed. The workers don't run any green threads so this is
+the way to bulk load from a patched process.
+
+Every shard is copied and committed on its own. A shard that fails doesn't
+stop the others. Once everything has finished a ParallelLoadError is raised
+that lists the shards that failed, unless *raise_errors* is turned off, in
+which case the failures are only in the result. *progress* is called in the
+calling process with the result so far every time a shard finishes.
+
+"""
+
+import concurrent.futures
+import itertools
+import logging
+import os
+import time
+import uuid
+from typing import Callable, Iterable, List, NamedTuple, Sequence, Tuple
+
+import psycopg2.extensions
+
+from ciptools.database import bulk
+
+logger = logging.getLogger(__name__)
+
+# the connection pool for each worker process
+_pool = None
+
+
+class ParallelResult(NamedTuple):
+    rows: int
+    shards: int
+    seconds: float
+    # a description of each shard that failed and why
+    errors: List[Tuple[str, str]]
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+class ParallelLoadError(Exception):
+    def __init__(self, result: ParallelResult):
+        super().__init__("{} of {} shards failed to load: {}".format(
+            len(result.errors), result.shards, "; ".join("{}: {}".format(shard, error) for shard, error in result.errors),
+        ))
+        self.result = result
+
+
+def parallel_copy(
+        connection: dict,
+        table: str,
+        columns: Sequence[str],
+        rows: Iterable[Sequence] = None,
+        files: Iterable[str] = None,
+        reader: Callable[[str], Iterable[Sequence]] = None,
+        workers: int = None,
+        connections: int = None,
+        shard_size: int = 100000,
+        types: Sequence[str] = None,
+        flush_size: int = 65536,
+        progress: Callable[[ParallelResult], None] = None,
+        raise_errors: bool = True,
+        retry: bool = True,
+) -> ParallelResult:
+    """Copy rows into a table from several processes at once.
+
+    *connection* holds the arguments for psycopg2.connect. Give either *rows*
+    or *files* and *reader*. *workers* defaults to the number of CPUs.
+    """
+    if (rows is None) == (files is None):
+        raise ValueError("give either rows or files to load")
+    if files is not None and reader is None:
+        raise ValueError("a reader is needed to load files")
+
+    workers = workers or os.cpu_count() or 1
+    if connections is not None:
+        workers = min(workers, connections)
+    workers = max(1, workers)
+
+    if rows is not None:
+        rows = iter(rows)
+        shards = ((
+            "rows {}-{}".format(start, start + len(chunk) - 1),
+            _copy,
+            (table, columns, chunk, types, flush_size),
+        ) for start, chunk in _chunks(rows, shard_size))
+    else:
+        shards = (
+            (path, _copy_file, (table, columns, reader, path, types, flush_size))
+            for path in files
+        )
+
+    started = time.monotonic()
+    loaded = 0
+    count = 0
+    errors = []
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_initialize,
+            initargs=(connection, retry),
+    ) as executor:
+        # only keep a few shards waiting for each worker so that a huge input
+        # isn't all read into memory at once
+        running = {}
+        shards = iter(shards)
+        while True:
+            for name, function, args in itertools.islice(shards, 2 * workers - len(running)):
+                running[executor.submit(function, *args)] = name
+            if not running:
+                break
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                count += 1
+                try:
+                    loaded += future.result()
+                except Exception as e:
+                    logger.error("could not load {} into {}: {}".format(name, table, e))
+                    errors.append((name, str(e)))
+
+                if progress is not None:
+                    progress(ParallelResult(loaded, count, time.monotonic() - started, list(errors)))
+
+    result = ParallelResult(loaded, count, time.monotonic() - started, errors)
+    logger.info("copied {} rows into {} from {} shards with {} workers in {:.2f}s ({:.0f} rows/s)".format(
+        result.rows, table, result.shards, workers, result.seconds, result.rows_per_second,
+    ))
+
+    if errors and raise_errors:
+        raise ParallelLoadError(result)
+    return result
+
+
+def _chunks(rows, size):
+    start = 0
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield start, chunk
+        start += len(chunk)
+
+
+def _initialize(connection, retry):
+    # imported here to avoid a circular import. the pool module uses this one.
+    from ciptools.database.pool import ConnectionPool
+
+    # a forked worker inherits the wait callback from a process patched for
+    # eventlet or gevent, and the patching itself. nothing here runs on the
+    # hub and COPY won't work with the callback installed so take it off and
+    # don't let the pool put it back.
+    psycopg2.extensions.set_wait_callback(None)
+
+    # keep the one connection between shards instead of connecting again
+    # for each of them
+    global _pool
+    _pool = ConnectionPool(1, 1, retry, green=False, **connection)
+
+
+def _copy(table, columns, rows, types, flush_size):
+    key = str(uuid.uuid4())
+    conn = _pool.getconn(key)
+    close = False
+    try:
+        return bulk.copy_rows(conn, table, columns, rows, flush_size=flush_size, types=types).rows
+    except Exception:
+        # don't trust a connection that something went wrong on
+        close = True
+        raise
+    finally:
+        _pool.putconn(key, close=close)
+
+
+def _copy_file(table, columns, reader, path, types, flush_size):
+    return _copy(table, columns, reader(path), types, flush_size)
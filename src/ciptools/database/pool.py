@@ -1,123 +1,621 @@
 import logging
+import os
 import threading
+import time
 import uuid
+from collections import deque
 from contextlib import contextmanager
 
 import psycopg2
 import tenacity
-from psycopg2.extensions import (TRANSACTION_STATUS_IDLE,
-                                 TRANSACTION_STATUS_UNKNOWN)
-from psycopg2.extras import DictCursor
+from psycopg2.extensions import (ISOLATION_LEVEL_DEFAULT,
+                                 TRANSACTION_STATUS_IDLE)
+
+import ciptools.monkey
+from ciptools.database import (batch, bulk, columnar, instrument, liveness,
+                               parallel, prepared, routing, streaming,
+                               transactions, watchdog)
+from ciptools.database.instrument import QueryStatistics
+from ciptools.database.rows import ROW_DICT, cursor_factory
+from ciptools.database.stats import PoolStats
 
 logger = logging.getLogger(__name__)
 
+# serializes pools rebuilding themselves after a fork. this lock is replaced in
+# the child in case some other thread was holding it when we forked.
+_fork_lock = threading.Lock()
+
+
+def _reset_fork_lock():
+    global _fork_lock
+    _fork_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_fork_lock)
+
+# the priority class of checkouts that don't ask for one
+DEFAULT_PRIORITY = "default"
+
+
+def detach(conn):
+    # get rid of a connection that was inherited from a parent process without
+    # disturbing the parent, which is still using the same server session. the
+    # child's copy of the socket is pointed at /dev/null first so that nothing
+    # psycopg2 sends when the connection is closed ever reaches the server.
+    try:
+        fd = conn.fileno()
+    except (AttributeError, psycopg2.Error):
+        fd = None
+
+    if fd is not None:
+        devnull = os.open(os.devnull, os.O_RDWR)
+        try:
+            os.dup2(devnull, fd)
+        except OSError as e:
+            logger.warning("could not detach inherited database connection: {}".format(e))
+            return
+        finally:
+            os.close(devnull)
+
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+class _Waiter(threading.Condition):
+    # a thread waiting in line for a connection and where it goes in line
+    def __init__(self, lock, priority, rank):
+        super().__init__(lock)
+        self.priority = priority
+        self.rank = rank
+
 
 class PoolError(psycopg2.Error):
     pass
 
 
 class ConnectionPool:
-    def __init__(self, minconn, maxconn, retry, *args, **kwargs):
+    def __init__(
+            self,
+            minconn,
+            maxconn,
+            retry,
+            *args,
+            timeout=30.0,
+            ping=liveness.PING_ALWAYS,
+            ping_idle=30.0,
+            max_idle=None,
+            max_lifetime=None,
+            maintenance_interval=None,
+            priorities=None,
+            green=True,
+            **kwargs,
+    ):
         self.minconn = int(minconn)
         self.maxconn = int(maxconn)
 
+        # priority classes for checkouts, highest priority first, like this:
+        #
+        #   {"interactive": {"reserve": 4}, "batch": {"max": 24}}
+        #
+        # "reserve" connections are kept for a class and other classes can't
+        # use them. "max" is the most connections a class may have at once.
+        # when a connection frees up the threads waiting for it are served by
+        # class and then in the order they arrived. checkouts that don't give
+        # a class are in the "default" class, which comes last unless it's
+        # listed somewhere else.
+        self.priorities = self._validate_priorities(priorities)
+        self._ranks = {name: rank for rank, name in enumerate(self.priorities)}
+
+        # how long to wait for a connection when the pool is exhausted. zero
+        # means fail immediately and None means wait forever.
+        self.timeout = timeout
+
+        # how to check connections before handing them out. see the liveness
+        # module for what the policies mean.
+        self.ping = liveness.validate_policy(ping)
+        self.ping_idle = ping_idle
+
+        # how many seconds a connection may sit idle in the pool and how many
+        # seconds a connection may live before it is replaced. idle connections
+        # are only reaped by the maintenance thread.
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+
         self._args = args
         self._kwargs = kwargs
 
-        self._pool = []   # connections that are available
+        # control retries
+        self._retry = retry
+
+        # whether to install the psycopg2 wait callback when eventlet or gevent
+        # is in charge. a pool whose connections must be able to COPY, like
+        # the ones in the parallel loader's workers, turns this off.
+        self.green = green
+
+        # if asked, start a thread that creates the first "minconn" connections
+        # and then keeps the pool topped up and tidy so that connecting doesn't
+        # happen while someone is waiting for a connection.
+        self.maintenance_interval = maintenance_interval
+
+        # counters and timings for everything the pool does
+        self._stats = PoolStats()
+
+        self._closed = False
+        self._setup()
+
+    def _validate_priorities(self, priorities):
+        if not priorities:
+            return {DEFAULT_PRIORITY: {"reserve": 0, "max": None}}
+
+        result = {}
+        for name, limits in priorities.items():
+            unknown = set(limits) - {"reserve", "max"}
+            if unknown:
+                raise ValueError("unknown limits for priority {}: {}".format(name, ", ".join(sorted(unknown))))
+            reserve = int(limits.get("reserve", 0))
+            maximum = limits.get("max")
+            if reserve < 0 or (maximum is not None and int(maximum) < reserve):
+                raise ValueError("priority {} must reserve between zero and its max connections".format(name))
+            result[name] = {"reserve": reserve, "max": None if maximum is None else int(maximum)}
+        result.setdefault(DEFAULT_PRIORITY, {"reserve": 0, "max": None})
+
+        if sum(limits["reserve"] for limits in result.values()) > self.maxconn:
+            raise ValueError("priorities reserve more than maxconn connections")
+        return result
+
+    def stats(self):
+        # a snapshot of the statistics plus what the pool looks like right now
+        with self._lock:
+            current = {
+                "in_use": len(self._used),
+                "idle": len(self._pool),
+                "pending": self._pending + self._returning,
+                "waiting": len(self._waiters),
+                "minconn": self.minconn,
+                "maxconn": self.maxconn,
+            }
+            if len(self.priorities) > 1:
+                current["priorities"] = {
+                    name: {
+                        "in_use": self._class_used[name],
+                        "waiting": sum(1 for waiter in self._waiters if waiter.priority == name),
+                        "reserve": limits["reserve"],
+                        "max": limits["max"],
+                    }
+                    for name, limits in self.priorities.items()
+                }
+        current.update(self._stats.snapshot())
+        return current
+
+    def add_hook(self, event, callback):
+        # see the stats module for how hooks are called. the events are:
+        #   checkout -- with the seconds spent waiting for the connection.
+        #               with priority classes there is also one event for
+        #               each class, like "checkout.interactive".
+        #   checkin -- with the seconds the connection was checked out
+        #   timeout -- when waiting for a connection timed out. like
+        #              checkout there's also "timeout.interactive" and so on.
+        #   connect -- with the seconds spent making a new connection
+        #   connect_failure -- when a connection attempt failed
+        #   reconnect -- when a connection failed its liveness check
+        #   deadline -- when a checkout's query was cancelled because its
+        #               deadline passed. see the watchdog module.
+        #   transaction_retry -- with the seconds before a transaction that
+        #                        failed to serialize or deadlocked is retried
+        #   transaction_failure -- when a transaction that failed that way ran
+        #                          out of attempts. see the transactions module.
+        self._stats.add_hook(event, callback)
+
+    def _setup(self):
+        # the process that owns the connections in this pool. if we find
+        # ourselves in a different process then we were forked and everything
+        # in here belongs to our parent.
+        self._pid = os.getpid()
+
+        self._pool = []   # connections that are available, with idle time
         self._used = {}   # connections currently in use
+        self._pending = 0  # connections being checked out
+        self._returning = 0  # connections being put back
+        self._created = {}  # when each connection was made, by id
+        self._checked_out = {}  # when each key checked out its connection
+        self._class_used = dict.fromkeys(self.priorities, 0)  # connections out by class
+        self._class_of = {}  # the priority class of each key
 
-        # control access to the thread pool
+        # control access to the thread pool. nothing that talks to the
+        # database is done while holding this lock.
         self._lock = threading.RLock()
 
-        # control retries
-        self._retry = retry
+        # threads waiting for a connection, oldest first. each one waits on its
+        # own condition so that we can wake them up in order.
+        self._waiters = deque()
+
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._maintenance = None
+        if self.maintenance_interval is not None and not self._closed:
+            self._maintenance = threading.Thread(target=self._maintain, name="ciptools-pool-maintenance", daemon=True)
+            self._maintenance.start()
+
+    def _check_fork(self):
+        # this is cheap enough to do on every call
+        if self._pid == os.getpid():
+            return
+
+        with _fork_lock:
+            if self._pid == os.getpid():
+                return
+
+            # we were forked. our parent's connections (and its lock and its
+            # maintenance thread) are no use to us. get rid of the connections
+            # without closing them on the server and start over. new
+            # connections will be made as they are needed.
+            inherited = [conn for conn, _ in self._pool] + list(self._used.values())
+            logger.debug("process forked, discarding {} inherited database connections".format(len(inherited)))
+            for conn in inherited:
+                detach(conn)
 
-    def getconn(self, key):
+            self._stats.reset()
+            self._setup()
+
+    def getconn(self, key, timeout=None, priority=None):
+        if timeout is None:
+            timeout = self.timeout
+        if priority is None:
+            priority = DEFAULT_PRIORITY
+        if priority not in self._ranks:
+            raise ValueError("unknown priority: {}".format(priority))
+
+        started = time.monotonic()
+        self._check_fork()
         with self._lock:
             # this key already has a connection so return it
             if key in self._used:
                 return self._used[key]
 
-            # our pool is currently empty
-            if len(self._pool) == 0:
-                # we've given out all of the connections that we want to
-                if len(self._used) == self.maxconn:
-                    raise PoolError("connection pool exhausted")
+            # get an idle connection or reserve a slot for a new one. the slot
+            # counts against maxconn until the connection is either handed out
+            # or abandoned.
+            conn = self._acquire(timeout, priority)
+            self._pending += 1
+            self._class_used[priority] += 1
 
-                # create new connection and put into the list of available
-                # connections. we'll pop it off in a minute and return it
-                conn = self._connect()
-                self._pool.append(conn)
+            # if we're dipping into the reserve then ask for more
+            if self._maintenance is not None and len(self._pool) < self.minconn:
+                self._wakeup.set()
 
-            # pull a connection off of the pool and test it. if it fails then
-            # we're going to drop it and create a new one
-            conn = self._pool.pop()
-            try:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT 1")
-            except psycopg2.Error as e:
-                logger.warning("connection failed: {}".format(e))
-
-                # try to rollback anything the connection was doing
-                try:
-                    if conn is not None:
-                        conn.rollback()
-                except Exception as e:
-                    logger.warning("could not rollback connection: {}".format(e))
-
-                # test failed, make a new connection
-                logger.warning("creating new connection to replace failed connection")
+        # connecting and testing connections happen without holding the lock so
+        # that one slow or failing database host doesn't stop every other
+        # thread from checking out or returning connections.
+        try:
+            if conn is None:
                 conn = self._connect()
+            else:
+                conn = self._check(*conn)
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+                self._class_used[priority] -= 1
+                self._notify()
+            raise
 
-            # move the connection to the "in use" list and return it
+        # move the connection to the "in use" list and return it
+        now = time.monotonic()
+        with self._lock:
+            self._pending -= 1
             self._used[key] = conn
-            return conn
+            self._checked_out[key] = now
+            self._class_of[key] = priority
+
+        self._stats.record("checkout", now - started)
+        if len(self.priorities) > 1:
+            self._stats.record("checkout.{}".format(priority), now - started)
+        return conn
 
     def putconn(self, key, close=False):
+        self._check_fork()
         with self._lock:
-            conn = self._used.get(key)
+            conn = self._used.pop(key, None)
             if conn is None:
                 raise PoolError("no connection with that key")
+            checked_out = self._checked_out.pop(key, None)
+            self._class_used[self._class_of.pop(key)] -= 1
 
-            if len(self._pool) < self.minconn and not close:
-                # return the connection into a consistent state before putting
-                # it back in the pool by rolling back or forcibly disconnecting
-                try:
-                    status = conn.info.transaction_status
-                    if status == TRANSACTION_STATUS_UNKNOWN:
-                        # server connection lost
-                        conn.close()
-                    if status != TRANSACTION_STATUS_IDLE:
-                        # connection in error or in transaction
-                        conn.rollback()
+            # decide now whether the connection goes back into the pool so that
+            # two threads returning connections at once don't overfill it. if
+            # the maintenance thread is reaping idle connections then we can
+            # keep everything and let it sort out what is no longer needed.
+            if self._maintenance is not None and self.max_idle is not None:
+                limit = self.maxconn
+            else:
+                limit = self.minconn
+
+            # threads waiting in line would only have to connect again so keep
+            # a connection for each of them that may have one
+            limit = max(limit, sum(1 for waiter in self._waiters if self._allowed(waiter.priority)))
+            keep = (
+                not close
+                and not self._closed
+                and not self._expired(conn)
+                and len(self._pool) + self._returning < limit
+            )
+            if keep:
+                self._returning += 1
+            else:
+                # the slot is free so let the next thread in line have it
+                self._notify()
+
+        if checked_out is not None:
+            self._stats.record("checkin", time.monotonic() - checked_out)
 
+        if keep:
+            # return the connection into a consistent state before putting it
+            # back in the pool. this may talk to the database so it is done
+            # without holding the lock.
+            reset = self._reset(conn)
+            with self._lock:
+                self._returning -= 1
+                if reset and not self._closed:
                     # regular idle connection. the connection will be checked
                     # before we give it out again, just so you know.
-                    self._pool.append(conn)
-                except psycopg2.Error as e:
-                    # we weren't able to reset the connection so do not put it
-                    # back into the pool. log the bad news.
-                    logger.warning("could not reset database connection when putting back into the pool: {}".format(e))
-            else:
-                # just close the connection. it's ok if we're not able to close
-                # the connection, though a warning is nice.
-                try:
-                    conn.close()
-                except psycopg2.Error as e:
-                    logger.warning("could not close database connection when putting back into the pool: {}".format(e))
+                    self._pool.append((conn, time.monotonic()))
+                    conn = None
+                self._notify()
 
-            # here we check for the presence of key because it can happen that
-            # a thread tries to put back a connection after a call to close
-            if key in self._used:
-                del self._used[key]
+        if conn is not None:
+            self._discard(conn)
+
+    def closeall(self):
+        # stop the maintenance thread and close every idle connection. the
+        # connections that are in use are closed when they are put back.
+        self._check_fork()
+        with self._lock:
+            self._closed = True
+            idle = [conn for conn, _ in self._pool]
+            self._pool = []
+
+            # anyone waiting in line needs to find out that the pool is closed
+            for waiter in self._waiters:
+                waiter.notify()
+
+        self._stop.set()
+        self._wakeup.set()
+        if self._maintenance is not None and self._maintenance is not threading.current_thread():
+            self._maintenance.join()
+
+        for conn in idle:
+            self._discard(conn)
+
+    def _acquire(self, timeout, priority=DEFAULT_PRIORITY):
+        # must be called while holding the lock. returns an idle connection or
+        # None if there is room to create a new one. waits in line behind any
+        # other threads that were already waiting if there is neither.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waiter = None
+        try:
+            while True:
+                if self._closed:
+                    raise PoolError("connection pool is closed")
+
+                # only the thread at the front of the line gets to go so that
+                # new arrivals can't cut in front of threads already waiting.
+                # the line is sorted by priority class and threads whose
+                # class can't have another connection step aside. a new
+                # arrival has to be allowed to go itself and may only go when
+                # nobody ahead of it in line could.
+                if waiter is None:
+                    rank = self._ranks[priority]
+                    ahead = any(w.rank <= rank and self._allowed(w.priority) for w in self._waiters)
+                    first = None if self._allowed(priority) and not ahead else False
+                else:
+                    first = self._next_waiter()
+                if first is waiter:
+                    if len(self._pool):
+                        return self._pool.pop()
+                    if self._available():
+                        return None
+
+                if deadline is None:
+                    remaining = None
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        # we've given out all of the connections that we want to
+                        self._stats.record("timeout")
+                        if len(self.priorities) > 1:
+                            self._stats.record("timeout.{}".format(priority))
+                        raise PoolError("connection pool exhausted")
+
+                if waiter is None:
+                    # behind everyone of the same or a higher priority
+                    waiter = _Waiter(self._lock, priority, rank)
+                    position = next((i for i, w in enumerate(self._waiters) if w.rank > rank), len(self._waiters))
+                    self._waiters.insert(position, waiter)
+                    continue
+
+                waiter.wait(remaining)
+        finally:
+            if waiter is not None:
+                self._waiters.remove(waiter)
 
-    def _connect(self):
+                # whether we got a connection or gave up, the next thread in
+                # line might be able to go now
+                self._notify()
+
+    def _available(self):
+        # must be called while holding the lock
+        return len(self._used) + self._pending + self._returning < self.maxconn
+
+    def _allowed(self, priority):
+        # must be called while holding the lock. whether a class may have
+        # another connection without going over its max or taking one that
+        # is reserved for another class.
+        if len(self.priorities) == 1:
+            return True
+
+        limits = self.priorities[priority]
+        if limits["max"] is not None and self._class_used[priority] >= limits["max"]:
+            return False
+
+        reserved = sum(
+            max(0, other["reserve"] - self._class_used[name])
+            for name, other in self.priorities.items() if name != priority
+        )
+        if not reserved:
+            return True
+        free = self.maxconn - (len(self._used) + self._pending + self._returning)
+        return free > reserved
+
+    def _next_waiter(self):
+        # must be called while holding the lock. the first thread in line
+        # whose class may have another connection, if there is one.
+        for waiter in self._waiters:
+            if self._allowed(waiter.priority):
+                return waiter
+        return None
+
+    def _notify(self):
+        # must be called while holding the lock. wake up the thread at the
+        # front of the line if there is something for it to take.
+        if self._waiters and (len(self._pool) or self._available()):
+            waiter = self._next_waiter()
+            if waiter is not None:
+                waiter.notify()
+
+    def _expired(self, conn, now=None):
+        if self.max_lifetime is None:
+            return False
+        if now is None:
+            now = time.monotonic()
+        return now - self._created.get(id(conn), now) > self.max_lifetime
+
+    def _check(self, conn, idle_since):
+        # connections that have lived too long are quietly replaced
+        if self._expired(conn):
+            self._discard(conn)
+            return self._connect()
+
+        # test the connection. if it fails then we're going to drop it and
+        # create a new one
+        if liveness.check(conn, self.ping, time.monotonic() - idle_since, self.ping_idle):
+            return conn
+
+        # try to rollback anything the connection was doing
+        try:
+            conn.rollback()
+        except Exception as e:
+            logger.warning("could not rollback connection: {}".format(e))
+
+        # and then make sure that it is gone
+        self._discard(conn)
+
+        # test failed, make a new connection
+        logger.warning("creating new connection to replace failed connection")
+        self._stats.record("reconnect")
+        return self._connect()
+
+    def _discard(self, conn):
+        # just close the connection. it's ok if we're not able to close the
+        # connection, though a warning is nice. anything prepared on it is
+        # gone with it.
+        self._created.pop(id(conn), None)
+        prepared.forget(conn)
+        try:
+            conn.close()
+        except psycopg2.Error as e:
+            logger.warning("could not close database connection: {}".format(e))
+
+    def _maintain(self):
+        # this runs in its own thread until the pool is closed. the first pass
+        # fills the pool up to "minconn" connections.
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            try:
+                self._reap()
+                self._refill()
+            except Exception as e:
+                logger.warning("could not maintain connection pool: {}".format(e))
+            self._wakeup.wait(self.maintenance_interval)
+
+    def _reap(self):
+        now = time.monotonic()
+        drop = []
+        with self._lock:
+            # idle connections past "max_idle" are closed but only while there
+            # are more than "minconn" of them. connections past "max_lifetime"
+            # are always closed. the oldest idle connections come first.
+            excess = len(self._pool) - self.minconn
+            keep = []
+            for conn, idle_since in self._pool:
+                if self._expired(conn, now):
+                    drop.append(conn)
+                    excess = excess - 1
+                elif excess > 0 and self.max_idle is not None and now - idle_since > self.max_idle:
+                    drop.append(conn)
+                    excess = excess - 1
+                else:
+                    keep.append((conn, idle_since))
+            self._pool = keep
+            self._notify()
+
+        for conn in drop:
+            logger.debug("closing idle or expired database connection")
+            self._discard(conn)
+
+    def _refill(self):
+        while not self._stop.is_set():
+            with self._lock:
+                if self._closed or len(self._pool) >= self.minconn or not self._available():
+                    return
+                self._pending += 1
+
+            try:
+                # don't retry here. if it fails then we'll try again next time.
+                conn = self._connect(retry=False)
+            except Exception:
+                with self._lock:
+                    self._pending -= 1
+                    self._notify()
+                return
+
+            with self._lock:
+                self._pending -= 1
+                if not self._closed:
+                    self._pool.append((conn, time.monotonic()))
+                    conn = None
+                self._notify()
+
+            if conn is not None:
+                self._discard(conn)
+
+    @staticmethod
+    def _reset(conn):
+        # return the connection into a consistent state by rolling back or
+        # forcibly disconnecting. returns true if it can be reused.
+        try:
+            if not liveness.is_usable(conn):
+                # server connection lost. this is how connections that failed
+                # while they were being used get weeded out.
+                conn.close()
+                return False
+            if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                # connection in error or in transaction
+                conn.rollback()
+            conn.autocommit = True
+            return True
+        except psycopg2.Error as e:
+            # we weren't able to reset the connection so do not put it back
+            # into the pool. log the bad news.
+            logger.warning("could not reset database connection when putting back into the pool: {}".format(e))
+            return False
+
+    def _connect(self, retry=None):
         # if set then we will not retry connections
         retry_flag = threading.Event()
 
         # control retries
-        if self._retry:
+        if (retry is None and self._retry) or retry:
             retry_flag.clear()
         else:
             retry_flag.set()
@@ -131,39 +629,249 @@ class ConnectionPool:
             with attempt:
                 counter = counter + 1
                 try:
+                    # if eventlet or gevent is in charge then make sure that
+                    # waiting on the database yields to the hub.
+                    if self.green:
+                        ciptools.monkey.patch_psycopg()
+
                     # connect to the database with the arguments provided when the
                     # pool was initialized. enable autocommit for consistency.
                     # this will retry using the "tenacity" library.
+                    started = time.monotonic()
                     conn = psycopg2.connect(*self._args, **self._kwargs)
                     conn.autocommit = True
+                    self._created[id(conn)] = time.monotonic()
+                    self._stats.record("connect", time.monotonic() - started)
                     return conn
                 except Exception as e:
                     logger.error("failed to connect to database on attempt {}: {}".format(counter, e))
+                    self._stats.record("connect_failure")
                     raise
 
 
 class DatabaseClient:
-    def __init__(self, minconn=2, maxconn=32, retry=True, **kwargs):
+    def __init__(
+            self,
+            minconn=2,
+            maxconn=32,
+            retry=True,
+            timeout=30.0,
+            ping=liveness.PING_ALWAYS,
+            ping_idle=30.0,
+            max_idle=None,
+            max_lifetime=None,
+            maintenance_interval=None,
+            row_type=ROW_DICT,
+            prepare=False,
+            prepare_threshold=5,
+            prepared_statements=100,
+            pgbouncer=False,
+            replicas=None,
+            balance=routing.LEAST_OUTSTANDING,
+            replica_retry_interval=30.0,
+            priorities=None,
+            instrument=False,
+            slow_query=1.0,
+            **kwargs,
+    ):
+        # what rows come back as unless a connection asks for something else.
+        # see the rows module.
+        self._cursor_factory = cursor_factory(row_type)
+
+        # run queries that are used a lot as prepared statements. see the
+        # prepared module. prepared statements don't work through pgbouncer
+        # so that always turns them off.
+        self._prepare = prepare and not pgbouncer
+        self._prepare_threshold = prepare_threshold
+        self._prepared_statements = prepared_statements
+
+        # time every query and log the ones that take longer than slow_query
+        # seconds. see the instrument module.
+        self._query_stats = QueryStatistics(slow_query) if instrument else None
+
         # initialize the connection pool
-        self.pool = ConnectionPool(
+        settings = dict(
             minconn=minconn,
             maxconn=maxconn,
-            retry=retry,
-            cursor_factory=DictCursor,
-            **kwargs,
+            timeout=timeout,
+            ping=ping,
+            ping_idle=ping_idle,
+            max_idle=max_idle,
+            max_lifetime=max_lifetime,
+            maintenance_interval=maintenance_interval,
+            priorities=priorities,
+            cursor_factory=self._cursor_factory,
         )
+        self.pool = ConnectionPool(retry=retry, **settings, **kwargs)
+
+        # each read replica gets a pool of its own with the same settings. a
+        # replica that can't connect is ejected so they don't retry forever.
+        # see the routing module.
+        self._router = None
+        if replicas:
+            pools = []
+            for index, replica in enumerate(replicas):
+                if isinstance(replica, str):
+                    replica = {"host": replica}
+                name = replica.get("host") or "replica{}".format(index)
+                pools.append(routing.Replica(name, ConnectionPool(retry=False, **settings, **{**kwargs, **replica})))
+            self._router = routing.Router(pools, balance=balance, retry_interval=replica_retry_interval)
+
+        # the connections that each thread is currently using, innermost last
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # stops the maintenance thread, if there is one, and closes the pool
+        self.pool.closeall()
+        for replica in self._replicas():
+            replica.pool.closeall()
+
+    def stats(self):
+        stats = self.pool.stats()
+        if self._router is not None:
+            stats["replicas"] = [
+                dict(status, **replica.pool.stats())
+                for replica, status in zip(self._router.replicas, self._router.stats())
+            ]
+        return stats
+
+    def add_hook(self, event, callback):
+        self.pool.add_hook(event, callback)
+        for replica in self._replicas():
+            replica.pool.add_hook(event, callback)
+
+    def query_stats(self):
+        # how long queries have taken, by fingerprint, if instrumented
+        return self._query_stats.snapshot() if self._query_stats is not None else {}
+
+    def _replicas(self):
+        return self._router.replicas if self._router is not None else []
+
+    @contextmanager
+    def conn(self, autocommit=True, timeout=None, row_type=None, readonly=False, priority=None, deadline=None, isolation=None):
+        # the timeout is how long to wait for a connection if the pool is
+        # exhausted. if not given then the pool's default is used. the row
+        # type, if given, is only for this checkout. readonly connections come
+        # from a read replica if there are any. the priority is the class to
+        # check the connection out as, see ConnectionPool. the deadline is how
+        # many seconds the checkout may run queries for, see the watchdog
+        # module. a transaction inside of a transaction uses the same
+        # connection with a savepoint, see the transactions module, which is
+        # also where the isolation levels are.
+        if isolation is not None:
+            isolation = transactions.isolation_level(isolation)
+        current = None if autocommit else self._current_transaction()
+        if current is not None:
+            context = transactions.savepoint(current)
+        else:
+            context = self._checkout(autocommit, timeout, row_type, readonly, priority, deadline, isolation)
+
+        with context as conn:
+            stack = self._stack()
+            stack.append(conn)
+            try:
+                yield conn
+            finally:
+                stack.pop()
+
+    @contextmanager
+    def priority(self, name):
+        # check out connections as this priority class for everything this
+        # thread does in the block, including the bulk methods
+        previous = getattr(self._local, "priority", None)
+        self._local.priority = name
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _current_transaction(self):
+        # the connection for the transaction this thread is in, if any
+        stack = self._stack()
+        if stack and not stack[-1].autocommit:
+            return stack[-1]
+        return None
+
+    def _getconn(self, key, timeout, readonly, priority=None):
+        # returns the pool the connection came from, the replica if it came
+        # from one, and the connection. reads try each working replica before
+        # giving up and going to the primary.
+        tried = []
+        while readonly and self._router is not None:
+            replica, probe = self._router.choose(exclude=tried)
+            if replica is None:
+                break
+            tried.append(replica)
+
+            try:
+                conn = replica.pool.getconn(key, timeout=timeout, priority=priority)
+            except PoolError as e:
+                # the replica is busy, not broken
+                logger.debug("read replica {} has no connections available: {}".format(replica.name, e))
+                self._router.release(replica)
+                continue
+            except psycopg2.Error as e:
+                self._router.eject(replica, e)
+                continue
+
+            if probe:
+                if not liveness.ping(conn):
+                    replica.pool.putconn(key, close=True)
+                    self._router.eject(replica, "health check failed")
+                    continue
+                self._router.admit(replica)
+
+            return replica.pool, replica, conn
+
+        return self.pool, None, self.pool.getconn(key, timeout=timeout, priority=priority)
 
     @contextmanager
-    def conn(self, autocommit=True):
+    def _checkout(self, autocommit, timeout, row_type=None, readonly=False, priority=None, deadline=None, isolation=None):
         conn = None
+        pool = self.pool
+        replica = None
+        watch = None
+        close = False
         key = str(uuid.uuid4())
+        factory = self._cursor_factory if row_type is None else cursor_factory(row_type)
+        if self._prepare:
+            factory = prepared.cursor_class(factory)
+        if self._query_stats is not None:
+            factory = instrument.cursor_class(factory)
 
         try:
-            conn = self.pool.getconn(key)
+            if priority is None:
+                priority = getattr(self._local, "priority", None)
+            pool, replica, conn = self._getconn(key, timeout, readonly, priority)
+            if self._prepare:
+                prepared.attach(conn, self._prepared_statements, self._prepare_threshold)
+            if self._query_stats is not None:
+                instrument.attach(conn, self._query_stats)
+            conn.cursor_factory = factory
+            if deadline is not None:
+                # set this before starting a transaction so that rolling the
+                # transaction back doesn't undo it
+                self._set_statement_timeout(conn, max(1, int(deadline * 1000)))
+                watch = watchdog.watch(conn, deadline)
             conn.autocommit = autocommit
+            if isolation is not None and not autocommit:
+                conn.isolation_level = isolation
             yield conn
             conn.commit()
-        except Exception:
+        except BaseException:
             try:
                 if conn is not None:
                     conn.rollback()
@@ -172,13 +880,173 @@ class DatabaseClient:
 
             raise
         finally:
+            # stop watching before anything else so the connection can't be
+            # cancelled once someone else has it
+            if watch is not None:
+                watch.cancel()
+                if watch.fired:
+                    pool._stats.record("deadline")
+
             try:
                 if conn is not None:
+                    if isolation is not None:
+                        conn.isolation_level = ISOLATION_LEVEL_DEFAULT
                     conn.autocommit = True
             except (AttributeError, psycopg2.Error) as e:
                 logger.warning("could not reset autocommit on connection: {}".format(e))
 
+            # a connection that still has our statement timeout isn't
+            # something to give to anyone else
+            if watch is not None and not conn.closed:
+                try:
+                    self._set_statement_timeout(conn, None)
+                except psycopg2.Error as e:
+                    logger.warning("could not reset statement timeout on connection: {}".format(e))
+                    close = True
+
+            # a replica whose connection broke while we were using it is
+            # probably gone
+            if replica is not None:
+                if conn.closed:
+                    self._router.eject(replica, "connection was closed")
+                else:
+                    self._router.release(replica)
+
             try:
-                self.pool.putconn(key)
+                pool.putconn(key, close=close)
             except Exception as e:
                 logger.warning("could not put connection back into pool: {}".format(e))
+
+    @staticmethod
+    def _set_statement_timeout(conn, milliseconds):
+        # None puts back whatever the server's default is
+        with conn.cursor() as cur:
+            if milliseconds is None:
+                cur.execute("RESET statement_timeout")
+            else:
+                cur.execute("SET statement_timeout = %s", (milliseconds,))
+
+    @contextmanager
+    def transaction(self, timeout=None, row_type=None, priority=None, deadline=None, isolation=None):
+        # a connection that commits when the block finishes and rolls back if
+        # the block raises an exception
+        with self.conn(
+                autocommit=False, timeout=timeout, row_type=row_type, priority=priority, deadline=deadline, isolation=isolation,
+        ) as conn:
+            yield conn
+
+    def run_in_transaction(self, fn, isolation=None, max_attempts=5, timeout=None, row_type=None, priority=None, deadline=None):
+        # call fn with a connection in a transaction and return what it
+        # returns. the transaction is tried again when it fails to serialize
+        # or deadlocks. see the transactions module.
+        if self._current_transaction() is not None:
+            with self.transaction(isolation=isolation) as conn:
+                return fn(conn)
+
+        def retrying(state):
+            seconds = state.next_action.sleep
+            logger.info("transaction failed on attempt {}, trying again in {:.3f}s: {}".format(
+                state.attempt_number, seconds, state.outcome.exception(),
+            ))
+            self.pool._stats.record("transaction_retry", seconds)
+
+        try:
+            for attempt in tenacity.Retrying(
+                    reraise=True,
+                    stop=tenacity.stop_after_attempt(max_attempts),
+                    wait=tenacity.wait_random_exponential(multiplier=0.01, max=1.0),
+                    retry=tenacity.retry_if_exception(transactions.is_retryable),
+                    before_sleep=retrying,
+            ):
+                with attempt:
+                    with self.transaction(
+                            timeout=timeout, row_type=row_type, priority=priority, deadline=deadline, isolation=isolation,
+                    ) as conn:
+                        return fn(conn)
+        except psycopg2.Error as e:
+            if transactions.is_retryable(e):
+                self.pool._stats.record("transaction_failure")
+            raise
+
+    def copy_rows(self, table, columns, rows, flush_size=65536, replace_nulls=True, types=None, timeout=None):
+        # stream rows into a table with COPY. see the bulk module for details.
+        # inside a transaction the rows are loaded as part of it. this doesn't
+        # work in a process patched for eventlet or gevent.
+        with self._cursor_transaction(timeout) as conn:
+            return bulk.copy_rows(conn, table, columns, rows, flush_size=flush_size, replace_nulls=replace_nulls, types=types)
+
+    def parallel_copy(self, table, columns, rows=None, files=None, reader=None, workers=None, connections=None, **kwargs):
+        # copy rows from a pool of processes, each with its own connection
+        # made with the same arguments as ours. see the parallel module.
+        return parallel.parallel_copy(
+            self.pool._kwargs, table, columns,
+            rows=rows, files=files, reader=reader, workers=workers, connections=connections, retry=self.pool._retry,
+            **kwargs,
+        )
+
+    def insert_many(self, table, columns, rows, on_conflict=None, returning=None, page_size=None, timeout=None):
+        # insert rows with VALUES lists in pages that size themselves. see the
+        # bulk module. all of the pages are in one transaction, either the
+        # current one or one of their own.
+        with self._cursor_transaction(timeout) as conn:
+            return bulk.insert_many(conn, table, columns, rows, on_conflict=on_conflict, returning=returning, page_size=page_size)
+
+    def bulk_upsert(self, table, key_columns, rows, columns=None, update_columns=None, chunk_size=100000, types=None, timeout=None):
+        # COPY rows into a temporary table and merge them into the table a
+        # chunk at a time. see the bulk module. the temporary table only lives
+        # as long as the transaction.
+        with self._cursor_transaction(timeout) as conn:
+            return bulk.bulk_upsert(
+                conn, table, key_columns, rows,
+                columns=columns, update_columns=update_columns, chunk_size=chunk_size, types=types,
+            )
+
+    def execute_many(self, query, rows, template=None, fetch=False, page_size=None, timeout=None):
+        # like insert_many but for any query with a "%s" for a VALUES list
+        with self._cursor_transaction(timeout) as conn:
+            return bulk.execute_many(conn, query, rows, template=template, fetch=fetch, page_size=page_size)
+
+    @contextmanager
+    def batch(self, max_bytes=1048576, timeout=None):
+        # queue statements and send them in as few round trips as possible.
+        # see the batch module. everything queued is sent when the block
+        # finishes. if it raises an exception then whatever was already sent
+        # is rolled back.
+        with self._cursor_transaction(timeout) as conn:
+            queue = batch.Batch(conn, max_bytes=max_bytes)
+            try:
+                yield queue
+                queue.finish()
+            except BaseException:
+                try:
+                    queue.rollback()
+                except psycopg2.Error as e:
+                    logger.warning("could not rollback batch: {}".format(e))
+                raise
+
+    def stream(self, query, params=None, itersize=2000, batches=False, timeout=None, row_type=None):
+        # yield rows from a server-side cursor. see the streaming module. this
+        # goes to a read replica unless we're in a transaction.
+        factory = None if row_type is None else cursor_factory(row_type)
+        if factory is not None and self._query_stats is not None:
+            factory = instrument.cursor_class(factory)
+        with self._cursor_transaction(timeout, readonly=True) as conn:
+            yield from streaming.stream(conn, query, params, itersize=itersize, batches=batches, cursor_factory=factory)
+
+    def fetch_columns(self, query, params=None, batch_size=10000, numpy=False, timeout=None):
+        # fetch results as columns instead of rows. see the columnar module.
+        # like stream this goes to a read replica.
+        with self._cursor_transaction(timeout, readonly=True) as conn:
+            return columnar.fetch(conn, query, params, batch_size=batch_size, numpy=numpy)
+
+    @contextmanager
+    def _cursor_transaction(self, timeout, readonly=False):
+        # server-side cursors need a transaction. use the current one if there
+        # is one. otherwise hold a connection of our own until we're done.
+        conn = self._current_transaction()
+        if conn is not None:
+            yield conn
+            return
+
+        with self._checkout(False, timeout, readonly=readonly) as conn:
+            yield conn
@@ -0,0 +1,203 @@
+"""Prepared Statements
+
+Every time a query is sent the server parses it and plans it again, even when
+it is the same query with different parameters. When a service runs the same
+few queries over and over that adds up. With "prepare" turned on the pool
+based DatabaseClient notices queries that are run a lot and runs them with
+PREPARE and EXECUTE instead, so they're only parsed once per connection:
+
+    db = DatabaseClient(host="mars.lab.cip.uw.edu", prepare=True)
+
+    with db.conn() as conn:
+        with conn.cursor() as cur:
+            # after the fifth time this is run on a connection it is prepared
+            cur.execute("SELECT text FROM tweets WHERE id = %s", (tweet_id,))
+
+Only queries that are run with parameters and that start with SELECT, INSERT,
+UPDATE, DELETE, VALUES or WITH are prepared. Parameters may be given either
+positionally with "%s" or by name with "%(name)s". Each connection remembers
+a limited number of queries and when it runs out of room the least recently
+used one is removed with DEALLOCATE. If a query can't be prepared, usually
+because the server can't figure out the type of one of its parameters, then
+it is run normally from then on.
+
+The server decides what type each parameter is when the query is prepared
+instead of psycopg2 working it out from the Python value. Queries that need a
+particular type should cast their parameters, like "%s::int8".
+
+Prepared statements belong to a server session. Poolers like pgbouncer in
+transaction mode hand each transaction to whatever server connection is free
+so a statement prepared on one may not exist on the next. Pass "pgbouncer"
+to the client when connecting through one and nothing will be prepared.
+
+"""
+
+import functools
+import logging
+import re
+import weakref
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import psycopg2
+import psycopg2.errors
+
+logger = logging.getLogger(__name__)
+
+# finds the placeholders that psycopg2 understands, including "%%"
+PLACEHOLDER = re.compile(r"%(?:(%)|(s)|\((\w+)\)s)")
+
+# only these kinds of statements can be prepared
+PREPARABLE = re.compile(r"\s*(SELECT|INSERT|UPDATE|DELETE|VALUES|WITH)\b", re.IGNORECASE)
+
+# the caches for each connection. they go away with their connections.
+_caches = weakref.WeakKeyDictionary()
+
+
+class Statement:
+    __slots__ = ("count", "name", "execute")
+
+    def __init__(self):
+        # how many times it has been run, the name it was prepared as and the
+        # query that runs it. the name is False if it can't be prepared.
+        self.count = 0
+        self.name = None
+        self.execute = None
+
+
+class StatementCache:
+    def __init__(self, size: int = 100, threshold: int = 5):
+        self.size = size
+        self.threshold = threshold
+        self.statements = OrderedDict()
+        self.counter = 0
+
+    def execute(self, conn, query, params, execute):
+        """Run *query* with *execute* either normally or as a prepared statement.
+
+        *execute* is the "execute" method of a cursor on *conn*.
+        """
+        if params is None or not isinstance(query, str) or not PREPARABLE.match(query):
+            return execute(query, params)
+
+        statement = self.statements.get(query)
+        if statement is None:
+            statement = self.statements[query] = Statement()
+            self._evict(execute)
+        else:
+            self.statements.move_to_end(query)
+
+        if statement.name is None:
+            statement.count += 1
+            if statement.count >= self.threshold:
+                self._prepare(conn, query, params, statement, execute)
+
+        if not statement.name:
+            return execute(query, params)
+
+        try:
+            return execute(statement.execute, params)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # something like "DISCARD ALL" got rid of our statements. start
+            # over and, if it won't hurt a transaction, run the query again.
+            self.statements.clear()
+            if not conn.autocommit:
+                raise
+            return execute(query, params)
+
+    def _prepare(self, conn, query, params, statement, execute):
+        rewritten = rewrite(query, params)
+        if rewritten is None:
+            statement.name = False
+            return
+
+        body, arguments = rewritten
+        self.counter += 1
+        name = "ciptools_{}".format(self.counter)
+
+        # a failed PREPARE would ruin the transaction that it is in
+        savepoint = not conn.autocommit
+        try:
+            if savepoint:
+                execute("SAVEPOINT ciptools_prepare")
+            execute("PREPARE {} AS {}".format(name, body))
+            if savepoint:
+                execute("RELEASE SAVEPOINT ciptools_prepare")
+        except psycopg2.Error as e:
+            logger.debug("could not prepare statement, it will not be prepared: {}".format(e))
+            statement.name = False
+            if savepoint:
+                execute("ROLLBACK TO SAVEPOINT ciptools_prepare")
+            return
+
+        statement.name = name
+        statement.execute = "EXECUTE {}{}".format(name, " ({})".format(arguments) if arguments else "")
+
+    def _evict(self, execute):
+        while len(self.statements) > self.size:
+            _, statement = self.statements.popitem(last=False)
+            if statement.name:
+                execute("DEALLOCATE {}".format(statement.name))
+
+
+def rewrite(query: str, params):
+    """Rewrite a query that uses psycopg2 placeholders for PREPARE.
+
+    Returns the body of the PREPARE statement with numbered parameters and the
+    argument list for EXECUTE with psycopg2 placeholders, or None if the
+    placeholders don't match the parameters.
+    """
+    named = isinstance(params, Mapping)
+    numbers = {}
+    arguments = []
+
+    def replace(match):
+        escaped, positional, name = match.groups()
+        if escaped:
+            return "%"
+        if bool(positional) == named:
+            raise ValueError("placeholders don't match parameters")
+        if named:
+            if name not in numbers:
+                numbers[name] = len(numbers) + 1
+                arguments.append("%({})s".format(name))
+            return "${}".format(numbers[name])
+        arguments.append("%s")
+        return "${}".format(len(arguments))
+
+    try:
+        body = PLACEHOLDER.sub(replace, query)
+    except ValueError:
+        return None
+
+    if not named and len(arguments) != len(params):
+        return None
+
+    # the body is sent without parameters so psycopg2 leaves any "%" alone
+    return body, ", ".join(arguments)
+
+
+def attach(conn, size: int = 100, threshold: int = 5):
+    """Give a connection a statement cache if it doesn't already have one."""
+    if conn not in _caches:
+        _caches[conn] = StatementCache(size, threshold)
+    return _caches[conn]
+
+
+def forget(conn):
+    """Drop a connection's statement cache, for example when it is closed."""
+    _caches.pop(conn, None)
+
+
+class PreparingCursorMixin:
+    def execute(self, query, vars=None):
+        cache = _caches.get(self.connection)
+        if cache is None or self.name is not None:
+            return super().execute(query, vars)
+        return cache.execute(self.connection, query, vars, super().execute)
+
+
+@functools.lru_cache(maxsize=None)
+def cursor_class(base):
+    """Return a subclass of the cursor class *base* that prepares statements."""
+    return type("Preparing{}".format(base.__name__), (PreparingCursorMixin, base), {})
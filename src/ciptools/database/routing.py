@@ -0,0 +1,139 @@
+"""Read Replica Routing
+
+The pool based DatabaseClient can be given read replicas along with the
+primary. Each replica gets a connection pool of its own and read-only work is
+spread across them:
+
+    db = DatabaseClient(
+        host="mars.lab.cip.uw.edu",
+        database="election2020",
+        replicas=["mars-replica1.lab.cip.uw.edu", "mars-replica2.lab.cip.uw.edu"],
+    )
+
+    # this goes to a replica
+    with db.conn(readonly=True) as conn:
+        ...
+
+    # so do these, unless they're in a transaction on the primary
+    for row in db.stream("SELECT id FROM tweets"):
+        ...
+
+Replicas may be given as host names or as dicts of connection arguments that
+replace the primary's. There are two ways to pick a replica:
+
+    "least_outstanding" -- the replica with the fewest connections checked out
+                           right now. this is the default.
+    "round_robin"       -- each replica in turn.
+
+A replica that can't give out a connection is ejected and the primary, or
+another replica, is used instead. Once *retry_interval* seconds have gone by
+the next read tries that replica again, checking the connection with
+"SELECT 1" first, and if it works the replica is back in. If the replica has
+no connection to spare for the check then it waits another *retry_interval*
+seconds. If there are no replicas that can be used then reads go to the
+primary.
+
+Replicas lag behind the primary so only send work to them that doesn't mind
+reading data that might be a little out of date.
+
+"""
+
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+LEAST_OUTSTANDING = "least_outstanding"
+ROUND_ROBIN = "round_robin"
+BALANCERS = (LEAST_OUTSTANDING, ROUND_ROBIN)
+
+
+class Replica:
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+
+        # how many connections are checked out from this replica, when it was
+        # ejected, if it is, and whether someone is checking if it's back
+        self.outstanding = 0
+        self.ejected_at = None
+        self.probing = False
+
+    @property
+    def healthy(self) -> bool:
+        return self.ejected_at is None
+
+
+class Router:
+    def __init__(self, replicas, balance: str = LEAST_OUTSTANDING, retry_interval: float = 30.0):
+        if balance not in BALANCERS:
+            raise ValueError("balance must be one of: {}".format(", ".join(BALANCERS)))
+
+        self.replicas = list(replicas)
+        self.balance = balance
+        self.retry_interval = retry_interval
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def choose(self, exclude=()):
+        """Return the replica to use next and whether it's being probed.
+
+        Returns (None, False) when there aren't any replicas that can be used.
+        The replica must be given back with "release", "eject" or "admit".
+        """
+        now = time.monotonic()
+        with self._lock:
+            # an ejected replica gets one try once it has waited long enough
+            for replica in self.replicas:
+                if replica in exclude or replica.healthy or replica.probing:
+                    continue
+                if now - replica.ejected_at >= self.retry_interval:
+                    replica.probing = True
+                    replica.outstanding += 1
+                    return replica, True
+
+            healthy = [replica for replica in self.replicas if replica.healthy and replica not in exclude]
+            if not healthy:
+                return None, False
+
+            if self.balance == ROUND_ROBIN:
+                replica = healthy[next(self._turn) % len(healthy)]
+            else:
+                replica = min(healthy, key=lambda r: r.outstanding)
+            replica.outstanding += 1
+            return replica, False
+
+    def release(self, replica):
+        with self._lock:
+            replica.outstanding -= 1
+
+            # a probe that gave up without finding out whether the replica
+            # works, like when its pool was busy, is tried again later
+            if replica.probing:
+                replica.probing = False
+                replica.ejected_at = time.monotonic()
+
+    def eject(self, replica, error=None):
+        with self._lock:
+            replica.outstanding -= 1
+            replica.probing = False
+            if replica.healthy:
+                logger.warning("ejecting read replica {}: {}".format(replica.name, error))
+            replica.ejected_at = time.monotonic()
+
+    def admit(self, replica):
+        # called after a probe works. the replica stays checked out.
+        with self._lock:
+            replica.probing = False
+            if not replica.healthy:
+                logger.info("read replica {} is back".format(replica.name))
+            replica.ejected_at = None
+
+    def stats(self):
+        with self._lock:
+            return [
+                {"name": replica.name, "healthy": replica.healthy, "outstanding": replica.outstanding}
+                for replica in self.replicas
+            ]
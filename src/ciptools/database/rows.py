@@ -0,0 +1,56 @@
+"""Row Types
+
+Connections made by ciptools return rows as DictRow objects by default, which
+can be used both like a list and like a dict. That is convenient but it costs
+a lot more than a plain tuple, both in time and in memory, for every row that
+is fetched. The row type can be chosen when making a client and changed for a
+single connection or query:
+
+    db = DatabaseClient(host="mars.lab.cip.uw.edu", row_type="tuple")
+
+    with db.conn(row_type="namedtuple") as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id, text FROM tweets LIMIT 1")
+            print(cur.fetchone().text)
+
+These are the row types:
+
+* dict        -- DictRow from psycopg2.extras.DictCursor. This is the default.
+* tuple       -- plain tuples. This is the cheapest.
+* namedtuple  -- a namedtuple class made for each set of column names. The
+                 classes are cached so making them is only paid for once.
+* realdict    -- a real dict from psycopg2.extras.RealDictCursor.
+
+A cursor class may also be given instead of a name. Either way it only sets
+the default for the connection so "conn.cursor(cursor_factory=...)" still
+works like it always has.
+
+"""
+
+import psycopg2.extensions
+import psycopg2.extras
+
+ROW_DICT = "dict"
+ROW_TUPLE = "tuple"
+ROW_NAMEDTUPLE = "namedtuple"
+ROW_REALDICT = "realdict"
+
+CURSOR_FACTORIES = {
+    ROW_DICT: psycopg2.extras.DictCursor,
+    ROW_TUPLE: psycopg2.extensions.cursor,
+    ROW_NAMEDTUPLE: psycopg2.extras.NamedTupleCursor,
+    ROW_REALDICT: psycopg2.extras.RealDictCursor,
+}
+
+
+def cursor_factory(row_type):
+    """Return the cursor class for a row type name or cursor class."""
+    if isinstance(row_type, type) and issubclass(row_type, psycopg2.extensions.cursor):
+        return row_type
+
+    try:
+        return CURSOR_FACTORIES[row_type]
+    except (KeyError, TypeError):
+        raise ValueError("row type must be one of {} or a cursor class, got {!r}".format(
+            ", ".join(CURSOR_FACTORIES), row_type,
+        )) from None
@@ -0,0 +1,125 @@
+"""Connection Pool Statistics
+
+Pools record what they are doing as events. Every event increments a counter
+with the same name and events that come with a value, usually a duration in
+seconds, are also added to a histogram with the same name. A snapshot of
+everything can be taken at any time and callbacks can be registered to hear
+about events as they happen, for example to forward them to a metrics system:
+
+    db = DatabaseClient(host="mars.lab.cip.uw.edu")
+    db.add_hook("checkout", lambda event, value: statsd.timing("db.wait", value))
+    print(db.stats())
+
+Histograms use fixed, exponentially sized buckets so recording a value is a
+binary search and an increment. Percentiles from a snapshot are approximate:
+they are the upper bound of the bucket that the percentile falls in.
+
+"""
+
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# bucket upper bounds in seconds, from 50 microseconds doubling up to about
+# three and a half minutes. anything larger lands in the last bucket.
+DEFAULT_BOUNDS = tuple(0.00005 * 2 ** i for i in range(23))
+
+
+class Histogram:
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p: float) -> float:
+        if not self.count:
+            return 0.0
+
+        rank = p * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def merge(self, other: "Histogram") -> "Histogram":
+        # a new histogram with everything in both. they must have the same
+        # bounds.
+        merged = Histogram(self.bounds)
+        merged.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        merged.count = self.count + other.count
+        merged.total = self.total + other.total
+        merged.max = max(self.max, other.max)
+        return merged
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(0.50),
+            "p90": self.percentile(0.90),
+            "p99": self.percentile(0.99),
+            "buckets": list(zip(self.bounds + (float("inf"),), self.buckets)),
+        }
+
+
+class PoolStats:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.hooks = {}
+        self._lock = threading.Lock()
+
+    def add_hook(self, event: str, callback):
+        """Call *callback(event, value)* every time *event* is recorded.
+
+        Callbacks are called in the thread that recorded the event so they
+        should be quick. Exceptions raised by callbacks are logged and ignored.
+        """
+        with self._lock:
+            self.hooks.setdefault(event, []).append(callback)
+
+    def record(self, event: str, value: float = None):
+        with self._lock:
+            self.counters[event] = self.counters.get(event, 0) + 1
+            if value is not None:
+                histogram = self.histograms.get(event)
+                if histogram is None:
+                    histogram = self.histograms[event] = Histogram()
+                histogram.observe(value)
+            hooks = self.hooks.get(event)
+
+        if hooks:
+            for hook in hooks:
+                try:
+                    hook(event, value)
+                except Exception as e:
+                    logger.warning("pool statistics hook for {} failed: {}".format(event, e))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+            }
+
+    def reset(self):
+        # used after a fork. the counters belong to the parent but the hooks
+        # are still wanted. the lock might have been held when we forked.
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
@@ -0,0 +1,70 @@
+"""Streaming Query Results
+
+psycopg2 normally loads the entire result set of a query into memory. A named
+(server-side) cursor fetches the results from the server a few rows at a time
+instead, so memory use stays the same no matter how many rows there are. The
+clients have a "stream" method that uses this and takes care of getting a
+connection and a transaction for the cursor:
+
+    for row in db.stream("SELECT id, text FROM tweets WHERE created_at > %s", (since,)):
+        print(row["id"])
+
+    # or get lists of rows instead of one row at a time
+    for rows in db.stream("SELECT id, text FROM tweets", itersize=10000, batches=True):
+        process(rows)
+
+Server-side cursors only exist inside a transaction. When "stream" is called
+inside a transaction it uses that transaction. Otherwise it holds a connection
+and a transaction of its own until the iterator is exhausted or closed.
+
+"""
+
+import uuid
+from contextlib import contextmanager
+
+import psycopg2
+
+
+@contextmanager
+def named_cursor(conn, itersize: int = 2000, cursor_factory=None):
+    """Open a server-side cursor and close it when the block finishes.
+
+    The connection must already be in a transaction.
+    """
+    name = "ciptools_{}".format(uuid.uuid4().hex)
+    if cursor_factory is None:
+        cur = conn.cursor(name=name)
+    else:
+        cur = conn.cursor(name=name, cursor_factory=cursor_factory)
+
+    try:
+        cur.itersize = itersize
+        yield cur
+    finally:
+        # closing a named cursor tells the server to close it too. if the
+        # transaction is already gone then so is the cursor.
+        try:
+            if not conn.closed:
+                cur.close()
+        except psycopg2.Error:
+            pass
+
+
+def stream(conn, query, params=None, itersize: int = 2000, batches: bool = False, cursor_factory=None):
+    """Yield rows, or lists of rows, from a server-side cursor.
+
+    The connection must already be in a transaction. *itersize* is how many
+    rows are fetched from the server at a time and is also the size of each
+    batch when *batches* is set.
+    """
+    with named_cursor(conn, itersize, cursor_factory) as cur:
+        cur.execute(query, params)
+
+        if batches:
+            while True:
+                rows = cur.fetchmany(itersize)
+                if not rows:
+                    break
+                yield rows
+        else:
+            yield from cur
@@ -0,0 +1,115 @@
+"""Nested Transactions
+
+Code that needs a transaction usually asks for one without knowing whether
+whoever called it is already in one. Both clients notice when a thread asks
+for a transaction while it is already in one and give it the same connection
+with a savepoint instead of a second connection:
+
+    with db.transaction() as conn:
+        insert_account(conn)
+
+        try:
+            # this is the same connection. if anything in here fails then
+            # only what happened in here is rolled back.
+            with db.transaction() as nested:
+                insert_tweets(nested)
+        except psycopg2.IntegrityError:
+            pass
+
+    # everything is committed here, when the outermost transaction finishes
+
+A nested transaction doesn't commit anything. It is released into the
+transaction around it when it finishes and rolled back to where it started if
+it raises an exception. Nested transactions use the connection the way the
+outermost transaction set it up, so arguments like *row_type* and *isolation*
+only count for the outermost one.
+
+Transactions at REPEATABLE READ or SERIALIZABLE can fail because of what
+other transactions did at the same time, and deadlocks can happen at any
+level. Neither is a bug and the usual fix is to try again. The pool based
+DatabaseClient does that with "run_in_transaction":
+
+    def move_tweets(conn):
+        with conn.cursor() as cur:
+            cur.execute("UPDATE tweets SET account_id = %s WHERE account_id = %s", (new, old))
+            return cur.rowcount
+
+    moved = db.run_in_transaction(move_tweets, isolation="serializable", max_attempts=5)
+
+The function gets the connection and is called again in a new transaction,
+after a short random wait that gets longer each time, when the transaction
+fails with a serialization failure (SQLSTATE 40001) or a deadlock (40P01).
+Anything else, or running out of attempts, raises the error. The function
+should only touch the database, since whatever else it does will happen more
+than once. Inside another transaction it is just a nested transaction and
+isn't retried because the outermost transaction is the one that has to start
+over.
+
+"""
+
+import logging
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+# savepoints with the same name stack up and each RELEASE or ROLLBACK TO goes
+# to the most recent one, so one name works at any depth
+SAVEPOINT = "SAVEPOINT ciptools_transaction"
+RELEASE = "RELEASE SAVEPOINT ciptools_transaction"
+ROLLBACK = "ROLLBACK TO SAVEPOINT ciptools_transaction"
+
+ISOLATION_LEVELS = {
+    "read committed": psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED,
+    "repeatable read": psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ,
+    "serializable": psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE,
+}
+
+# serialization_failure and deadlock_detected
+RETRYABLE = ("40001", "40P01")
+
+
+def isolation_level(isolation) -> int:
+    """Return the psycopg2 isolation level for a name like "repeatable read".
+
+    Underscores may be used instead of spaces and psycopg2's own constants
+    are returned as they are.
+    """
+    if isinstance(isolation, str):
+        level = ISOLATION_LEVELS.get(isolation.lower().replace("_", " "))
+        if level is not None:
+            return level
+    elif isolation in ISOLATION_LEVELS.values():
+        return isolation
+    raise ValueError("isolation must be one of: {}".format(", ".join(ISOLATION_LEVELS)))
+
+
+def is_retryable(error) -> bool:
+    """Whether a transaction that failed with *error* should be tried again."""
+    if isinstance(error, (psycopg2.errors.SerializationFailure, psycopg2.errors.DeadlockDetected)):
+        return True
+    return isinstance(error, psycopg2.Error) and error.pgcode in RETRYABLE
+
+
+@contextmanager
+def savepoint(conn):
+    """Run the block inside a savepoint on *conn*, which must be in a transaction."""
+    with conn.cursor() as cur:
+        cur.execute(SAVEPOINT)
+
+    try:
+        yield conn
+    except BaseException:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(ROLLBACK)
+                cur.execute(RELEASE)
+        except psycopg2.Error as e:
+            logger.warning("could not roll back to savepoint: {}".format(e))
+        raise
+
+    with conn.cursor() as cur:
+        cur.execute(RELEASE)
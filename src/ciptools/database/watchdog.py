@@ -0,0 +1,142 @@
+"""Query Deadlines
+
+A query that runs for much longer than it should holds on to its connection
+the whole time and there is nothing the pool can do to get it back. The pool
+based DatabaseClient can give a checkout a deadline:
+
+    # give up on whatever this is doing after 30 seconds
+    with db.conn(deadline=30) as conn:
+        ...
+
+    with db.transaction(deadline=5) as conn:
+        ...
+
+Two things happen when a checkout has a deadline. The connection's
+statement_timeout is set to the deadline so that the server itself stops any
+one query that runs longer than that. And a watchdog thread, shared by every
+checkout in the process, cancels whatever the connection is running once the
+deadline passes, so that a lot of quick queries can't add up to more than the
+deadline either. Either way the query fails with QueryCanceled, the
+transaction is rolled back, statement_timeout is put back and the connection
+is returned to the pool ready for the next checkout.
+
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+
+class Watch:
+    __slots__ = ("conn", "when", "fired", "cancelled", "_watchdog", "_lock")
+
+    def __init__(self, watchdog, conn, when):
+        self.conn = conn
+        self.when = when
+        self.fired = False
+        self.cancelled = False
+        self._watchdog = watchdog
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """Stop watching the connection.
+
+        Once this returns the connection won't be cancelled, so it is safe to
+        give it to someone else.
+        """
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+        self._watchdog._forget()
+
+    def _fire(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.fired = True
+            logger.warning("deadline passed, cancelling query")
+            try:
+                self.conn.cancel()
+            except psycopg2.Error as e:
+                logger.warning("could not cancel query: {}".format(e))
+
+
+class Watchdog:
+    def __init__(self):
+        # watches ordered by when they go off. cancelled watches stay in here
+        # until they get to the front or there are too many of them.
+        self._heap = []
+        self._cancelled = 0
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def watch(self, conn, seconds: float) -> Watch:
+        """Cancel whatever *conn* is running in *seconds* unless told not to."""
+        watch = Watch(self, conn, time.monotonic() + seconds)
+        with self._condition:
+            heapq.heappush(self._heap, (watch.when, next(self._counter), watch))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ciptools-watchdog", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return watch
+
+    def _forget(self):
+        with self._condition:
+            self._cancelled += 1
+            if self._cancelled > 64 and self._cancelled > len(self._heap) // 2:
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def _run(self):
+        with self._condition:
+            while True:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                    self._cancelled = max(0, self._cancelled - 1)
+
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                remaining = self._heap[0][0] - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+
+                # cancelling talks to the server so don't hold everyone else
+                # up while that happens
+                _, _, watch = heapq.heappop(self._heap)
+                self._condition.release()
+                try:
+                    watch._fire()
+                finally:
+                    self._condition.acquire()
+
+
+# the watchdog for the whole process
+_watchdog = Watchdog()
+
+
+def _reset_watchdog():
+    # the watchdog thread doesn't survive a fork and the connections it was
+    # watching belong to the parent
+    global _watchdog
+    _watchdog = Watchdog()
+
+
+os.register_at_fork(after_in_child=_reset_watchdog)
+
+
+def watch(conn, seconds: float) -> Watch:
+    return _watchdog.watch(conn, seconds)
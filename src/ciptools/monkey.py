@@ -4,10 +4,12 @@ import sys
 def patch():
     eventlet_patch()
     if is_eventlet_patched():
+        patch_psycopg()
         return True
 
     gevent_patch()
     if is_gevent_patched():
+        patch_psycopg()
         return True
 
     return False
@@ -57,3 +59,64 @@ def is_gevent_patched():
         return False
     else:
         return bool(gevent.monkey.saved)
+
+
+def patch_psycopg():
+    # psycopg2 talks to the database from inside libpq so monkey patching the
+    # socket module does nothing for it and every query blocks the hub. psycopg2
+    # can call us back whenever it would block, though, and from there we can
+    # yield to the hub. this is safe to call more than once and returns true if
+    # a callback is installed.
+    #
+    # psycopg2 refuses to COPY while a callback is installed so afterwards
+    # copy_rows and bulk_upsert raise NotSupportedError. use insert_many, or
+    # parallel_copy, whose worker processes take the callback off again.
+    try:
+        import psycopg2.extensions
+    except ImportError:
+        return False
+
+    if is_eventlet_patched():
+        callback = eventlet_wait_callback
+    elif is_gevent_patched():
+        callback = gevent_wait_callback
+    else:
+        return False
+
+    if psycopg2.extensions.get_wait_callback() is not callback:
+        psycopg2.extensions.set_wait_callback(callback)
+
+    return True
+
+
+def eventlet_wait_callback(conn, timeout=-1):
+    # noinspection PyUnresolvedReferences
+    from eventlet.hubs import trampoline
+
+    _wait_callback(
+        conn,
+        lambda fd: trampoline(fd, read=True),
+        lambda fd: trampoline(fd, write=True),
+    )
+
+
+def gevent_wait_callback(conn, timeout=None):
+    # noinspection PyUnresolvedReferences
+    from gevent.socket import wait_read, wait_write
+
+    _wait_callback(conn, wait_read, wait_write)
+
+
+def _wait_callback(conn, wait_read, wait_write):
+    import psycopg2.extensions
+
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            wait_read(conn.fileno())
+        elif state == psycopg2.extensions.POLL_WRITE:
+            wait_write(conn.fileno())
+        else:
+            raise psycopg2.OperationalError("bad state from poll: {}".format(state))
@@ -1,9 +1,22 @@
+import datetime
+import json
 import re
 from io import TextIOBase
 
 # compile this for performance later in the module
 NULL_TERMINATOR = re.compile(r"(?<!\\)\\u0000")
 
+# characters that must be escaped in the text format used by COPY. postgres
+# can't store null characters in text at all so those are just removed. the
+# backslash has to come first.
+COPY_ESCAPES = (
+    ("\\", "\\\\"),
+    ("\t", "\\t"),
+    ("\n", "\\n"),
+    ("\r", "\\r"),
+    ("\x00", ""),
+)
+
 
 # this function was taken from here: https://hakibenita.com/fast-load-data-python-postgresql
 class StringIteratorIO(TextIOBase):
@@ -50,6 +63,70 @@ def replace_null_terminators(text: str, replacement: str = r""):
     return NULL_TERMINATOR.sub(replacement, text) if text is not None else None
 
 
+def copy_escape(value, replace_nulls: bool = True) -> str:
+    """Format a value for a row in PostgreSQL's COPY text format.
+
+    None becomes NULL, bytes are written in bytea hex format, dicts are
+    written as JSON, lists and tuples are written as arrays and everything
+    else is converted with str(). If *replace_nulls* is set then escaped null
+    terminators are removed, which is what you want when loading JSON from an
+    API into a jsonb column.
+    """
+    if value is None:
+        return "\\N"
+
+    # the most common types don't need any escaping
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+
+    text = _copy_text(value)
+    if replace_nulls and "\\u0000" in text:
+        text = replace_null_terminators(text)
+
+    # most strings don't have anything that needs escaping and checking for
+    # each character is much faster than always replacing them
+    for character, replacement in COPY_ESCAPES:
+        if character in text:
+            text = text.replace(character, replacement)
+    return text
+
+
+def copy_line(values, replace_nulls: bool = True) -> str:
+    """Format a row of values as one line of PostgreSQL's COPY text format."""
+    return "\t".join([copy_escape(value, replace_nulls) for value in values]) + "\n"
+
+
+def _copy_text(value) -> str:
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "\\x" + bytes(value).hex()
+    if isinstance(value, dict):
+        return json.dumps(value)
+    if isinstance(value, (list, tuple)):
+        return _array_literal(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+def _array_literal(values) -> str:
+    # array elements are quoted and escaped for the array parser. the whole
+    # literal is escaped again for COPY by the caller.
+    elements = []
+    for value in values:
+        if value is None:
+            elements.append("NULL")
+        elif isinstance(value, (list, tuple)):
+            elements.append(_array_literal(value))
+        else:
+            text = _copy_text(value)
+            elements.append('"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"')
+    return "{" + ",".join(elements) + "}"
+
+
 def extract_text_from_html(text: str):
     from html.parser import HTMLParser
 
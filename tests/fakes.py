@@ -0,0 +1,168 @@
+import os
+import socket
+import threading
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extensions import (POLL_OK, TRANSACTION_STATUS_IDLE,
+                                 TRANSACTION_STATUS_INTRANS,
+                                 TRANSACTION_STATUS_UNKNOWN)
+
+
+class FakeInfo:
+    def __init__(self, conn):
+        self.conn = conn
+
+    @property
+    def transaction_status(self):
+        if self.conn.closed:
+            return TRANSACTION_STATUS_UNKNOWN
+        if self.conn.in_transaction:
+            return TRANSACTION_STATUS_INTRANS
+        return TRANSACTION_STATUS_IDLE
+
+
+class FakeCursor:
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.connection = conn
+        self.name = name
+        self.rowcount = -1
+        self.itersize = 2000
+        self.rows = []
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def execute(self, query, params=None):
+        if self.conn.closed or self.conn.broken:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        if self.name is not None and self.conn.autocommit:
+            raise psycopg2.ProgrammingError("can't use a named cursor outside of transactions")
+        self.conn.queries.append(query)
+        if any(marker in query for marker in self.conn.fail):
+            raise psycopg2.IntegrityError("duplicate key value violates unique constraint")
+        self.rows = list(self.conn.results)
+        # a named cursor only declares itself when it is executed. the
+        # columns aren't known until the first fetch.
+        self.description = self.conn.description if self.name is None else None
+        self.rowcount = len(self.rows)
+        if query in ("COMMIT", "ROLLBACK"):
+            self.conn.in_transaction = False
+        elif query == "BEGIN" or not self.conn.autocommit:
+            self.conn.in_transaction = True
+
+    def mogrify(self, query, params=None):
+        if isinstance(query, str):
+            query = query.encode()
+        if params is None:
+            return query
+        return query % tuple(repr(param).encode() for param in params)
+
+    def _fetched(self):
+        if self.name is not None:
+            self.description = self.conn.description
+
+    def fetchone(self):
+        self._fetched()
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size=None):
+        self._fetched()
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        self._fetched()
+        rows, self.rows = self.rows, []
+        return rows
+
+    def __iter__(self):
+        self._fetched()
+        while self.rows:
+            yield self.rows.pop(0)
+
+    def copy_expert(self, query, file, size=8192):
+        if psycopg2.extensions.get_wait_callback() is not None:
+            raise psycopg2.ProgrammingError("copy_expert cannot be used with an asynchronous callback.")
+        self.execute(query)
+        while True:
+            data = file.read(size)
+            if not data:
+                break
+            self.conn.copied.append(data)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """Stands in for a psycopg2 connection without talking to a database."""
+
+    def __init__(self, *args, **kwargs):
+        self.kwargs = kwargs
+        self.closed = 0
+        self.broken = False
+        self.autocommit = bool(kwargs.get("async_"))
+        self.in_transaction = False
+        self.queries = []
+        self.copied = []
+        self.results = []
+        self.fail = ()
+        self.encoding = "UTF8"
+        self.description = None
+        self.info = FakeInfo(self)
+
+        # like a real connection, closing it tells the server goodbye. the
+        # "server" end of the socket lets tests see whether that happened.
+        self.socket, self.server = socket.socketpair()
+
+    def cursor(self, name=None, **kwargs):
+        return FakeCursor(self, name)
+
+    def commit(self):
+        self.in_transaction = False
+
+    def rollback(self):
+        if self.closed:
+            raise psycopg2.InterfaceError("connection already closed")
+        self.in_transaction = False
+
+    def poll(self):
+        return POLL_OK
+
+    def isexecuting(self):
+        return False
+
+    def cancel(self):
+        pass
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        if not self.closed:
+            os.write(self.socket.fileno(), b"X")
+            self.socket.close()
+        self.closed = 1
+
+
+class FakeConnector:
+    """Replaces psycopg2.connect and optionally makes connecting slow."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        if self.delay:
+            threading.Event().wait(self.delay)
+        conn = FakeConnection(*args, **kwargs)
+        with self.lock:
+            self.connections.append(conn)
+        return conn
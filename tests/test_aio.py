@@ -0,0 +1,92 @@
+import asyncio
+from unittest import TestCase, mock
+
+from ciptools.database.aio import AsyncConnectionPool, AsyncDatabaseClient
+from ciptools.database.pool import PoolError
+from tests.fakes import FakeConnector
+
+
+class AsyncConnectionPoolTests(TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reuse_connection(self):
+        async def run():
+            pool = AsyncConnectionPool(1, 2, False)
+            conn = await pool.getconn()
+            await pool.putconn(conn)
+            self.assertIs(await pool.getconn(), conn)
+            self.assertEqual(self.connector.connections[0].kwargs["async_"], True)
+
+        asyncio.run(run())
+
+    def test_exhausted(self):
+        async def run():
+            pool = AsyncConnectionPool(1, 1, False)
+            await pool.getconn()
+            with self.assertRaises(PoolError):
+                await pool.getconn(timeout=0.05)
+
+        asyncio.run(run())
+
+    def test_waiters_served_in_order(self):
+        async def run():
+            pool = AsyncConnectionPool(1, 1, False)
+            held = await pool.getconn()
+            served = []
+
+            async def worker(n):
+                conn = await pool.getconn(timeout=5)
+                served.append(n)
+                await asyncio.sleep(0)
+                await pool.putconn(conn)
+
+            tasks = []
+            for n in range(5):
+                tasks.append(asyncio.create_task(worker(n)))
+                await asyncio.sleep(0)
+
+            await pool.putconn(held)
+            await asyncio.gather(*tasks)
+            self.assertEqual(served, [0, 1, 2, 3, 4])
+            self.assertEqual(len(self.connector.connections), 1)
+
+        asyncio.run(run())
+
+    def test_many_tasks_small_pool(self):
+        async def run():
+            db = AsyncDatabaseClient(minconn=2, maxconn=4, retry=False)
+
+            peak = []
+
+            async def worker():
+                async with db.conn() as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute("SELECT 1")
+                    peak.append(sum(1 for c in self.connector.connections if not c.closed))
+                    await asyncio.sleep(0.001)
+
+            await asyncio.gather(*[worker() for _ in range(1000)])
+            self.assertLessEqual(max(peak), 4)
+            await db.close()
+
+        asyncio.run(run())
+
+    def test_transaction(self):
+        async def run():
+            db = AsyncDatabaseClient(minconn=1, maxconn=1, retry=False, ping="never")
+            async with db.transaction() as conn:
+                await conn.execute("INSERT 1")
+
+            with self.assertRaises(RuntimeError):
+                async with db.transaction() as conn:
+                    await conn.execute("INSERT 2")
+                    raise RuntimeError("nope")
+
+            queries = self.connector.connections[0].queries
+            self.assertEqual(queries, ["BEGIN", "INSERT 1", "COMMIT", "BEGIN", "INSERT 2", "ROLLBACK"])
+
+        asyncio.run(run())
@@ -0,0 +1,205 @@
+from unittest import TestCase, mock
+
+import ciptools.database
+from ciptools.database.batch import Batch, BatchError
+from ciptools.database.pool import DatabaseClient
+from tests.fakes import FakeConnection, FakeConnector
+
+
+class BatchTests(TestCase):
+    def setUp(self):
+        self.conn = FakeConnection()
+        self.conn.autocommit = False
+        self.addCleanup(self.conn.close)
+
+    def test_one_round_trip(self):
+        batch = Batch(self.conn)
+        batch.execute("UPDATE a SET x = %s", (1,))
+        batch.execute("UPDATE b SET y = %s", ("two",))
+        batch.execute_values("INSERT INTO c VALUES %s", [(1, 2), (3, 4)])
+        self.assertEqual(self.conn.queries, [])
+
+        batch.flush()
+        self.assertEqual(self.conn.queries, [
+            b"SAVEPOINT ciptools_batch_start;\n"
+            b"SAVEPOINT ciptools_batch;\n"
+            b"UPDATE a SET x = 1;\n"
+            b"UPDATE b SET y = 'two';\n"
+            b"INSERT INTO c VALUES (1,2),(3,4)",
+        ])
+        self.assertEqual(batch.round_trips, 1)
+
+    def test_pages(self):
+        batch = Batch(self.conn, max_bytes=40)
+        batch.execute_values("INSERT INTO c VALUES %s", [(i,) for i in range(10)], page_size=3)
+        batch.flush()
+
+        # four pages that were sent two at a time because of max_bytes
+        self.assertEqual(self.conn.queries, [
+            b"SAVEPOINT ciptools_batch_start;\n"
+            b"SAVEPOINT ciptools_batch;\n"
+            b"INSERT INTO c VALUES (0),(1),(2);\n"
+            b"INSERT INTO c VALUES (3),(4),(5)",
+            b"RELEASE SAVEPOINT ciptools_batch;\n"
+            b"SAVEPOINT ciptools_batch;\n"
+            b"INSERT INTO c VALUES (6),(7),(8);\n"
+            b"INSERT INTO c VALUES (9)",
+        ])
+
+    def test_fetch(self):
+        self.conn.results = [(5,)]
+        self.conn.description = [("count",)]
+
+        batch = Batch(self.conn)
+        first = batch.execute("UPDATE a SET x = 1")
+        count = batch.execute("SELECT count(*) FROM a", fetch=True)
+        last = batch.execute("UPDATE a SET x = 2")
+        batch.flush()
+
+        # asking for results ends the round trip
+        self.assertEqual(len(self.conn.queries), 2)
+        self.assertEqual(count.rows, [(5,)])
+        self.assertEqual(count.rowcount, 1)
+        self.assertIsNone(first.rows)
+        self.assertTrue(last.done)
+
+    def test_error_attribution(self):
+        self.conn.fail = (b"bad",)
+
+        batch = Batch(self.conn)
+        batch.execute("INSERT INTO a VALUES (1)")
+        batch.execute("INSERT INTO a VALUES ('bad')")
+        batch.execute("INSERT INTO a VALUES (3)")
+        with self.assertRaises(BatchError) as context:
+            batch.flush()
+
+        self.assertEqual(context.exception.index, 1)
+        self.assertEqual(context.exception.query, b"INSERT INTO a VALUES ('bad')")
+        self.assertEqual(self.conn.queries[1:], [
+            b"ROLLBACK TO SAVEPOINT ciptools_batch",
+            b"INSERT INTO a VALUES (1)",
+            b"INSERT INTO a VALUES ('bad')",
+        ])
+
+    def test_finish(self):
+        batch = Batch(self.conn)
+        batch.execute("UPDATE a SET x = 1")
+        batch.finish()
+
+        # the savepoints are let go of in the last round trip
+        self.assertEqual(self.conn.queries, [
+            b"SAVEPOINT ciptools_batch_start;\n"
+            b"SAVEPOINT ciptools_batch;\n"
+            b"UPDATE a SET x = 1;\n"
+            b"RELEASE SAVEPOINT ciptools_batch_start",
+        ])
+        self.assertEqual(batch.round_trips, 1)
+
+    def test_finish_after_fetch(self):
+        self.conn.results = [(5,)]
+        self.conn.description = [("count",)]
+
+        batch = Batch(self.conn)
+        count = batch.execute("SELECT count(*) FROM a", fetch=True)
+        batch.finish()
+
+        # releasing can't come after the results that were asked for
+        self.assertEqual(count.rows, [(5,)])
+        self.assertEqual(self.conn.queries[-1], b"RELEASE SAVEPOINT ciptools_batch_start")
+        self.assertEqual(batch.round_trips, 2)
+
+    def test_finish_nothing_sent(self):
+        Batch(self.conn).finish()
+        self.assertEqual(self.conn.queries, [])
+
+    def test_rollback(self):
+        batch = Batch(self.conn)
+        batch.execute("UPDATE a SET x = 1")
+        batch.rollback()
+        self.assertEqual(self.conn.queries, [])
+
+        # what was already sent is undone and what is queued is dropped
+        batch.execute("SELECT 1", fetch=True)
+        batch.execute("UPDATE a SET x = 2")
+        batch.rollback()
+        batch.flush()
+        self.assertEqual(self.conn.queries[1:], [b"ROLLBACK TO SAVEPOINT ciptools_batch_start"])
+
+
+class ClientBatchTests(TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pool(self):
+        with DatabaseClient(minconn=1, maxconn=1, retry=False, ping="never") as db:
+            with db.batch() as batch:
+                batch.execute("UPDATE a SET x = 1")
+                self.assertEqual(self.connector.connections[0].queries, [])
+
+            conn = self.connector.connections[0]
+            self.assertIn(b"UPDATE a SET x = 1", conn.queries[-1])
+            self.assertFalse(conn.in_transaction)
+
+            # nothing is sent if the block fails
+            with self.assertRaises(ValueError):
+                with db.batch() as batch:
+                    batch.execute("UPDATE a SET x = 2")
+                    raise ValueError()
+            self.assertNotIn(b"x = 2", b"".join(q for q in conn.queries if isinstance(q, bytes)))
+
+    def test_pool_rollback_inside_transaction(self):
+        with DatabaseClient(minconn=1, maxconn=1, retry=False, ping="never") as db:
+            with db.transaction() as conn:
+                with self.assertRaises(ValueError):
+                    with db.batch() as batch:
+                        batch.execute("SELECT 1", fetch=True)
+                        batch.execute("UPDATE a SET x = 1")
+                        raise ValueError()
+
+                # what was sent is rolled back and the transaction carries on
+                self.assertEqual(conn.queries[-1], b"ROLLBACK TO SAVEPOINT ciptools_batch_start")
+                self.assertTrue(conn.in_transaction)
+                with conn.cursor() as cur:
+                    cur.execute("UPDATE a SET x = 2")
+
+    def test_pool_batches_inside_transaction(self):
+        # every batch lets go of its savepoints so a transaction with a lot of
+        # batches in it doesn't pile up subtransactions
+        with DatabaseClient(minconn=1, maxconn=1, retry=False, ping="never") as db:
+            with db.transaction() as conn:
+                for i in range(3):
+                    with db.batch() as batch:
+                        batch.execute("UPDATE a SET x = %s", (i,))
+
+        statements = b";\n".join(conn.queries).split(b";\n")
+        self.assertEqual(statements.count(b"SAVEPOINT ciptools_batch_start"), 3)
+        self.assertEqual(statements.count(b"RELEASE SAVEPOINT ciptools_batch_start"), 3)
+        self.assertEqual(len(conn.queries), 3)
+
+    def test_legacy(self):
+        self.addCleanup(ciptools.database.connections.clear)
+        self.addCleanup(ciptools.database.last_used.clear)
+
+        db = ciptools.database.DatabaseClient(client_id="batch", retry=False, ping="never")
+        with db.batch() as batch:
+            batch.execute("UPDATE a SET x = 1")
+
+        conn = db.conn()
+        self.assertTrue(conn.autocommit)
+        self.assertFalse(conn.in_transaction)
+        self.assertIn(b"UPDATE a SET x = 1", conn.queries[-1])
+
+    def test_legacy_rollback_inside_transaction(self):
+        self.addCleanup(ciptools.database.connections.clear)
+        self.addCleanup(ciptools.database.last_used.clear)
+
+        db = ciptools.database.DatabaseClient(client_id="batch", retry=False, ping="never")
+        with db.transaction() as conn:
+            with self.assertRaises(ValueError):
+                with db.batch() as batch:
+                    batch.execute("SELECT 1", fetch=True)
+                    raise ValueError()
+            self.assertEqual(conn.queries[-1], b"ROLLBACK TO SAVEPOINT ciptools_batch_start")
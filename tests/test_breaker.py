@@ -0,0 +1,91 @@
+from unittest import TestCase, mock
+
+import psycopg2
+
+import ciptools.database
+from ciptools.database import breaker
+from tests.fakes import FakeConnector
+
+
+class CircuitBreakerTests(TestCase):
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch("time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_opens_after_failures(self):
+        circuit = breaker.CircuitBreaker(failures=3, reset_timeout=10.0)
+        for _ in range(2):
+            circuit.before()
+            circuit.failure()
+        self.assertEqual(circuit.state, breaker.CLOSED)
+
+        circuit.before()
+        circuit.failure()
+        self.assertEqual(circuit.state, breaker.OPEN)
+        with self.assertRaises(breaker.CircuitOpenError):
+            circuit.before()
+
+    def test_success_resets_count(self):
+        circuit = breaker.CircuitBreaker(failures=2)
+        circuit.failure()
+        circuit.success()
+        circuit.failure()
+        self.assertEqual(circuit.state, breaker.CLOSED)
+
+    def test_half_open_lets_one_attempt_through(self):
+        circuit = breaker.CircuitBreaker(failures=1, reset_timeout=10.0)
+        circuit.failure()
+
+        self.now += 10.0
+        circuit.before()
+        self.assertEqual(circuit.state, breaker.HALF_OPEN)
+        with self.assertRaises(breaker.CircuitOpenError):
+            circuit.before()
+
+        # the probe failed so wait again
+        circuit.failure()
+        self.assertEqual(circuit.state, breaker.OPEN)
+        with self.assertRaises(breaker.CircuitOpenError):
+            circuit.before()
+
+        # and this time it works
+        self.now += 10.0
+        circuit.before()
+        circuit.success()
+        self.assertEqual(circuit.state, breaker.CLOSED)
+        circuit.before()
+
+
+class RegistryBreakerTests(TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        for registry in (ciptools.database.connections, ciptools.database.last_used, ciptools.database.owners):
+            self.addCleanup(registry.clear)
+        self.addCleanup(breaker._breakers.clear)
+
+    def test_conn_stops_trying(self):
+        failing = mock.Mock(side_effect=psycopg2.OperationalError("could not connect to server"))
+        with mock.patch("psycopg2.connect", failing):
+            for _ in range(5):
+                with self.assertRaises(psycopg2.OperationalError):
+                    ciptools.database.conn(host="down.example.com", ping="never")
+            self.assertEqual(failing.call_count, 5)
+
+            with self.assertRaises(breaker.CircuitOpenError):
+                ciptools.database.conn(host="down.example.com", ping="never")
+            self.assertEqual(failing.call_count, 5)
+
+            # turning it off goes to the server anyway
+            with self.assertRaises(psycopg2.OperationalError) as raised:
+                ciptools.database.conn(host="down.example.com", ping="never", circuit_breaker=False)
+            self.assertNotIsInstance(raised.exception, breaker.CircuitOpenError)
+            self.assertEqual(failing.call_count, 6)
+
+        # other databases aren't affected
+        ciptools.database.conn(host="up.example.com", ping="never")
@@ -0,0 +1,168 @@
+import datetime
+from unittest import TestCase, mock
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extensions import Column
+from psycopg2.sql import Composable
+
+from ciptools.database.bulk import (PageSize, bulk_upsert, copy_rows,
+                                    execute_many)
+from ciptools.strings import copy_escape, copy_line
+from tests.fakes import FakeConnection
+
+
+class CopyTextTests(TestCase):
+    def test_escape(self):
+        self.assertEqual(copy_escape(None), "\\N")
+        self.assertEqual(copy_escape(1), "1")
+        self.assertEqual(copy_escape(1.5), "1.5")
+        self.assertEqual(copy_escape(True), "t")
+        self.assertEqual(copy_escape("a\tb\nc\rd\\e"), "a\\tb\\nc\\rd\\\\e")
+        self.assertEqual(copy_escape("\\N"), "\\\\N")
+        self.assertEqual(copy_escape(b"\x00\xff"), "\\\\x00ff")
+        self.assertEqual(copy_escape(datetime.date(2020, 11, 3)), "2020-11-03")
+        self.assertEqual(copy_escape({"a": "b"}), '{"a": "b"}')
+
+    def test_escape_nulls(self):
+        self.assertEqual(copy_escape("a\x00b"), "ab")
+        self.assertEqual(copy_escape('{"a": "b\\u0000"}'), '{"a": "b"}')
+        self.assertEqual(copy_escape('{"a": "b\\u0000"}', replace_nulls=False), '{"a": "b\\\\u0000"}')
+
+    def test_escape_arrays(self):
+        self.assertEqual(copy_escape([1, None, 3]), '{"1",NULL,"3"}')
+        self.assertEqual(copy_escape(["a\"b", "c\\d"]), '{"a\\\\"b","c\\\\\\\\d"}')
+        self.assertEqual(copy_escape([[1, 2], [3, 4]]), '{{"1","2"},{"3","4"}}')
+
+    def test_line(self):
+        self.assertEqual(copy_line([1, None, "x\ty"]), "1\t\\N\tx\\ty\n")
+
+    def test_copy_rows(self):
+        conn = FakeConnection()
+        rows = ([i, "row {}".format(i)] for i in range(1000))
+        result = copy_rows(conn, "public.things", ["id", "name"], rows, flush_size=100)
+
+        self.assertEqual(result.rows, 1000)
+        data = "".join(conn.copied)
+        self.assertEqual(data.count("\n"), 1000)
+        self.assertTrue(data.startswith("0\trow 0\n1\trow 1\n"))
+        self.assertTrue(all(len(chunk) <= 100 for chunk in conn.copied))
+
+
+class PageSizeTests(TestCase):
+    def test_grows_when_fast(self):
+        page_size = PageSize(initial=100, target_seconds=0.25)
+        self.assertEqual(page_size.update(100, 0.01, 1000), 200)
+        self.assertEqual(page_size.update(200, 0.02, 2000), 400)
+
+    def test_shrinks_when_slow(self):
+        page_size = PageSize(initial=1000, target_seconds=0.25)
+        self.assertEqual(page_size.update(1000, 10.0, 1000), 500)
+
+        # close to the target it settles where the target is
+        self.assertEqual(page_size.update(500, 0.4, 1000), 312)
+
+    def test_max_bytes(self):
+        page_size = PageSize(initial=1000, max_bytes=100000)
+        self.assertEqual(page_size.update(1000, 0.001, 150000), 666)
+
+    def test_limits(self):
+        page_size = PageSize(initial=20, minimum=10, maximum=30)
+        self.assertEqual(page_size.update(20, 100.0, 1), 10)
+        self.assertEqual(page_size.update(10, 0.0, 0), 20)
+        self.assertEqual(page_size.update(20, 0.0, 0), 30)
+        self.assertEqual(page_size.update(0, 0.0, 0), 30)
+
+
+class ExecuteManyTests(TestCase):
+    def test_execute_many(self):
+        conn = FakeConnection()
+        conn.results = [(1,)]
+        conn.description = [("id",)]
+        page_size = PageSize(initial=2, minimum=2, maximum=3)
+
+        result = execute_many(conn, "INSERT INTO t VALUES %s RETURNING id", ((i, "x") for i in range(7)), fetch=True, page_size=page_size)
+        self.assertEqual(result.rows, 7)
+        self.assertEqual(result.pages, 3)
+        self.assertEqual(result.returned, [(1,), (1,), (1,)])
+        self.assertEqual(conn.queries, [
+            b"INSERT INTO t VALUES (0,'x'),(1,'x') RETURNING id",
+            b"INSERT INTO t VALUES (2,'x'),(3,'x'),(4,'x') RETURNING id",
+            b"INSERT INTO t VALUES (5,'x'),(6,'x') RETURNING id",
+        ])
+
+    def test_template(self):
+        conn = FakeConnection()
+        result = execute_many(conn, "UPDATE t SET x = v.x FROM (VALUES %s) AS v (id, x) WHERE t.id = v.id", [(1, 2)], template="(%s, %s::int8)")
+        self.assertIsNone(result.returned)
+        self.assertEqual(conn.queries, [b"UPDATE t SET x = v.x FROM (VALUES (1, 2::int8)) AS v (id, x) WHERE t.id = v.id"])
+
+
+class BulkUpsertTests(TestCase):
+    def setUp(self):
+        self.conn = FakeConnection()
+        self.conn.autocommit = False
+        self.conn.results = [(2, 1)]
+
+        # the fake can't turn composed queries into strings
+        patcher = mock.patch("psycopg2.sql.Identifier.as_string", lambda self, context: ".".join('"{}"'.format(s) for s in self.strings))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def queries(self):
+        return [query.as_string(None) if isinstance(query, Composable) else query for query in self.conn.queries]
+
+    def test_chunks(self):
+        rows = [(i, "text {}".format(i)) for i in range(5)]
+        result = bulk_upsert(self.conn, "public.tweets", ["id"], rows, columns=["id", "text"], chunk_size=2)
+
+        # one copy, an index on the row numbers and one statement for each chunk
+        self.assertEqual((result.rows, result.chunks, result.inserted, result.updated), (5, 3, 6, 3))
+        queries = self.queries()
+        self.assertEqual(len(queries), 9)
+        self.assertTrue(queries[0].startswith("CREATE TEMPORARY TABLE"))
+        self.assertIn('SELECT "id", "text" FROM "public"."tweets" WITH NO DATA', queries[0])
+        self.assertTrue(queries[2].startswith("COPY"))
+        self.assertTrue(queries[3].endswith("ADD PRIMARY KEY (ciptools_row)"))
+        self.assertTrue(queries[4].startswith("ANALYZE"))
+        self.assertIn('ON CONFLICT ("id") DO UPDATE SET "text" = excluded."text"', queries[5])
+        self.assertIn("RETURNING xmax = 0 AS inserted", queries[5])
+        self.assertTrue(queries[8].startswith("DROP TABLE"))
+        self.assertEqual(self.conn.copied, ["".join("{}\ttext {}\n".format(i, i) for i in range(5))])
+
+    def test_nothing_to_update(self):
+        result = bulk_upsert(self.conn, "links", ["a", "b"], [(1, 2)], columns=["a", "b"])
+        self.assertEqual(result.chunks, 1)
+        self.assertIn('ON CONFLICT ("a", "b") DO NOTHING', self.queries()[5])
+
+    def test_all_columns(self):
+        self.conn.description = [Column(name="id"), Column(name="text")]
+        bulk_upsert(self.conn, "tweets", ["id"], [(1, "a")])
+        self.assertIn('SELECT "id", "text" FROM "tweets"', self.queries()[1])
+
+
+class GreenCopyTests(TestCase):
+    def setUp(self):
+        # what ciptools.monkey.patch_psycopg does in a patched process
+        psycopg2.extensions.set_wait_callback(lambda conn: None)
+        self.addCleanup(psycopg2.extensions.set_wait_callback, None)
+        self.conn = FakeConnection()
+        self.conn.autocommit = False
+
+    def test_copy_rows(self):
+        with self.assertRaises(psycopg2.NotSupportedError):
+            copy_rows(self.conn, "things", ["id"], [(1,)])
+        with self.assertRaises(psycopg2.NotSupportedError):
+            copy_rows(self.conn, "things", ["id"], [(1,)], types=["int8"])
+        self.assertEqual(self.conn.queries, [])
+
+    def test_bulk_upsert(self):
+        # nothing is sent, not even the staging table
+        with self.assertRaises(psycopg2.NotSupportedError):
+            bulk_upsert(self.conn, "things", ["id"], [(1, "a")], columns=["id", "text"])
+        self.assertEqual(self.conn.queries, [])
+
+    def test_execute_many(self):
+        # the fallback still works
+        result = execute_many(self.conn, "INSERT INTO things VALUES %s", [(1,), (2,)])
+        self.assertEqual(result.rows, 2)
@@ -0,0 +1,135 @@
+from unittest import TestCase, mock
+
+import psycopg2
+
+import ciptools.database
+from ciptools.database import breaker
+from ciptools.database.pool import DatabaseClient, PoolError
+from tests.fakes import FakeConnector
+
+
+class DatabaseClientTests(TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.db = DatabaseClient(minconn=1, maxconn=2, retry=False, ping="never")
+        self.addCleanup(self.db.close)
+
+    def test_transaction(self):
+        with self.db.transaction() as conn:
+            with conn.cursor() as cur:
+                cur.execute("INSERT 1")
+            self.assertFalse(conn.autocommit)
+            self.assertTrue(conn.in_transaction)
+        self.assertTrue(conn.autocommit)
+        self.assertFalse(conn.in_transaction)
+
+    def test_stream(self):
+        with self.db.conn() as conn:
+            conn.results = [(i,) for i in range(10)]
+
+        rows = self.db.stream("SELECT", itersize=3)
+        self.assertEqual(next(rows), (0,))
+
+        # the connection stays checked out while the iterator is open
+        self.assertEqual(self.db.stats()["in_use"], 1)
+        self.assertEqual(len(list(rows)), 9)
+        self.assertEqual(self.db.stats()["in_use"], 0)
+
+    def test_stream_batches(self):
+        with self.db.conn() as conn:
+            conn.results = [(i,) for i in range(10)]
+
+        batches = list(self.db.stream("SELECT", itersize=4, batches=True))
+        self.assertEqual([len(batch) for batch in batches], [4, 4, 2])
+
+    def test_stream_closed_early(self):
+        with self.db.conn() as conn:
+            conn.results = [(i,) for i in range(10)]
+
+        rows = self.db.stream("SELECT")
+        next(rows)
+        rows.close()
+
+        # the connection was returned clean
+        self.assertEqual(self.db.stats()["in_use"], 0)
+        self.assertTrue(conn.autocommit)
+        self.assertFalse(conn.in_transaction)
+
+    def test_stream_in_transaction(self):
+        with self.db.transaction() as conn:
+            conn.results = [(1,), (2,)]
+            self.assertEqual(list(self.db.stream("SELECT")), [(1,), (2,)])
+
+            # it didn't need another connection
+            self.assertEqual(self.db.stats()["in_use"], 1)
+
+    def test_priority(self):
+        db = DatabaseClient(maxconn=2, retry=False, ping="never", timeout=0, priorities={"interactive": {"reserve": 1}, "batch": {}})
+        self.addCleanup(db.close)
+
+        with db.priority("batch"):
+            with db.conn():
+                # the other connection is reserved
+                with self.assertRaises(PoolError):
+                    with db.conn():
+                        pass
+                with db.conn(priority="interactive"):
+                    pass
+
+        stats = db.stats()
+        self.assertEqual(stats["histograms"]["checkout.batch"]["count"], 1)
+        self.assertEqual(stats["histograms"]["checkout.interactive"]["count"], 1)
+        self.assertEqual(stats["counters"]["timeout.batch"], 1)
+
+
+class LegacyCursorTransactionTests(TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        for registry in (ciptools.database.connections, ciptools.database.last_used, ciptools.database.owners):
+            self.addCleanup(registry.clear)
+        self.addCleanup(breaker._breakers.clear)
+
+        self.db = ciptools.database.DatabaseClient(host="legacy", client_id="cursor", retry=False, ping="never")
+
+    def test_stream(self):
+        self.assertEqual(list(self.db.stream("SELECT")), [])
+
+        # only the connection for the cursor, which was closed, and nothing
+        # was put in the registry
+        self.assertEqual(len(self.connector.connections), 1)
+        self.assertTrue(self.connector.connections[0].closed)
+        self.assertEqual(ciptools.database.count(), 0)
+
+    def test_stream_in_transaction(self):
+        with self.db.transaction() as conn:
+            conn.results = [(1,)]
+            self.assertEqual(list(self.db.stream("SELECT")), [(1,)])
+        self.assertEqual(self.connector.connections, [conn])
+
+    def test_retry(self):
+        failing = mock.Mock(side_effect=[psycopg2.OperationalError("could not connect to server"), self.connector()])
+        db = ciptools.database.DatabaseClient(host="legacy", retry=True, ping="never", retry_max_wait=0.01)
+        with mock.patch("psycopg2.connect", failing):
+            self.assertEqual(list(db.stream("SELECT")), [])
+        self.assertEqual(failing.call_count, 2)
+
+    def test_circuit_breaker(self):
+        # the registry has a connection already so only the cursor's
+        # connection has to connect
+        self.db.conn()
+        failing = mock.Mock(side_effect=psycopg2.OperationalError("could not connect to server"))
+        with mock.patch("psycopg2.connect", failing):
+            for _ in range(5):
+                with self.assertRaises(psycopg2.OperationalError):
+                    self.db.fetch_columns("SELECT")
+            with self.assertRaises(breaker.CircuitOpenError):
+                self.db.fetch_columns("SELECT")
+        self.assertEqual(failing.call_count, 5)
@@ -0,0 +1,89 @@
+import array
+import unittest
+from unittest import TestCase, mock
+
+from psycopg2.extensions import Column
+
+from ciptools.database import columnar
+from ciptools.database.pool import DatabaseClient
+from tests.fakes import FakeConnection, FakeConnector
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def describe(*columns):
+    return [Column(name=name, type_code=type_code) for name, type_code in columns]
+
+
+class ColumnarTests(TestCase):
+    def setUp(self):
+        self.conn = FakeConnection()
+        self.conn.autocommit = False
+        self.addCleanup(self.conn.close)
+
+    def test_fetch(self):
+        self.conn.description = describe(("id", 20), ("score", 701), ("ok", 16), ("text", 25))
+        self.conn.results = [(i, i / 2, i % 2 == 0, "row {}".format(i)) for i in range(25)]
+
+        columns = columnar.fetch(self.conn, "SELECT", batch_size=10)
+        self.assertEqual(list(columns), ["id", "score", "ok", "text"])
+        self.assertEqual(columns["id"], array.array("q", range(25)))
+        self.assertEqual(columns["score"], array.array("d", [i / 2 for i in range(25)]))
+        self.assertEqual(columns["ok"].tolist(), [int(i % 2 == 0) for i in range(25)])
+        self.assertEqual(columns["text"], ["row {}".format(i) for i in range(25)])
+
+    def test_fetch_nulls(self):
+        self.conn.description = describe(("id", 20), ("count", 23))
+        self.conn.results = [(1, 10), (2, 20), (3, None), (4, 40)]
+
+        # a null in a numeric column turns it into a list
+        columns = columnar.fetch(self.conn, "SELECT", batch_size=3)
+        self.assertEqual(columns["id"], array.array("q", [1, 2, 3, 4]))
+        self.assertEqual(columns["count"], [10, 20, None, 40])
+
+    def test_fetch_empty(self):
+        self.conn.description = describe(("id", 20), ("text", 25))
+        columns = columnar.fetch(self.conn, "SELECT")
+        self.assertEqual(columns, {"id": array.array("q"), "text": []})
+
+    def test_duplicate_names(self):
+        self.conn.description = describe(("id", 20), ("id", 20))
+        with self.assertRaises(ValueError):
+            columnar.fetch(self.conn, "SELECT")
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_numpy(self):
+        self.conn.description = describe(("id", 21), ("ok", 16), ("text", 25))
+        self.conn.results = [(1, True, "a"), (2, False, "b")]
+
+        columns = columnar.fetch(self.conn, "SELECT", numpy=True)
+        self.assertEqual(columns["id"].dtype, numpy.int16)
+        self.assertEqual(columns["ok"].tolist(), [True, False])
+        self.assertEqual(columns["text"], ["a", "b"])
+
+
+class FetchColumnsTests(TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.db = DatabaseClient(minconn=1, maxconn=2, retry=False, ping="never")
+        self.addCleanup(self.db.close)
+
+    def test_fetch_columns(self):
+        with self.db.conn() as conn:
+            conn.description = describe(("id", 23),)
+            conn.results = [(1,), (2,)]
+
+        columns = self.db.fetch_columns("SELECT id FROM things")
+        self.assertEqual(columns["id"], array.array("i", [1, 2]))
+
+        # the connection was in a transaction for the cursor and came back clean
+        self.assertEqual(self.db.stats()["in_use"], 0)
+        self.assertTrue(conn.autocommit)
+        self.assertFalse(conn.in_transaction)
@@ -0,0 +1,145 @@
+from unittest import TestCase, mock
+
+import psycopg2
+
+import ciptools.database
+from ciptools.database import instrument
+from ciptools.database.pool import DatabaseClient
+from tests.fakes import FakeConnection, FakeConnector
+
+
+class BaseCursor:
+    def __init__(self, conn):
+        self.connection = conn
+        self.rowcount = -1
+
+    def execute(self, query, vars=None):
+        if "fail" in query:
+            raise psycopg2.ProgrammingError("syntax error")
+        self.rowcount = 2
+
+    def executemany(self, query, vars_list):
+        self.rowcount = len(list(vars_list))
+
+    def copy_expert(self, sql, file, size=8192):
+        self.rowcount = 10
+
+
+Cursor = instrument.cursor_class(BaseCursor)
+
+
+class FingerprintTests(TestCase):
+    def test_fingerprint(self):
+        self.assertEqual(instrument.fingerprint("SELECT text FROM tweets WHERE id = %s"), "SELECT text FROM tweets WHERE id = ?")
+        self.assertEqual(
+            instrument.fingerprint("select *\n  from t1 -- comment\n where a in (1, 2, 3) and b = 'it''s' limit 10"),
+            "select * from t1 where a in (?) and b = ? limit ?",
+        )
+        self.assertEqual(
+            instrument.fingerprint(b"INSERT INTO t (a, b) VALUES (1, 'a'), (2, NULL)"),
+            "INSERT INTO t (a, b) VALUES (?)",
+        )
+        self.assertEqual(instrument.fingerprint("UPDATE t SET x = $1 WHERE y = %(name)s"), "UPDATE t SET x = ? WHERE y = ?")
+
+    def test_shape(self):
+        self.assertEqual(instrument.shape((1, "secret", None, [1, 2])), "(int, str[6], NoneType, list[2])")
+        self.assertEqual(instrument.shape({"id": 1.5}), "{id: float}")
+        self.assertEqual(instrument.shape(None), "none")
+
+
+class InstrumentedCursorTests(TestCase):
+    def setUp(self):
+        self.conn = FakeConnection()
+        self.statistics = instrument.QueryStatistics(slow_query=None)
+        instrument.attach(self.conn, self.statistics)
+
+    def test_records(self):
+        cur = Cursor(self.conn)
+        cur.execute("SELECT * FROM tweets WHERE id = %s", (1,))
+        cur.execute("SELECT * FROM tweets WHERE id = %s", (2,))
+        cur.executemany("INSERT INTO tweets VALUES (%s)", iter([(1,), (2,), (3,)]))
+        cur.copy_expert("COPY tweets FROM STDIN", None)
+        with self.assertRaises(psycopg2.ProgrammingError):
+            cur.execute("fail")
+
+        stats = self.statistics.snapshot()
+        self.assertEqual(stats["SELECT * FROM tweets WHERE id = ?"]["count"], 2)
+        self.assertEqual(stats["SELECT * FROM tweets WHERE id = ?"]["rows"], 4)
+        self.assertEqual(stats["SELECT * FROM tweets WHERE id = ?"]["latency"]["count"], 2)
+        self.assertEqual(stats["INSERT INTO tweets VALUES (?)"]["rows"], 3)
+        self.assertEqual(stats["COPY tweets FROM STDIN"]["rows"], 10)
+        self.assertEqual(stats["fail"]["errors"], 1)
+
+    def test_not_attached(self):
+        cur = Cursor(FakeConnection())
+        cur.execute("SELECT 1")
+        self.assertEqual(self.statistics.snapshot(), {})
+
+    def test_slow_query_log(self):
+        self.statistics.slow_query = 0.0
+        with self.assertLogs("ciptools.database.instrument", "WARNING") as logs:
+            Cursor(self.conn).execute("SELECT * FROM users WHERE password = %s", ("hunter2",))
+        self.assertIn("SELECT * FROM users WHERE password = ? with parameters (str[7])", logs.output[0])
+        self.assertNotIn("hunter2", logs.output[0])
+
+    def test_rolling_window(self):
+        self.statistics.window = 10.0
+        now = [100.0]
+        with mock.patch("time.monotonic", lambda: now[0]):
+            cur = Cursor(self.conn)
+            cur.execute("SELECT 1")
+            now[0] += 10.0
+            cur.execute("SELECT 1")
+            stats = self.statistics.snapshot()["SELECT ?"]
+            self.assertEqual((stats["count"], stats["latency"]["count"]), (2, 2))
+
+            now[0] += 10.0
+            cur.execute("SELECT 1")
+            stats = self.statistics.snapshot()["SELECT ?"]
+            self.assertEqual((stats["count"], stats["latency"]["count"]), (3, 2))
+
+            # nothing for a long time so the old window is too old
+            now[0] += 100.0
+            cur.execute("SELECT 1")
+            stats = self.statistics.snapshot()["SELECT ?"]
+            self.assertEqual((stats["count"], stats["latency"]["count"]), (4, 1))
+
+    def test_too_many_statements(self):
+        self.statistics.max_statements = 2
+        cur = Cursor(self.conn)
+        for table in ("a", "b", "c", "d"):
+            cur.execute("SELECT * FROM {}".format(table))
+        self.assertEqual(sorted(self.statistics.snapshot()), ["<other>", "SELECT * FROM a", "SELECT * FROM b"])
+
+
+class ClientInstrumentTests(TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pool_client(self):
+        db = DatabaseClient(retry=False, ping="never", instrument=True, prepare=True)
+        self.addCleanup(db.close)
+        with db.conn() as conn:
+            self.assertTrue(issubclass(conn.cursor_factory, instrument.InstrumentedCursorMixin))
+            self.assertIs(instrument._registries[conn], db._query_stats)
+        self.assertEqual(db.query_stats(), {})
+
+        plain = DatabaseClient(retry=False, ping="never")
+        self.addCleanup(plain.close)
+        with plain.conn() as conn:
+            self.assertFalse(issubclass(conn.cursor_factory, instrument.InstrumentedCursorMixin))
+
+    def test_legacy_conn(self):
+        for registry in (ciptools.database.connections, ciptools.database.last_used, ciptools.database.owners):
+            self.addCleanup(registry.clear)
+
+        conn = ciptools.database.conn(ping="never", instrument=True)
+        self.assertTrue(issubclass(self.connector.connections[0].kwargs["cursor_factory"], instrument.InstrumentedCursorMixin))
+        self.assertIs(instrument._registries[conn], instrument.statistics)
+
+        # asking without it puts the plain cursors back
+        ciptools.database.conn(ping="never")
+        self.assertFalse(issubclass(conn.cursor_factory, instrument.InstrumentedCursorMixin))
@@ -0,0 +1,25 @@
+from unittest import TestCase, mock
+
+import psycopg2.extensions
+
+import ciptools.monkey
+
+
+class MonkeyTests(TestCase):
+    def tearDown(self):
+        psycopg2.extensions.set_wait_callback(None)
+
+    def test_not_patched(self):
+        self.assertFalse(ciptools.monkey.patch_psycopg())
+        self.assertIsNone(psycopg2.extensions.get_wait_callback())
+
+    @mock.patch("ciptools.monkey.is_eventlet_patched", return_value=True)
+    def test_eventlet(self, _):
+        self.assertTrue(ciptools.monkey.patch_psycopg())
+        self.assertIs(psycopg2.extensions.get_wait_callback(), ciptools.monkey.eventlet_wait_callback)
+
+    @mock.patch("ciptools.monkey.is_gevent_patched", return_value=True)
+    def test_gevent(self, _):
+        self.assertTrue(ciptools.monkey.patch_psycopg())
+        self.assertTrue(ciptools.monkey.patch_psycopg())
+        self.assertIs(psycopg2.extensions.get_wait_callback(), ciptools.monkey.gevent_wait_callback)
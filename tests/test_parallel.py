@@ -0,0 +1,145 @@
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+from unittest import TestCase, mock
+
+import psycopg2
+import psycopg2.extensions
+
+import ciptools.monkey
+from ciptools.database import parallel
+from ciptools.database.pool import DatabaseClient
+from tests.fakes import FakeConnector
+
+# the workers are forked from the test so they see these as they were when
+# the pool started
+connector = None
+reads = None
+
+
+def read(path):
+    if path == "bad":
+        raise IOError("no such file: bad")
+
+    # which worker read the file and how many connections it had made before
+    if reads is not None:
+        reads.put((os.getpid(), len(connector.connections)))
+    return [(path, i) for i in range(3)]
+
+
+class ParallelCopyTests(TestCase):
+    def setUp(self):
+        global connector, reads
+
+        context = multiprocessing.get_context("fork")
+        connector = FakeConnector()
+        reads = context.Queue()
+        self.addCleanup(globals().update, connector=None, reads=None)
+
+        patcher = mock.patch("psycopg2.connect", connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # the patches made here are inherited by the forked workers. the fake
+        # database doesn't cross processes so only what comes back is checked.
+        patcher = mock.patch(
+            "concurrent.futures.ProcessPoolExecutor",
+            functools.partial(concurrent.futures.ProcessPoolExecutor, mp_context=context),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rows(self):
+        progress = []
+        result = parallel.parallel_copy(
+            {"host": "test"}, "tweets", ["id"], rows=((i,) for i in range(25)),
+            workers=4, connections=2, shard_size=10, progress=progress.append,
+        )
+        self.assertEqual((result.rows, result.shards, result.errors), (25, 3, []))
+        self.assertEqual([p.shards for p in progress], [1, 2, 3])
+        self.assertEqual(progress[-1].rows, 25)
+
+        # nothing was copied in this process
+        self.assertEqual(connector.connections, [])
+
+    def test_files(self):
+        paths = ["a", "b", "c", "d", "e", "f"]
+        result = parallel.parallel_copy({"host": "test"}, "tweets", ["path", "n"], files=paths, reader=read, workers=2)
+        self.assertEqual((result.rows, result.shards), (18, 6))
+
+        # at most two processes, each with one connection that it reuses
+        seen = [reads.get(timeout=5) for _ in paths]
+        self.assertLessEqual(len({pid for pid, _ in seen}), 2)
+        self.assertNotIn(os.getpid(), {pid for pid, _ in seen})
+        self.assertTrue(all(count <= 1 for _, count in seen))
+
+    def test_errors(self):
+        with self.assertRaises(parallel.ParallelLoadError) as context:
+            parallel.parallel_copy({"host": "test"}, "tweets", ["path", "n"], files=["a", "bad"], reader=read, workers=1)
+        self.assertEqual(context.exception.result.rows, 3)
+        self.assertEqual(context.exception.result.errors, [("bad", "no such file: bad")])
+
+        result = parallel.parallel_copy(
+            {"host": "test"}, "tweets", ["path", "n"], files=["bad"], reader=read, workers=1, raise_errors=False,
+        )
+        self.assertEqual(len(result.errors), 1)
+
+    def test_wait_callback(self):
+        # the workers of a process patched for eventlet or gevent can still
+        # copy. the workers inherit the patching as well as the callback.
+        patcher = mock.patch("ciptools.monkey.is_eventlet_patched", return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.assertTrue(ciptools.monkey.patch_psycopg())
+        self.addCleanup(psycopg2.extensions.set_wait_callback, None)
+
+        result = parallel.parallel_copy({"host": "test"}, "tweets", ["id"], rows=((i,) for i in range(25)), workers=2, shard_size=10)
+        self.assertEqual((result.rows, result.errors), (25, []))
+        self.assertIs(psycopg2.extensions.get_wait_callback(), ciptools.monkey.eventlet_wait_callback)
+
+    def test_arguments(self):
+        with self.assertRaises(ValueError):
+            parallel.parallel_copy({}, "tweets", ["id"])
+        with self.assertRaises(ValueError):
+            parallel.parallel_copy({}, "tweets", ["id"], files=["a"])
+
+    def test_client(self):
+        with DatabaseClient(minconn=0, maxconn=1, retry=False, host="test") as db:
+            result = db.parallel_copy("tweets", ["id"], rows=[(1,), (2,)], workers=1)
+        self.assertEqual(result.rows, 2)
+
+
+class WorkerTests(TestCase):
+    # what each worker does, run in this process so the copies can be seen
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        parallel._initialize({"host": "test"}, False)
+        self.addCleanup(setattr, parallel, "_pool", None)
+        self.addCleanup(lambda: parallel._pool.closeall())
+
+    def copied(self):
+        return [line for conn in self.connector.connections for data in conn.copied for line in data.splitlines()]
+
+    def test_copy(self):
+        self.assertEqual(parallel._copy("tweets", ["id"], [(1,), (2,)], None, 65536), 2)
+        self.assertEqual(parallel._copy("tweets", ["id"], [(3,)], None, 65536), 1)
+        self.assertEqual(self.copied(), ["1", "2", "3"])
+
+        # one connection, made with the arguments given to the pool
+        self.assertEqual(len(self.connector.connections), 1)
+        self.assertEqual(self.connector.connections[0].kwargs["host"], "test")
+
+    def test_copy_file(self):
+        self.assertEqual(parallel._copy_file("tweets", ["path", "n"], read, "a", None, 65536), 3)
+        self.assertEqual(self.copied(), ["a\t0", "a\t1", "a\t2"])
+
+    def test_failed_copy_closes_connection(self):
+        with mock.patch("ciptools.database.bulk.copy_rows", side_effect=psycopg2.IntegrityError("duplicate key")):
+            with self.assertRaises(psycopg2.IntegrityError):
+                parallel._copy("tweets", ["id"], [(1,)], None, 65536)
+        self.assertTrue(self.connector.connections[0].closed)
@@ -0,0 +1,74 @@
+import datetime
+import struct
+import uuid
+from unittest import TestCase
+
+from ciptools.pgcopy import HEADER, TRAILER, BinaryCopyIO, encoder
+
+
+def encode(type_name, value):
+    buffer = bytearray()
+    encoder(type_name)(buffer, value)
+    return bytes(buffer)
+
+
+class BinaryCopyTests(TestCase):
+    def test_scalars(self):
+        self.assertEqual(encode("int2", 1), b"\x00\x00\x00\x02\x00\x01")
+        self.assertEqual(encode("int4", -1), b"\x00\x00\x00\x04\xff\xff\xff\xff")
+        self.assertEqual(encode("int8", 1), b"\x00\x00\x00\x08" + b"\x00" * 7 + b"\x01")
+        self.assertEqual(encode("float8", 1.5), b"\x00\x00\x00\x08" + struct.pack(">d", 1.5))
+        self.assertEqual(encode("bool", True), b"\x00\x00\x00\x01\x01")
+        self.assertEqual(encode("text", "hé"), b"\x00\x00\x00\x03h\xc3\xa9")
+        self.assertEqual(encode("bytea", b"\x00\x01"), b"\x00\x00\x00\x02\x00\x01")
+        self.assertEqual(encode("jsonb", {"a": 1}), b"\x00\x00\x00\x09\x01" + b'{"a": 1}')
+        self.assertEqual(encode("json", '{"a":1}'), b"\x00\x00\x00\x07" + b'{"a":1}')
+
+        value = uuid.uuid4()
+        self.assertEqual(encode("uuid", str(value)), b"\x00\x00\x00\x10" + value.bytes)
+
+    def test_times(self):
+        self.assertEqual(encode("date", datetime.date(2000, 1, 2)), b"\x00\x00\x00\x04\x00\x00\x00\x01")
+        self.assertEqual(
+            encode("timestamp", datetime.datetime(2000, 1, 1, 0, 0, 1)),
+            b"\x00\x00\x00\x08" + struct.pack(">q", 1000000),
+        )
+        pacific = datetime.timezone(datetime.timedelta(hours=-8))
+        self.assertEqual(
+            encode("timestamptz", datetime.datetime(1999, 12, 31, 16, 0, 0, 5, tzinfo=pacific)),
+            b"\x00\x00\x00\x08" + struct.pack(">q", 5),
+        )
+
+    def test_arrays(self):
+        self.assertEqual(
+            encode("int4[]", [1, None]),
+            struct.pack(">iiiiiiiii", 32, 1, 1, 23, 2, 1, 4, 1, -1),
+        )
+        self.assertEqual(encode("text[]", []), struct.pack(">iiii", 12, 0, 0, 25))
+
+        data = encode("int2[]", [[1, 2], [3, 4]])
+        self.assertEqual(struct.unpack(">iiiiiii", data[:28]), (len(data) - 4, 2, 0, 21, 2, 1, 2))
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            encoder("money")
+
+    def test_stream(self):
+        rows = [(i, "row {}".format(i), None) for i in range(1000)]
+        data = BinaryCopyIO(["int8", "text", "float8"], rows, flush_size=100)
+
+        chunks = []
+        while True:
+            chunk = data.read(64)
+            if not chunk:
+                break
+            self.assertLessEqual(len(chunk), 64)
+            chunks.append(chunk)
+
+        stream = b"".join(chunks)
+        self.assertEqual(data.count, 1000)
+        self.assertTrue(stream.startswith(HEADER))
+        self.assertTrue(stream.endswith(TRAILER))
+
+        first = stream[len(HEADER):len(HEADER) + 27]
+        self.assertEqual(first, struct.pack(">hiqi", 3, 8, 0, 5) + b"row 0" + struct.pack(">i", -1))
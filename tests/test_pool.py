@@ -0,0 +1,495 @@
+import multiprocessing
+import threading
+import time
+from unittest import TestCase, mock
+
+import psycopg2.extensions
+
+from ciptools.database.pool import ConnectionPool, PoolError
+from tests.fakes import FakeConnector
+
+
+class ConnectionPoolTests(TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reuse_connection(self):
+        pool = ConnectionPool(1, 2, False)
+        conn = pool.getconn("a")
+        self.assertIs(pool.getconn("a"), conn)
+        pool.putconn("a")
+        self.assertIs(pool.getconn("b"), conn)
+        self.assertEqual(len(self.connector.connections), 1)
+
+    def test_exhausted(self):
+        pool = ConnectionPool(1, 2, False, timeout=0)
+        pool.getconn("a")
+        pool.getconn("b")
+        with self.assertRaises(PoolError):
+            pool.getconn("c")
+
+        pool.putconn("a")
+        pool.getconn("c")
+
+    def test_replace_failed_connection(self):
+        pool = ConnectionPool(1, 1, False)
+        conn = pool.getconn("a")
+        pool.putconn("a")
+        conn.broken = True
+
+        replacement = pool.getconn("b")
+        self.assertIsNot(replacement, conn)
+        self.assertTrue(conn.closed)
+
+    def test_close_lost_connection(self):
+        pool = ConnectionPool(1, 1, False)
+        conn = pool.getconn("a")
+        conn.close()
+        pool.putconn("a")
+        self.assertIsNot(pool.getconn("b"), conn)
+
+    def test_ping_always(self):
+        pool = ConnectionPool(1, 1, False)
+        conn = pool.getconn("a")
+        pool.putconn("a")
+        pool.getconn("b")
+        self.assertEqual(conn.queries, ["SELECT 1"])
+
+    def test_ping_never(self):
+        pool = ConnectionPool(1, 1, False, ping="never")
+        conn = pool.getconn("a")
+        pool.putconn("a")
+        self.assertIs(pool.getconn("b"), conn)
+        self.assertEqual(conn.queries, [])
+
+        # a connection that failed while in use is dropped when it comes back
+        conn.closed = 2
+        pool.putconn("b")
+        self.assertIsNot(pool.getconn("c"), conn)
+
+    def test_ping_idle(self):
+        pool = ConnectionPool(1, 1, False, ping="idle", ping_idle=0.05)
+        conn = pool.getconn("a")
+        pool.putconn("a")
+        pool.getconn("b")
+        self.assertEqual(conn.queries, [])
+
+        pool.putconn("b")
+        time.sleep(0.05)
+        pool.getconn("c")
+        self.assertEqual(conn.queries, ["SELECT 1"])
+
+    def test_ping_invalid(self):
+        with self.assertRaises(ValueError):
+            ConnectionPool(1, 1, False, ping="sometimes")
+
+    def test_connect_outside_lock(self):
+        pool = ConnectionPool(1, 4, False)
+        pool.getconn("a")
+
+        # make new connections slow and start one in the background
+        self.connector.delay = 0.5
+        thread = threading.Thread(target=pool.getconn, args=("b",))
+        thread.start()
+        time.sleep(0.1)
+
+        # returning and checking out an idle connection doesn't wait for it
+        started = time.monotonic()
+        pool.putconn("a")
+        pool.getconn("c")
+        self.assertLess(time.monotonic() - started, 0.25)
+
+        # but the reserved slot counts against maxconn the whole time
+        pool.getconn("d")
+        self.connector.delay = 0.0
+        thread.join()
+        pool.getconn("e")
+        with self.assertRaises(PoolError):
+            pool.getconn("f", timeout=0)
+
+    def test_wait_for_connection(self):
+        pool = ConnectionPool(1, 1, False)
+        pool.getconn("a")
+        threading.Timer(0.1, pool.putconn, args=("a",)).start()
+
+        started = time.monotonic()
+        pool.getconn("b", timeout=5)
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+
+    def test_wait_timeout(self):
+        pool = ConnectionPool(1, 1, False)
+        pool.getconn("a")
+
+        started = time.monotonic()
+        with self.assertRaises(PoolError):
+            pool.getconn("b", timeout=0.1)
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+
+        # giving up doesn't leave anything behind
+        pool.putconn("a")
+        pool.getconn("c", timeout=0)
+
+    def test_waiters_served_in_order(self):
+        pool = ConnectionPool(1, 1, False)
+        pool.getconn("holder")
+
+        served = []
+
+        def worker(key):
+            pool.getconn(key, timeout=5)
+            served.append(key)
+            pool.putconn(key)
+
+        threads = []
+        for i in range(5):
+            thread = threading.Thread(target=worker, args=(str(i),))
+            thread.start()
+            threads.append(thread)
+
+            # make sure they get in line in order
+            while len(pool._waiters) < i + 1:
+                time.sleep(0.001)
+
+        pool.putconn("holder")
+        for thread in threads:
+            thread.join()
+        self.assertEqual(served, ["0", "1", "2", "3", "4"])
+
+    def test_many_threads_small_pool(self):
+        pool = ConnectionPool(4, 32, False)
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(10):
+                    key = "{}-{}".format(n, i)
+                    pool.getconn(key, timeout=10)
+                    time.sleep(0.001)
+                    pool.putconn(key)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(200)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(self.connector.connections) - sum(c.closed for c in self.connector.connections), 32)
+        self.assertEqual(len(pool._used), 0)
+
+    def test_waiters_reuse_connections(self):
+        # connections given back while threads are waiting go to them instead
+        # of being closed and connected again
+        pool = ConnectionPool(2, 8, False, ping="never")
+
+        def worker(n):
+            for i in range(50):
+                key = "{}-{}".format(n, i)
+                pool.getconn(key, timeout=10)
+                time.sleep(0.0005)
+                pool.putconn(key)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # a few extra while the threads are starting up but not one per checkout
+        self.assertLessEqual(len(self.connector.connections), 16)
+        self.assertEqual(len(pool._pool), 2)
+
+    def wait_for(self, condition, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("condition never became true")
+            time.sleep(0.01)
+
+    def test_maintenance_prewarm_and_refill(self):
+        pool = ConnectionPool(3, 5, False, maintenance_interval=10)
+        self.addCleanup(pool.closeall)
+        self.wait_for(lambda: len(pool._pool) == 3)
+
+        # taking a connection from the reserve gets it topped back up
+        pool.getconn("a")
+        self.wait_for(lambda: len(pool._pool) == 3)
+        self.assertEqual(len(self.connector.connections), 4)
+
+    def test_maintenance_reaps_idle(self):
+        pool = ConnectionPool(1, 4, False, max_idle=0.1, maintenance_interval=0.05)
+        self.addCleanup(pool.closeall)
+        for key in "abc":
+            pool.getconn(key)
+        for key in "abc":
+            pool.putconn(key)
+
+        # all three were kept but only "minconn" of them survive
+        self.wait_for(lambda: len(pool._pool) == 1)
+        self.assertEqual(sum(1 for c in self.connector.connections if not c.closed), 1)
+
+    def test_max_lifetime(self):
+        pool = ConnectionPool(1, 1, False, max_lifetime=0.05, maintenance_interval=0.02)
+        self.addCleanup(pool.closeall)
+        self.wait_for(lambda: len(pool._pool) == 1)
+        first = pool._pool[0][0]
+
+        # the maintenance thread replaces it once it gets too old
+        self.wait_for(lambda: first.closed)
+        self.wait_for(lambda: len(pool._pool) == 1)
+        self.assertIsNot(pool._pool[0][0], first)
+
+    def test_closeall(self):
+        pool = ConnectionPool(2, 2, False, maintenance_interval=10)
+        self.wait_for(lambda: len(pool._pool) == 2)
+        pool.closeall()
+
+        self.assertFalse(pool._maintenance.is_alive())
+        self.assertTrue(all(c.closed for c in self.connector.connections))
+        with self.assertRaises(PoolError):
+            pool.getconn("a")
+
+    def test_fork(self):
+        pool = ConnectionPool(2, 8, False)
+        inherited = [pool.getconn("a"), pool.getconn("b")]
+        pool.putconn("b")
+
+        def worker(results):
+            try:
+                # the parent's connections aren't handed out in the child
+                keys = ["{}".format(i) for i in range(4)]
+                threads = [threading.Thread(target=pool.getconn, args=(key,)) for key in keys]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+                conns = [pool.getconn(key) for key in keys]
+                results.put((
+                    len(set(map(id, conns))),
+                    any(conn in inherited for conn in conns),
+                    all(conn.closed for conn in inherited),
+                ))
+
+                for key in keys:
+                    pool.putconn(key)
+            except Exception as e:
+                results.put(e)
+
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        workers = [context.Process(target=worker, args=(results,)) for _ in range(3)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        for _ in workers:
+            self.assertEqual(results.get(timeout=5), (4, False, True))
+
+        # nothing the children did made it to the server over the parent's
+        # connections and the parent can keep using them
+        for conn in inherited:
+            conn.server.setblocking(False)
+            with self.assertRaises(BlockingIOError):
+                conn.server.recv(1)
+            self.assertFalse(conn.closed)
+
+        pool.putconn("a")
+        self.assertIn(pool.getconn("c"), inherited)
+
+    def test_stats(self):
+        pool = ConnectionPool(1, 2, False, timeout=0)
+        events = []
+        pool.add_hook("reconnect", lambda event, value: events.append(event))
+
+        conn = pool.getconn("a")
+        pool.getconn("b")
+        with self.assertRaises(PoolError):
+            pool.getconn("c")
+
+        stats = pool.stats()
+        self.assertEqual(stats["in_use"], 2)
+        self.assertEqual(stats["idle"], 0)
+        self.assertEqual(stats["counters"]["checkout"], 2)
+        self.assertEqual(stats["counters"]["connect"], 2)
+        self.assertEqual(stats["counters"]["timeout"], 1)
+
+        pool.putconn("a")
+        conn.broken = True
+        pool.getconn("d")
+
+        stats = pool.stats()
+        self.assertEqual(stats["counters"]["checkin"], 1)
+        self.assertEqual(stats["counters"]["reconnect"], 1)
+        self.assertEqual(stats["histograms"]["checkout"]["count"], 3)
+        self.assertEqual(events, ["reconnect"])
+
+    @mock.patch("ciptools.monkey.is_eventlet_patched", return_value=True)
+    def test_green(self, _):
+        self.addCleanup(psycopg2.extensions.set_wait_callback, None)
+
+        # a pool that isn't green doesn't install the wait callback
+        pool = ConnectionPool(0, 1, False, green=False)
+        pool.getconn("a")
+        self.assertIsNone(psycopg2.extensions.get_wait_callback())
+
+        pool = ConnectionPool(0, 1, False)
+        pool.getconn("a")
+        self.assertIsNotNone(psycopg2.extensions.get_wait_callback())
+
+    def test_priority_reserve(self):
+        pool = ConnectionPool(0, 3, False, timeout=0, priorities={"interactive": {"reserve": 1}, "batch": {}})
+        pool.getconn("b1", priority="batch")
+        pool.getconn("b2", priority="batch")
+
+        # the last connection is kept for interactive work
+        with self.assertRaises(PoolError):
+            pool.getconn("b3", priority="batch")
+        with self.assertRaises(PoolError):
+            pool.getconn("d1")
+        pool.getconn("i1", priority="interactive")
+
+        with self.assertRaises(ValueError):
+            pool.getconn("x", priority="nonsense")
+
+    def test_priority_max(self):
+        pool = ConnectionPool(0, 3, False, timeout=0, priorities={"batch": {"max": 1}})
+        pool.getconn("b1", priority="batch")
+        with self.assertRaises(PoolError):
+            pool.getconn("b2", priority="batch")
+        pool.getconn("d1")
+        pool.getconn("d2")
+
+        stats = pool.stats()
+        self.assertEqual(stats["priorities"]["batch"]["in_use"], 1)
+        self.assertEqual(stats["priorities"]["default"]["in_use"], 2)
+        self.assertEqual(stats["counters"]["timeout.batch"], 1)
+        self.assertEqual(stats["histograms"]["checkout.default"]["count"], 2)
+
+        pool.putconn("b1")
+        self.assertEqual(pool.stats()["priorities"]["batch"]["in_use"], 0)
+        pool.getconn("b2", priority="batch")
+
+    def test_priority_waiters_served_first(self):
+        pool = ConnectionPool(0, 1, False, priorities={"interactive": {}, "batch": {}})
+        pool.getconn("holder", priority="batch")
+
+        served = []
+
+        def worker(key, priority):
+            pool.getconn(key, timeout=5, priority=priority)
+            served.append(key)
+            pool.putconn(key)
+
+        threads = []
+        for key, priority in [("b1", "batch"), ("b2", "batch"), ("i1", "interactive"), ("i2", "interactive")]:
+            thread = threading.Thread(target=worker, args=(key, priority))
+            thread.start()
+            threads.append(thread)
+            while len(pool._waiters) < len(threads):
+                time.sleep(0.001)
+
+        pool.putconn("holder")
+        for thread in threads:
+            thread.join()
+        self.assertEqual(served, ["i1", "i2", "b1", "b2"])
+
+    def test_priority_max_steps_aside(self):
+        # a waiter whose class is full doesn't hold up the rest of the line
+        pool = ConnectionPool(0, 2, False, priorities={"batch": {"max": 1}})
+        pool.getconn("b1", priority="batch")
+        pool.getconn("d1")
+
+        served = []
+
+        def worker(key, priority):
+            pool.getconn(key, timeout=5, priority=priority)
+            served.append(key)
+
+        batch = threading.Thread(target=worker, args=("b2", "batch"))
+        batch.start()
+        while len(pool._waiters) < 1:
+            time.sleep(0.001)
+        default = threading.Thread(target=worker, args=("d2", None))
+        default.start()
+        while len(pool._waiters) < 2:
+            time.sleep(0.001)
+
+        pool.putconn("d1")
+        default.join()
+        self.assertEqual(served, ["d2"])
+
+        pool.putconn("b1")
+        batch.join()
+        self.assertEqual(served, ["d2", "b2"])
+
+    def test_priority_new_arrival_behind_full_class(self):
+        # a queued waiter whose class is full doesn't let a new arrival of
+        # the same class through
+        pool = ConnectionPool(0, 3, False, priorities={"batch": {"max": 1}})
+        pool.getconn("b1", priority="batch")
+
+        errors = []
+
+        def worker():
+            try:
+                pool.getconn("b2", timeout=0.5, priority="batch")
+            except PoolError as e:
+                errors.append(e)
+
+        waiting = threading.Thread(target=worker)
+        waiting.start()
+        while len(pool._waiters) < 1:
+            time.sleep(0.001)
+
+        with self.assertRaises(PoolError):
+            pool.getconn("b3", timeout=0, priority="batch")
+        self.assertEqual(pool.stats()["priorities"]["batch"]["in_use"], 1)
+
+        # other classes still get through
+        pool.getconn("d1", timeout=0)
+        waiting.join()
+        self.assertEqual(len(errors), 1)
+
+    def test_priority_new_arrival_keeps_reserve(self):
+        # a queued waiter that can't have the reserved connection doesn't let
+        # a new arrival of the same class take it either
+        pool = ConnectionPool(0, 3, False, priorities={"interactive": {"reserve": 1}, "batch": {}})
+        pool.getconn("b1", priority="batch")
+        pool.getconn("b2", priority="batch")
+
+        errors = []
+
+        def worker():
+            try:
+                pool.getconn("b3", timeout=0.5, priority="batch")
+            except PoolError as e:
+                errors.append(e)
+
+        waiting = threading.Thread(target=worker)
+        waiting.start()
+        while len(pool._waiters) < 1:
+            time.sleep(0.001)
+
+        with self.assertRaises(PoolError):
+            pool.getconn("b4", timeout=0, priority="batch")
+        self.assertEqual(pool.stats()["priorities"]["batch"]["in_use"], 2)
+
+        pool.getconn("i1", timeout=0, priority="interactive")
+        waiting.join()
+        self.assertEqual(len(errors), 1)
+
+    def test_priority_validation(self):
+        with self.assertRaises(ValueError):
+            ConnectionPool(0, 2, False, priorities={"interactive": {"reserve": 3}})
+        with self.assertRaises(ValueError):
+            ConnectionPool(0, 2, False, priorities={"interactive": {"reserve": 2, "max": 1}})
+        with self.assertRaises(ValueError):
+            ConnectionPool(0, 2, False, priorities={"interactive": {"minimum": 1}})
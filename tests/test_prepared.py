@@ -0,0 +1,147 @@
+from unittest import TestCase, mock
+
+import psycopg2
+import psycopg2.errors
+
+from ciptools.database import prepared
+from ciptools.database.pool import DatabaseClient
+from tests.fakes import FakeConnector
+
+
+class Recorder:
+    def __init__(self, autocommit=True):
+        self.autocommit = autocommit
+        self.queries = []
+        self.fail = ()
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+        if query.split()[0] in self.fail:
+            raise psycopg2.ProgrammingError("could not determine data type of parameter $1")
+
+
+class RewriteTests(TestCase):
+    def test_positional(self):
+        self.assertEqual(
+            prepared.rewrite("SELECT * FROM t WHERE a = %s AND b LIKE 'x%%' AND c = %s", (1, 2)),
+            ("SELECT * FROM t WHERE a = $1 AND b LIKE 'x%' AND c = $2", "%s, %s"),
+        )
+
+    def test_named(self):
+        self.assertEqual(
+            prepared.rewrite("SELECT %(a)s, %(b)s, %(a)s", {"a": 1, "b": 2}),
+            ("SELECT $1, $2, $1", "%(a)s, %(b)s"),
+        )
+
+    def test_mismatch(self):
+        self.assertIsNone(prepared.rewrite("SELECT %s", {"a": 1}))
+        self.assertIsNone(prepared.rewrite("SELECT %(a)s", (1,)))
+        self.assertIsNone(prepared.rewrite("SELECT %s, %s", (1,)))
+
+
+class StatementCacheTests(TestCase):
+    def test_prepare_after_threshold(self):
+        conn = Recorder()
+        cache = prepared.StatementCache(size=10, threshold=3)
+
+        for i in range(4):
+            cache.execute(conn, "SELECT * FROM t WHERE id = %s", (i,), conn.execute)
+
+        self.assertEqual(conn.queries, [
+            ("SELECT * FROM t WHERE id = %s", (0,)),
+            ("SELECT * FROM t WHERE id = %s", (1,)),
+            ("PREPARE ciptools_1 AS SELECT * FROM t WHERE id = $1", None),
+            ("EXECUTE ciptools_1 (%s)", (2,)),
+            ("EXECUTE ciptools_1 (%s)", (3,)),
+        ])
+
+    def test_not_prepared(self):
+        conn = Recorder()
+        cache = prepared.StatementCache(threshold=1)
+
+        # no parameters, not a preparable statement and not a string
+        cache.execute(conn, "SELECT 1", None, conn.execute)
+        cache.execute(conn, "CREATE TABLE t (id int8) -- %s", (1,), conn.execute)
+        cache.execute(conn, b"SELECT %s", (1,), conn.execute)
+        self.assertEqual([query for query, _ in conn.queries], ["SELECT 1", "CREATE TABLE t (id int8) -- %s", b"SELECT %s"])
+
+    def test_savepoint_in_transaction(self):
+        conn = Recorder(autocommit=False)
+        cache = prepared.StatementCache(threshold=1)
+        cache.execute(conn, "SELECT %s::int8", (1,), conn.execute)
+        self.assertEqual([query for query, _ in conn.queries], [
+            "SAVEPOINT ciptools_prepare",
+            "PREPARE ciptools_1 AS SELECT $1::int8",
+            "RELEASE SAVEPOINT ciptools_prepare",
+            "EXECUTE ciptools_1 (%s)",
+        ])
+
+    def test_prepare_fails(self):
+        conn = Recorder(autocommit=False)
+        conn.fail = ("PREPARE",)
+        cache = prepared.StatementCache(threshold=1)
+
+        cache.execute(conn, "SELECT %s", (1,), conn.execute)
+        cache.execute(conn, "SELECT %s", (2,), conn.execute)
+
+        # it was rolled back and then never tried again
+        self.assertEqual([query for query, _ in conn.queries], [
+            "SAVEPOINT ciptools_prepare",
+            "PREPARE ciptools_1 AS SELECT $1",
+            "ROLLBACK TO SAVEPOINT ciptools_prepare",
+            "SELECT %s",
+            "SELECT %s",
+        ])
+
+    def test_evict(self):
+        conn = Recorder()
+        cache = prepared.StatementCache(size=2, threshold=1)
+
+        cache.execute(conn, "SELECT %s, 1", (1,), conn.execute)
+        cache.execute(conn, "SELECT %s, 2", (1,), conn.execute)
+        cache.execute(conn, "SELECT %s, 1", (1,), conn.execute)
+        conn.queries.clear()
+
+        # the second one is the least recently used
+        cache.execute(conn, "SELECT %s, 3", (1,), conn.execute)
+        self.assertEqual(conn.queries[0], ("DEALLOCATE ciptools_2", None))
+        self.assertEqual(list(cache.statements), ["SELECT %s, 1", "SELECT %s, 3"])
+
+    def test_statement_gone(self):
+        conn = Recorder()
+        cache = prepared.StatementCache(threshold=1)
+        cache.execute(conn, "SELECT %s", (1,), conn.execute)
+
+        def execute(query, params=None):
+            conn.queries.append((query, params))
+            if query.startswith("EXECUTE"):
+                raise psycopg2.errors.InvalidSqlStatementName("prepared statement does not exist")
+
+        # outside of a transaction the query is just run again
+        cache.execute(conn, "SELECT %s", (2,), execute)
+        self.assertEqual(conn.queries[-1], ("SELECT %s", (2,)))
+        self.assertEqual(len(cache.statements), 0)
+
+
+class PoolPrepareTests(TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_attach(self):
+        with DatabaseClient(minconn=1, maxconn=1, retry=False, ping="never", prepare=True, prepared_statements=7) as db:
+            with db.conn() as conn:
+                self.assertTrue(issubclass(conn.cursor_factory, prepared.PreparingCursorMixin))
+                self.assertEqual(prepared._caches[conn].size, 7)
+
+            # closing the connection drops its cache
+            db.close()
+            self.assertNotIn(conn, prepared._caches)
+
+    def test_pgbouncer(self):
+        with DatabaseClient(minconn=1, maxconn=1, retry=False, ping="never", prepare=True, pgbouncer=True) as db:
+            with db.conn() as conn:
+                self.assertFalse(issubclass(conn.cursor_factory, prepared.PreparingCursorMixin))
+                self.assertNotIn(conn, prepared._caches)
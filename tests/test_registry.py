@@ -0,0 +1,84 @@
+import os
+import threading
+import weakref
+from unittest import TestCase, mock
+
+import ciptools.database
+from tests.fakes import FakeConnector
+
+
+class RegistryTests(TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        for registry in (ciptools.database.connections, ciptools.database.last_used, ciptools.database.owners):
+            self.addCleanup(registry.clear)
+
+    def connect_in_threads(self, count):
+        # the threads are all alive at once so that they get different ids
+        barrier = threading.Barrier(count)
+
+        def connect():
+            ciptools.database.conn(ping="never")
+            barrier.wait()
+
+        threads = [threading.Thread(target=connect) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_thread_exits(self):
+        main = ciptools.database.conn(ping="never")
+        self.connect_in_threads(3)
+        self.assertEqual(ciptools.database.count(), 4)
+
+        # only the connections of the threads that exited are released
+        self.assertEqual(ciptools.database.sweep(), 3)
+        self.assertEqual(ciptools.database.count(), 1)
+        self.assertEqual([c.closed for c in self.connector.connections], [0, 1, 1, 1])
+        self.assertIs(ciptools.database.conn(ping="never"), main)
+
+    def test_periodic_sweep(self):
+        self.connect_in_threads(1)
+        ciptools.database.conn(ping="never")
+        self.assertEqual(ciptools.database.count(), 2)
+
+        with mock.patch.object(ciptools.database, "SWEEP_INTERVAL", 0):
+            ciptools.database.conn(ping="never")
+        self.assertEqual(ciptools.database.count(), 1)
+
+    def test_fork(self):
+        inherited = ciptools.database.conn(ping="never")
+
+        # pretend to be a child process. the next call notices right away.
+        with mock.patch("os.getpid", return_value=os.getpid() + 1), \
+                mock.patch("ciptools.database.detach") as detach:
+            conn = ciptools.database.conn(ping="never")
+
+        detach.assert_called_once_with(inherited)
+        self.assertIsNot(conn, inherited)
+        self.assertEqual(ciptools.database.count(), 1)
+
+    def test_thread_id_reused_during_sweep(self):
+        class Exited(threading.Thread):
+            # a thread that is gone, except that a new thread with the same
+            # id takes over its connections while the sweep is looking at it
+            def is_alive(self):
+                with mock.patch("ciptools.database.get_connection_id", return_value="reused"):
+                    self.taken = ciptools.database.conn(ping="never")
+                return False
+
+        with mock.patch("ciptools.database.get_connection_id", return_value="reused"):
+            connection = ciptools.database.conn(ping="never")
+        exited = Exited()
+        ciptools.database.owners["reused"] = (os.getpid(), weakref.ref(exited))
+
+        self.assertEqual(ciptools.database.sweep(), 0)
+        self.assertIs(exited.taken, connection)
+        self.assertFalse(connection.closed)
+        self.assertIs(ciptools.database.owners["reused"][1](), threading.current_thread())
+        self.assertEqual(ciptools.database.count(), 1)
@@ -0,0 +1,185 @@
+from unittest import TestCase, mock
+
+import psycopg2
+
+from ciptools.database import routing
+from ciptools.database.pool import DatabaseClient, PoolError
+from tests.fakes import FakeConnector
+
+
+class DownConnector(FakeConnector):
+    """A connector that refuses to connect to some hosts."""
+
+    def __init__(self):
+        super().__init__()
+        self.down = set()
+
+    def __call__(self, *args, **kwargs):
+        if kwargs.get("host") in self.down:
+            raise psycopg2.OperationalError("could not connect to server")
+        return super().__call__(*args, **kwargs)
+
+
+class RouterTests(TestCase):
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch("time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.replicas = [routing.Replica(name, None) for name in ("a", "b", "c")]
+
+    def test_round_robin(self):
+        router = routing.Router(self.replicas, balance=routing.ROUND_ROBIN)
+        chosen = []
+        for _ in range(6):
+            replica, probe = router.choose()
+            self.assertFalse(probe)
+            chosen.append(replica.name)
+            router.release(replica)
+        self.assertEqual(chosen, ["a", "b", "c", "a", "b", "c"])
+
+    def test_least_outstanding(self):
+        router = routing.Router(self.replicas)
+        first, _ = router.choose()
+        second, _ = router.choose()
+        self.assertNotEqual(first, second)
+
+        router.release(first)
+        third, _ = router.choose()
+        self.assertIs(third, first)
+
+    def test_eject_and_probe(self):
+        router = routing.Router(self.replicas[:2], retry_interval=30.0)
+        replica, _ = router.choose()
+        router.eject(replica, "broken")
+        self.assertFalse(replica.healthy)
+
+        for _ in range(3):
+            other, probe = router.choose()
+            self.assertIsNot(other, replica)
+            router.release(other)
+
+        # once enough time has gone by one read gets to probe it
+        self.now += 30.0
+        probed, probe = router.choose()
+        self.assertIs(probed, replica)
+        self.assertTrue(probe)
+        other, probe = router.choose()
+        self.assertIsNot(other, replica)
+        self.assertFalse(probe)
+
+        router.admit(probed)
+        self.assertTrue(probed.healthy)
+        self.assertEqual([status["outstanding"] for status in router.stats()], [1, 1])
+
+    def test_probe_gives_up(self):
+        router = routing.Router(self.replicas[:1], retry_interval=30.0)
+        replica, _ = router.choose()
+        router.eject(replica, "broken")
+
+        # a probe that couldn't check the replica waits for another interval
+        self.now += 30.0
+        probed, probe = router.choose()
+        self.assertTrue(probe)
+        router.release(probed)
+        self.assertFalse(replica.probing)
+        self.assertFalse(replica.healthy)
+        self.assertEqual(router.choose(), (None, False))
+
+        self.now += 30.0
+        self.assertEqual(router.choose(), (replica, True))
+
+    def test_nothing_healthy(self):
+        router = routing.Router(self.replicas[:1])
+        replica, _ = router.choose()
+        router.eject(replica)
+        self.assertEqual(router.choose(), (None, False))
+
+    def test_bad_balance(self):
+        with self.assertRaises(ValueError):
+            routing.Router(self.replicas, balance="random")
+
+
+class ClientRoutingTests(TestCase):
+    def setUp(self):
+        self.connector = DownConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.db = DatabaseClient(
+            host="primary", replicas=["replica1", {"host": "replica2", "port": 5433}],
+            balance=routing.ROUND_ROBIN, ping="never",
+        )
+        self.addCleanup(self.db.close)
+
+    def host(self, **kwargs):
+        with self.db.conn(**kwargs) as conn:
+            return conn.kwargs["host"]
+
+    def test_writes_go_to_primary(self):
+        self.assertEqual(self.host(), "primary")
+        self.assertEqual(self.host(autocommit=False), "primary")
+
+    def test_reads_go_to_replicas(self):
+        self.assertEqual([self.host(readonly=True) for _ in range(4)], ["replica1", "replica2", "replica1", "replica2"])
+        self.assertEqual(self.connector.connections[1].kwargs["port"], 5433)
+
+    def test_stream_goes_to_replica(self):
+        list(self.db.stream("SELECT 1"))
+        self.assertEqual([c.kwargs["host"] for c in self.connector.connections], ["replica1"])
+
+        # but stays in the current transaction
+        with self.db.transaction():
+            list(self.db.stream("SELECT 1"))
+        self.assertEqual(self.connector.connections[-1].kwargs["host"], "primary")
+        self.assertEqual(len(self.connector.connections), 2)
+
+    def test_failed_replica_is_ejected(self):
+        self.connector.down.add("replica1")
+        self.assertEqual([self.host(readonly=True) for _ in range(3)], ["replica2"] * 3)
+
+        replicas = self.db.stats()["replicas"]
+        self.assertEqual([r["healthy"] for r in replicas], [False, True])
+        self.assertEqual([r["outstanding"] for r in replicas], [0, 0])
+
+    def test_falls_back_to_primary(self):
+        self.connector.down.update(["replica1", "replica2"])
+        self.assertEqual(self.host(readonly=True), "primary")
+
+    def test_replica_comes_back(self):
+        self.connector.down.add("replica1")
+        self.host(readonly=True)
+        self.connector.down.clear()
+
+        # not until the retry interval has gone by
+        self.assertEqual([self.host(readonly=True) for _ in range(2)], ["replica2"] * 2)
+
+        with mock.patch("time.monotonic", return_value=self.db._router.replicas[0].ejected_at + 30.0):
+            self.assertEqual(self.host(readonly=True), "replica1")
+        self.assertTrue(self.db._router.replicas[0].healthy)
+        self.assertIn("SELECT 1", self.connector.connections[-1].queries)
+
+    def test_busy_replica_probed_again(self):
+        self.connector.down.add("replica1")
+        self.host(readonly=True)
+        self.connector.down.clear()
+        replica = self.db._router.replicas[0]
+
+        # the probe can't get a connection so the read goes elsewhere
+        probe_at = replica.ejected_at + 30.0
+        with mock.patch("time.monotonic", return_value=probe_at):
+            with mock.patch.object(replica.pool, "getconn", side_effect=PoolError("connection pool exhausted")):
+                self.assertEqual(self.host(readonly=True), "replica2")
+        self.assertFalse(replica.probing)
+        self.assertEqual(replica.ejected_at, probe_at)
+
+        with mock.patch("time.monotonic", return_value=probe_at + 30.0):
+            self.assertEqual(self.host(readonly=True), "replica1")
+        self.assertTrue(replica.healthy)
+
+    def test_broken_connection_ejects(self):
+        with self.db.conn(readonly=True) as conn:
+            conn.close()
+        self.assertFalse(self.db._router.replicas[0].healthy)
@@ -0,0 +1,82 @@
+from unittest import TestCase, mock
+
+import psycopg2.extensions
+import psycopg2.extras
+
+import ciptools.database
+from ciptools.database import rows
+from ciptools.database.pool import DatabaseClient
+from tests.fakes import FakeConnector
+
+
+class RowTypeTests(TestCase):
+    def test_cursor_factory(self):
+        self.assertIs(rows.cursor_factory("dict"), psycopg2.extras.DictCursor)
+        self.assertIs(rows.cursor_factory("tuple"), psycopg2.extensions.cursor)
+        self.assertIs(rows.cursor_factory("namedtuple"), psycopg2.extras.NamedTupleCursor)
+        self.assertIs(rows.cursor_factory("realdict"), psycopg2.extras.RealDictCursor)
+
+        # cursor classes are passed through
+        self.assertIs(rows.cursor_factory(psycopg2.extras.LoggingCursor), psycopg2.extras.LoggingCursor)
+
+    def test_bad_row_type(self):
+        for row_type in ("dicts", None, dict):
+            with self.assertRaises(ValueError):
+                rows.cursor_factory(row_type)
+
+
+class PoolRowTypeTests(TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_default(self):
+        with DatabaseClient(minconn=1, maxconn=1, retry=False, ping="never") as db:
+            with db.conn() as conn:
+                self.assertIs(conn.cursor_factory, psycopg2.extras.DictCursor)
+            self.assertIs(self.connector.connections[0].kwargs["cursor_factory"], psycopg2.extras.DictCursor)
+
+    def test_per_client_and_per_call(self):
+        with DatabaseClient(minconn=1, maxconn=1, retry=False, ping="never", row_type="tuple") as db:
+            with db.conn() as conn:
+                self.assertIs(conn.cursor_factory, psycopg2.extensions.cursor)
+
+            with db.transaction(row_type="namedtuple") as conn:
+                self.assertIs(conn.cursor_factory, psycopg2.extras.NamedTupleCursor)
+
+            # the override only lasted for that checkout
+            with db.conn() as conn:
+                self.assertIs(conn.cursor_factory, psycopg2.extensions.cursor)
+
+    def test_bad_row_type(self):
+        with self.assertRaises(ValueError):
+            DatabaseClient(minconn=0, maxconn=1, retry=False, row_type="list")
+
+
+class LegacyRowTypeTests(TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(ciptools.database.connections.clear)
+        self.addCleanup(ciptools.database.last_used.clear)
+
+    def test_row_type(self):
+        db = ciptools.database.DatabaseClient(client_id="rows", retry=False, ping="never", row_type="realdict")
+        conn = db.conn()
+        self.assertIs(self.connector.connections[0].kwargs["cursor_factory"], psycopg2.extras.RealDictCursor)
+
+        self.assertIs(db.conn(row_type="tuple"), conn)
+        self.assertIs(conn.cursor_factory, psycopg2.extensions.cursor)
+
+        with db.transaction(row_type="namedtuple"):
+            # asking for the connection inside of the transaction doesn't
+            # change what the transaction's rows look like
+            db.conn()
+            self.assertIs(conn.cursor_factory, psycopg2.extras.NamedTupleCursor)
+
+        db.conn()
+        self.assertIs(conn.cursor_factory, psycopg2.extras.RealDictCursor)
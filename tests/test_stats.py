@@ -0,0 +1,34 @@
+from unittest import TestCase
+
+from ciptools.database.stats import Histogram, PoolStats
+
+
+class StatsTests(TestCase):
+    def test_histogram(self):
+        h = Histogram(bounds=(1, 2, 4, 8))
+        for value in (0.5, 1.5, 1.5, 3, 100):
+            h.observe(value)
+
+        snapshot = h.snapshot()
+        self.assertEqual(snapshot["count"], 5)
+        self.assertEqual(snapshot["max"], 100)
+        self.assertEqual(snapshot["p50"], 2)
+        self.assertEqual(snapshot["p99"], 100)
+        self.assertEqual(snapshot["buckets"][-1], (float("inf"), 1))
+
+    def test_empty_histogram(self):
+        self.assertEqual(Histogram().snapshot()["p99"], 0.0)
+
+    def test_hooks(self):
+        stats = PoolStats()
+        seen = []
+        stats.add_hook("checkout", lambda event, value: seen.append((event, value)))
+        stats.add_hook("checkout", lambda event, value: 1 / 0)
+
+        stats.record("checkout", 0.25)
+        stats.record("timeout")
+
+        self.assertEqual(seen, [("checkout", 0.25)])
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot["counters"], {"checkout": 1, "timeout": 1})
+        self.assertEqual(list(snapshot["histograms"]), ["checkout"])
@@ -0,0 +1,172 @@
+from unittest import TestCase, mock
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+import ciptools.database
+from ciptools.database import transactions
+from ciptools.database.pool import DatabaseClient
+from tests.fakes import FakeConnector
+
+
+class NestedTransactionTests(TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.db = DatabaseClient(minconn=1, maxconn=1, retry=False, ping="never", timeout=0)
+        self.addCleanup(self.db.close)
+
+    def test_nested(self):
+        with self.db.transaction() as outer:
+            commit = mock.Mock(wraps=outer.commit)
+            outer.commit = commit
+            with self.db.transaction() as middle:
+                self.assertIs(middle, outer)
+                with self.db.conn(autocommit=False) as inner:
+                    self.assertIs(inner, outer)
+                    with inner.cursor() as cur:
+                        cur.execute("INSERT 1")
+            self.assertEqual(commit.call_count, 0)
+        self.assertEqual(commit.call_count, 1)
+
+        self.assertEqual(outer.queries, [
+            transactions.SAVEPOINT, transactions.SAVEPOINT, "INSERT 1", transactions.RELEASE, transactions.RELEASE,
+        ])
+        self.assertEqual(self.db.stats()["counters"]["checkout"], 1)
+
+    def test_nested_failure(self):
+        with self.db.transaction() as outer:
+            with self.assertRaises(psycopg2.IntegrityError):
+                with self.db.transaction() as nested:
+                    with nested.cursor() as cur:
+                        cur.execute("INSERT 1")
+                    raise psycopg2.IntegrityError("duplicate key value violates unique constraint")
+
+            # the outer transaction carries on
+            self.assertFalse(outer.autocommit)
+            with outer.cursor() as cur:
+                cur.execute("INSERT 2")
+
+        self.assertEqual(outer.queries, [
+            transactions.SAVEPOINT, "INSERT 1", transactions.ROLLBACK, transactions.RELEASE, "INSERT 2",
+        ])
+
+    def test_autocommit_inside_transaction(self):
+        # asking for autocommit still means a connection of its own
+        db = DatabaseClient(minconn=1, maxconn=2, retry=False, ping="never")
+        self.addCleanup(db.close)
+        with db.transaction() as outer:
+            with db.conn() as conn:
+                self.assertIsNot(conn, outer)
+
+    def test_copy_inside_transaction(self):
+        # the copy joins the transaction instead of taking another connection
+        with self.db.transaction() as outer:
+            with outer.cursor() as cur:
+                cur.execute("TRUNCATE things")
+            result = self.db.copy_rows("things", ["id"], [(1,), (2,)])
+            self.assertTrue(outer.in_transaction)
+
+        self.assertEqual(result.rows, 2)
+        self.assertEqual("".join(outer.copied), "1\n2\n")
+        self.assertEqual(self.db.stats()["counters"]["checkout"], 1)
+
+    def test_legacy(self):
+        for registry in (ciptools.database.connections, ciptools.database.last_used, ciptools.database.owners):
+            self.addCleanup(registry.clear)
+
+        db = ciptools.database.DatabaseClient(client_id="nested", retry=False, ping="never")
+        with db.transaction() as outer:
+            with db.transaction() as nested:
+                self.assertIs(nested, outer)
+                with nested.cursor() as cur:
+                    cur.execute("INSERT 1")
+
+            # the inner transaction didn't end the outer one
+            self.assertFalse(outer.autocommit)
+
+            with self.assertRaises(ValueError):
+                with db.transaction():
+                    raise ValueError()
+            self.assertFalse(outer.autocommit)
+
+        self.assertTrue(outer.autocommit)
+        self.assertEqual(outer.queries, [
+            transactions.SAVEPOINT, "INSERT 1", transactions.RELEASE,
+            transactions.SAVEPOINT, transactions.ROLLBACK, transactions.RELEASE,
+        ])
+
+
+class RunInTransactionTests(TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", self.connector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.db = DatabaseClient(minconn=1, maxconn=1, retry=False, ping="never")
+        self.addCleanup(self.db.close)
+
+    def failing(self, *errors):
+        # fails with each error in turn and then works
+        errors = list(errors)
+        calls = []
+
+        def fn(conn):
+            calls.append(conn)
+            if errors:
+                raise errors.pop(0)
+            return "done"
+
+        return fn, calls
+
+    def test_retries(self):
+        fn, calls = self.failing(psycopg2.errors.SerializationFailure(), psycopg2.errors.DeadlockDetected())
+        self.assertEqual(self.db.run_in_transaction(fn, isolation="serializable"), "done")
+        self.assertEqual(len(calls), 3)
+
+        stats = self.db.stats()
+        self.assertEqual(stats["counters"]["transaction_retry"], 2)
+        self.assertNotIn("transaction_failure", stats["counters"])
+
+    def test_gives_up(self):
+        fn, calls = self.failing(*[psycopg2.errors.SerializationFailure() for _ in range(3)])
+        with self.assertRaises(psycopg2.errors.SerializationFailure):
+            self.db.run_in_transaction(fn, max_attempts=3)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.db.stats()["counters"]["transaction_failure"], 1)
+
+    def test_other_errors_not_retried(self):
+        fn, calls = self.failing(psycopg2.errors.UniqueViolation())
+        with self.assertRaises(psycopg2.errors.UniqueViolation):
+            self.db.run_in_transaction(fn)
+        self.assertEqual(len(calls), 1)
+
+    def test_isolation(self):
+        levels = []
+        self.db.run_in_transaction(lambda conn: levels.append(conn.isolation_level), isolation="repeatable_read")
+        self.assertEqual(levels, [psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ])
+
+        # the next checkout gets the server's default again
+        with self.db.conn() as conn:
+            self.assertIsNone(conn.isolation_level)
+
+        with self.assertRaises(ValueError):
+            self.db.run_in_transaction(lambda conn: None, isolation="chaotic")
+
+    def test_nested_not_retried(self):
+        fn, calls = self.failing(psycopg2.errors.SerializationFailure())
+        with self.assertRaises(psycopg2.errors.SerializationFailure):
+            with self.db.transaction() as outer:
+                self.db.run_in_transaction(fn)
+        self.assertEqual(calls, [outer])
+
+    def test_is_retryable(self):
+        self.assertTrue(transactions.is_retryable(psycopg2.errors.SerializationFailure()))
+        self.assertTrue(transactions.is_retryable(psycopg2.errors.DeadlockDetected()))
+        self.assertFalse(transactions.is_retryable(psycopg2.OperationalError()))
+        self.assertFalse(transactions.is_retryable(ValueError()))
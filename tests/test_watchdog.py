@@ -0,0 +1,87 @@
+import threading
+import time
+from unittest import TestCase, mock
+
+from ciptools.database import watchdog
+from ciptools.database.pool import DatabaseClient
+from tests.fakes import FakeConnection, FakeConnector
+
+
+class CancellingConnection(FakeConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class WatchdogTests(TestCase):
+    def test_fires(self):
+        conn = CancellingConnection()
+        watch = watchdog.Watchdog().watch(conn, 0.01)
+        self.assertTrue(conn.cancelled.wait(5))
+        self.assertTrue(watch.fired)
+
+    def test_cancelled(self):
+        dog = watchdog.Watchdog()
+        conn = CancellingConnection()
+        watch = dog.watch(conn, 0.05)
+        watch.cancel()
+
+        # a later watch still goes off and the cancelled one didn't
+        other = CancellingConnection()
+        dog.watch(other, 0.1)
+        self.assertTrue(other.cancelled.wait(5))
+        self.assertFalse(conn.cancelled.is_set())
+        self.assertFalse(watch.fired)
+
+    def test_order(self):
+        dog = watchdog.Watchdog()
+        late, early = CancellingConnection(), CancellingConnection()
+        dog.watch(late, 60)
+        dog.watch(early, 0.01)
+        self.assertTrue(early.cancelled.wait(5))
+        self.assertFalse(late.cancelled.is_set())
+
+
+class DeadlineTests(TestCase):
+    def setUp(self):
+        self.connector = FakeConnector()
+        patcher = mock.patch("psycopg2.connect", lambda *args, **kwargs: self.connect(*args, **kwargs))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.db = DatabaseClient(minconn=1, maxconn=1, retry=False, ping="never")
+        self.addCleanup(self.db.close)
+
+    def connect(self, *args, **kwargs):
+        conn = CancellingConnection(*args, **kwargs)
+        self.connector.connections.append(conn)
+        return conn
+
+    def test_statement_timeout(self):
+        with self.db.transaction(deadline=2.5) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+        self.assertEqual(conn.queries, ["SET statement_timeout = %s", "SELECT 1", "RESET statement_timeout"])
+        self.assertFalse(conn.cancelled.is_set())
+
+        # no deadline, nothing extra
+        with self.db.conn() as again:
+            with again.cursor() as cur:
+                cur.execute("SELECT 2")
+        self.assertIs(again, conn)
+        self.assertEqual(conn.queries[-1], "SELECT 2")
+
+    def test_cancelled_when_deadline_passes(self):
+        with self.db.conn(deadline=0.01) as conn:
+            self.assertTrue(conn.cancelled.wait(5))
+            time.sleep(0.01)
+
+        self.assertEqual(conn.queries[-1], "RESET statement_timeout")
+        self.assertEqual(self.db.stats()["counters"]["deadline"], 1)
+
+        # and the connection is reused
+        with self.db.conn() as again:
+            self.assertIs(again, conn)